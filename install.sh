@@ -119,6 +119,7 @@ collect_user_input() {
     # Generate credentials
     VLESS_UUID=$(generate_uuid)
     HY2_PASSWORD=$(generate_password)
+    CLASH_API_SECRET=$(generate_password)
     ADGUARD_ADMIN_PASS=$(generate_password)
     PATH_PREFIX="sui"
     GATEWAY_CONTAINER="sui-gateway"
@@ -144,6 +145,7 @@ generate_singbox_config() {
         -e "s/\${ACME_EMAIL}/${ACME_EMAIL}/g" \
         -e "s/\${GATEWAY_CONTAINER}/${GATEWAY_CONTAINER}/g" \
         -e "s/\${HY2_PASSWORD}/${HY2_PASSWORD}/g" \
+        -e "s/\${CLASH_API_SECRET}/${CLASH_API_SECRET}/g" \
         "$template_file" > "$output_file"
     
     # Validate JSON
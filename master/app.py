@@ -3,14 +3,34 @@
 
 import os
 import re
+import sys
+import base64
+import bisect
 import hashlib
+import hmac
 import json
 import time
+import ssl
+import mmap
+import fcntl
+import struct
+import tempfile
+import heapq
+import queue
+import random
+import secrets
+import sqlite3
+import asyncio
 import subprocess
+import threading
+import uuid as uuid_lib
 from datetime import datetime
-from collections import defaultdict
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from urllib.parse import urlsplit, urlunsplit, urlencode, parse_qs, quote, unquote
+from collections import defaultdict, OrderedDict
 from functools import wraps
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeout
 from flask import Flask, render_template, request, jsonify, Response
 import requests
 
@@ -19,58 +39,200 @@ app = Flask(__name__)
 DATA_DIR = os.environ.get('DATA_DIR', '/data')
 CLUSTER_SECRET = os.environ.get('CLUSTER_SECRET', '')
 NODES_FILE = os.path.join(DATA_DIR, 'nodes.json')
+NODES_DB = os.path.join(DATA_DIR, 'nodes.db')
+NODE_REGISTRY = os.environ.get('NODE_REGISTRY', 'sqlite')  # sqlite | json
 SETTINGS_FILE = os.path.join(DATA_DIR, 'settings.json')
+CACHE_DB = os.path.join(DATA_DIR, 'cache.db')
+JOBS_DB = os.path.join(DATA_DIR, 'jobs.db')
+TSDB_DIR = os.path.join(DATA_DIR, 'tsdb')
+USERS_DB = os.path.join(DATA_DIR, 'users.db')
 SALT = "SUI_Solo_Secured_2025"
 VERSION = "2.0.0"
 GITHUB_REPO = "https://github.com/pjonix/SUIS"
 GITHUB_RAW = "https://raw.githubusercontent.com/pjonix/SUIS/main"
 
+# Master -> node connection pool
+NODE_POOL_MAXSIZE = int(os.environ.get('NODE_POOL_MAXSIZE', '4'))
+NODE_POOL_MAX_NODES = int(os.environ.get('NODE_POOL_MAX_NODES', '256'))
+NODE_POOL_IDLE_TIMEOUT = int(os.environ.get('NODE_POOL_IDLE_TIMEOUT', '120'))
+NODE_FANOUT_CONCURRENCY = int(os.environ.get('NODE_FANOUT_CONCURRENCY', '512'))
+
+# Log streams relayed from nodes (agents send a heartbeat every 15s)
+LOG_STREAM_IDLE_TIMEOUT = int(os.environ.get('LOG_STREAM_IDLE_TIMEOUT', '60'))
+
+# Background node health polling (interval 0 disables the poller)
+HEALTH_POLL_INTERVAL = int(os.environ.get('HEALTH_POLL_INTERVAL', '30'))
+HEALTH_POLL_JITTER = float(os.environ.get('HEALTH_POLL_JITTER', '0.2'))
+HEALTH_POLL_CONCURRENCY = int(os.environ.get('HEALTH_POLL_CONCURRENCY', '16'))
+HEALTH_POLL_TIMEOUT = int(os.environ.get('HEALTH_POLL_TIMEOUT', '5'))
+HEALTH_FLUSH_INTERVAL = int(os.environ.get('HEALTH_FLUSH_INTERVAL', '10'))
+
+# Container state changes pushed by agents (POST /api/nodes/events); last N kept per node
+NODE_RECENT_EVENTS = int(os.environ.get('NODE_RECENT_EVENTS', '20'))
+
+# Shared subscription cache (fresh for TTL, served stale while refreshing up to STALE_TTL)
+SUBSCRIPTION_CACHE_TTL = int(os.environ.get('SUBSCRIPTION_CACHE_TTL', '300'))
+SUBSCRIPTION_STALE_TTL = int(os.environ.get('SUBSCRIPTION_STALE_TTL', '86400'))
+SUBSCRIPTION_CACHE_MAX_BYTES = int(os.environ.get('SUBSCRIPTION_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+SUBSCRIPTION_CACHE_MAX_ENTRIES = int(os.environ.get('SUBSCRIPTION_CACHE_MAX_ENTRIES', '64'))
+
+# Subscription users (changes within SYNC_DELAY are pushed to nodes together; rendered
+# per-user subscriptions are memoized per worker, least recently used evicted first)
+USER_SYNC_DELAY = float(os.environ.get('USER_SYNC_DELAY', '2'))
+USER_SYNC_TIMEOUT = int(os.environ.get('USER_SYNC_TIMEOUT', '120'))
+USER_SUBSCRIPTION_MEMO = int(os.environ.get('USER_SUBSCRIPTION_MEMO', '20000'))
+
+# Per-user traffic reported by nodes (POST /api/nodes/usage), written to users.db every FLUSH_INTERVAL
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL', '5'))
+
+# Node config templates (sources fetched from a node's agent, refetched after TTL seconds)
+TEMPLATE_SOURCE_TTL = int(os.environ.get('TEMPLATE_SOURCE_TTL', '300'))
+
+# Config rollouts (nodes pushed in parallel; TIMEOUT covers a sing-box apply with health check and rollback)
+CONFIG_ROLLOUT_PARALLELISM = int(os.environ.get('CONFIG_ROLLOUT_PARALLELISM', '16'))
+CONFIG_ROLLOUT_TIMEOUT = int(os.environ.get('CONFIG_ROLLOUT_TIMEOUT', '90'))
+
+# Batch fleet endpoints
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '16'))
+BATCH_DEADLINE = float(os.environ.get('BATCH_DEADLINE', '15'))
+
+# Rolling fleet updates
+ROLLOUT_PARALLELISM = int(os.environ.get('ROLLOUT_PARALLELISM', '5'))
+ROLLOUT_CANARY = int(os.environ.get('ROLLOUT_CANARY', '1'))
+ROLLOUT_MAX_FAILURE_RATIO = float(os.environ.get('ROLLOUT_MAX_FAILURE_RATIO', '0.2'))
+ROLLOUT_UPDATE_TIMEOUT = int(os.environ.get('ROLLOUT_UPDATE_TIMEOUT', '120'))
+ROLLOUT_HEALTH_TIMEOUT = int(os.environ.get('ROLLOUT_HEALTH_TIMEOUT', '180'))
+
+# Per-boot state shared by the gunicorn workers (tmpfs when available)
+RUNTIME_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Rate limiting (slot table shared by all workers through RATE_LIMIT_DIR; empty = per process)
+RATE_LIMIT_SLOTS = int(os.environ.get('RATE_LIMIT_SLOTS', '16384'))
+RATE_LIMIT_DIR = os.environ.get('RATE_LIMIT_DIR', RUNTIME_DIR)
+RATE_LIMIT_FILE = 'sui-master-ratelimit-{}.bin'
+
+# Metrics (each worker publishes its totals to METRICS_DIR for /metrics)
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(RUNTIME_DIR, 'sui-master-metrics'))
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+# Users created here are named with this prefix; agents replace only users carrying it (agent MANAGED_USER_PREFIX)
+MANAGED_USER_PREFIX = 'sui-'
+
 # Regex patterns
 DOMAIN_PATTERN = re.compile(r'^[a-zA-Z0-9]([a-zA-Z0-9\-\.]{0,253}[a-zA-Z0-9])?$')
 NODE_ID_PATTERN = re.compile(r'^[a-f0-9]{8}$')
+USER_ID_PATTERN = re.compile(rf'^{MANAGED_USER_PREFIX}[a-f0-9]{{12}}$')
+USER_TOKEN_PATTERN = re.compile(r'^[A-Za-z0-9_-]{32}$')
 
 
+# Kept identical to RateLimiter in node/agent.py (tests/test_shared_code.bats)
 class RateLimiter:
-    def __init__(self, max_requests: int = 10, window_seconds: int = 60):
+    """Sliding-window counter per client in a fixed-size slot table.
+
+    Each key costs one 32-byte slot (current and previous window counts), so
+    memory is bounded by RATE_LIMIT_SLOTS no matter how many addresses show up;
+    when a key's probe run is full the least recently seen, least busy slot is reused.
+    With a state directory the table lives in a shared mmap guarded by flock,
+    so every gunicorn worker enforces the same limit.
+    """
+
+    SLOT = struct.Struct('<QqIId')  # key hash, window index, current, previous, blocked until
+    PROBE = 8
+
+    def __init__(self, max_requests=10, window_seconds=60, name=None, slots=RATE_LIMIT_SLOTS, block_seconds=0):
+        self.name = name
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests = defaultdict(list)
-
-    def is_allowed(self, client_ip: str) -> bool:
-        now = time.time()
-        self.requests[client_ip] = [t for t in self.requests[client_ip] if now - t < self.window_seconds]
-        if len(self.requests[client_ip]) >= self.max_requests:
-            return False
-        self.requests[client_ip].append(now)
-        return True
+        self.block_seconds = block_seconds
+        self.slots = max(slots, self.PROBE)
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._fd = None
+        size = self.slots * self.SLOT.size
+        path = os.path.join(RATE_LIMIT_DIR, RATE_LIMIT_FILE.format(name)) if name and RATE_LIMIT_DIR else None
+        if path:
+            try:
+                self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(self._fd).st_size != size:
+                        os.ftruncate(self._fd, 0)
+                        os.ftruncate(self._fd, size)
+                finally:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                self._table = mmap.mmap(self._fd, size)
+            except OSError as e:
+                app.logger.warning(f'Rate limiter {name}: shared state unavailable ({e}), using per-process table')
+                if self._fd is not None:
+                    os.close(self._fd)
+                self._fd = None
+        if self._fd is None:
+            self._table = mmap.mmap(-1, size)
 
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
 
-api_limiter = RateLimiter(max_requests=30, window_seconds=60)
-auth_limiter = RateLimiter(max_requests=5, window_seconds=60)
+    def _find(self, h):
+        """Slot offset for h: its own slot, else an empty one, else the stalest in the probe run.
 
+        Among slots last seen in the same window the one with the fewest requests
+        goes, so a scan from many addresses cannot evict (and reset) a busy client.
+        """
+        unpack, size = self.SLOT.unpack_from, self.SLOT.size
+        start = h % self.slots
+        victim, victim_rank = None, None
+        for i in range(self.PROBE):
+            offset = ((start + i) % self.slots) * size
+            key, window, current, _, _ = unpack(self._table, offset)
+            if key == h:
+                return offset, True
+            if key == 0:
+                return offset, False
+            if victim is None or (window, current) < victim_rank:
+                victim, victim_rank = offset, (window, current)
+        return victim, False
 
-# Simple subscription cache (5 minutes TTL)
-class SubscriptionCache:
-    def __init__(self, ttl=300):
-        self.cache = {}
-        self.ttl = ttl
-    
-    def get(self, key):
-        if key in self.cache:
-            data, timestamp = self.cache[key]
-            if time.time() - timestamp < self.ttl:
-                return data
-            del self.cache[key]
-        return None
-    
-    def set(self, key, data):
-        self.cache[key] = (data, time.time())
-    
-    def clear(self):
-        self.cache.clear()
+    def is_allowed(self, client_ip, consume=True):
+        """Count a request from client_ip; with consume=False only report whether it would pass."""
+        h = self._hash(client_ip)
+        now = time.time()
+        window, position = divmod(now, self.window_seconds)
+        window = int(window)
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, found = self._find(h)
+                current = previous = 0
+                blocked_until = 0.0
+                if found:
+                    _, last, current, previous, blocked_until = self.SLOT.unpack_from(self._table, offset)
+                    if last != window:
+                        previous = current if last == window - 1 else 0
+                        current = 0
+                if now < blocked_until:
+                    allowed = False
+                else:
+                    estimate = previous * (1 - position / self.window_seconds) + current
+                    allowed = estimate < self.max_requests
+                    if not allowed and consume and self.block_seconds:
+                        blocked_until = now + self.block_seconds
+                if allowed and consume:
+                    current += 1
+                if consume or found:
+                    self.SLOT.pack_into(self._table, offset, h, window, current, previous, blocked_until)
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if not allowed:
+            self.rejected += 1
+        return allowed
 
 
-subscription_cache = SubscriptionCache(ttl=300)  # 5 minutes
+api_limiter = RateLimiter(max_requests=30, window_seconds=60, name='api')
+auth_limiter = RateLimiter(max_requests=5, window_seconds=60, name='auth')
+event_limiter = RateLimiter(max_requests=120, window_seconds=60, name='events')
 
 
 def get_client_ip():
@@ -121,284 +283,2121 @@ def load_json(filepath, default=None):
 
 def save_json(filepath, data):
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    with open(filepath, 'w') as f:
+    tmp = f'{filepath}.tmp'
+    with open(tmp, 'w') as f:
         json.dump(data, f, indent=2)
+    os.replace(tmp, filepath)
 
 
-def load_nodes():
-    return load_json(NODES_FILE, {})
+def connect_sqlite(path):
+    """Autocommit SQLite connection in WAL mode (one per thread)"""
+    db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
 
 
-def save_nodes(nodes):
-    save_json(NODES_FILE, nodes)
+# Kept identical to LeaderLock in node/agent.py (tests/test_shared_code.bats)
+class LeaderLock:
+    """Non-blocking flock that elects one worker for a background loop; held until the worker exits"""
 
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
 
-def load_settings():
-    return load_json(SETTINGS_FILE, {'auto_update': False, 'last_update_check': None})
+    def acquire(self):
+        """True once this worker holds the lock; cheap enough to call on every iteration"""
+        if self.lock_file:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
 
 
-def save_settings(settings):
-    save_json(SETTINGS_FILE, settings)
+# ============================================================================
+# METRICS - Prometheus text exposition, summed over threads and workers
+# ============================================================================
+# Kept identical to Metrics in node/agent.py (tests/test_shared_code.bats)
+class Metrics:
+    """Counters and histograms with one shard per recording thread.
 
+    A thread only ever writes its own shard (a plain dict), so recording is a
+    dict update without locks; the shard list itself is locked once per new
+    thread. Each worker periodically writes its merged totals to METRICS_DIR
+    and render() sums every live worker's snapshot, so any worker can answer a
+    scrape for the whole service. Collectors add counters that components
+    already keep (cache stats, pool stats) at snapshot time.
+    """
 
-def get_node_api_url(node):
-    protocol = 'https' if node.get('https', True) else 'http'
-    return f"{protocol}://{node['domain']}/{get_hidden_path(CLUSTER_SECRET)}/api/v1"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
+    def __init__(self, prefix, directory):
+        self.prefix = prefix
+        self.directory = directory
+        self.families = {}  # name -> (type, help, label names, buckets)
+        self.collectors = []
+        self.shards = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
 
-def call_node_api(node, endpoint, method='GET', data=None, timeout=30):
-    url = f"{get_node_api_url(node)}/{endpoint}"
-    headers = {'X-SUI-Token': CLUSTER_SECRET}
-    try:
-        if method == 'GET':
-            resp = requests.get(url, headers=headers, timeout=timeout)
-        else:
-            resp = requests.post(url, headers=headers, json=data, timeout=timeout)
-        return resp.json() if resp.ok else {'error': resp.text}
-    except Exception as e:
-        return {'error': str(e)}
+    def counter(self, name, help_text, labels=()):
+        self.families[name] = ('counter', help_text, tuple(labels), None)
 
+    def histogram(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.families[name] = ('histogram', help_text, tuple(labels), tuple(buckets))
 
-def check_for_updates():
-    """Check GitHub for latest version"""
-    try:
-        resp = requests.get(f"{GITHUB_RAW}/master/app.py", timeout=10)
-        if resp.ok:
-            match = re.search(r'VERSION\s*=\s*["\']([^"\']+)["\']', resp.text)
-            if match:
-                return {'current': VERSION, 'latest': match.group(1), 'update_available': match.group(1) != VERSION}
-    except Exception:
+    def collector(self, fn):
+        """fn() -> iterable of (counter name, label values, value); families must be declared"""
+        self.collectors.append(fn)
+        return fn
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        key = (name, labels)
+        slot = shard.get(key)
+        if slot is None:
+            slot = shard[key] = [0] * (len(self.families[name][3]) + 3)  # buckets, +Inf, sum, count
+        slot[bisect.bisect_left(self.families[name][3], value)] += 1
+        slot[-2] += value
+        slot[-1] += 1
+
+    def snapshot(self):
+        """This worker's totals as {'name\\x1flabel...': value or bucket list}"""
+        totals = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            while True:
+                try:
+                    items = list(shard.items())
+                    break
+                except RuntimeError:
+                    continue  # resized by its owner thread mid-copy
+            for (name, labels), value in items:
+                _merge_metric(totals, '\x1f'.join((name, *labels)), value)
+        for fn in self.collectors:
+            try:
+                for name, labels, value in fn():
+                    _merge_metric(totals, '\x1f'.join((name, *labels)), value)
+            except Exception as e:
+                app.logger.warning(f'Metrics collector {fn.__name__} failed: {e}')
+        return totals
+
+    def flush(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.warning(f'Metrics flush failed: {e}')
+
+    def render(self):
+        totals = self.snapshot()
+        for entry in (os.listdir(self.directory) if os.path.isdir(self.directory) else []):
+            pid = entry.partition('.')[0]
+            if not entry.endswith('.json') or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                os.unlink(os.path.join(self.directory, entry))  # worker is gone
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(os.path.join(self.directory, entry)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # being replaced or just removed
+            for key, value in snapshot.items():
+                _merge_metric(totals, key, value)
+
+        series = defaultdict(list)
+        for key, value in totals.items():
+            name, *labels = key.split('\x1f')
+            series[name].append((tuple(labels), value))
+        out = []
+        for name, (kind, help_text, label_names, buckets) in self.families.items():
+            full = f'{self.prefix}_{name}'
+            out.append(f'# HELP {full} {help_text}')
+            out.append(f'# TYPE {full} {kind}')
+            for labels, value in sorted(series.get(name, [])):
+                pairs = [f'{k}="{_escape_label(v)}"' for k, v in zip(label_names, labels)]
+                if kind == 'counter':
+                    out.append(f'{full}{_label_set(pairs)} {value:g}')
+                    continue
+                cumulative = 0
+                for bound, count in zip((*buckets, '+Inf'), value):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    out.append(f'{full}_bucket{_label_set(pairs + [le])} {cumulative}')
+                out.append(f'{full}_sum{_label_set(pairs)} {value[-2]:g}')
+                out.append(f'{full}_count{_label_set(pairs)} {value[-1]}')
+        return '\n'.join(out) + '\n'
+
+
+def _merge_metric(totals, key, value):
+    if isinstance(value, list):
+        current = totals.get(key)
+        totals[key] = [a + b for a, b in zip(current, value)] if current else list(value)
+    else:
+        totals[key] = totals.get(key, 0) + value
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_set(pairs):
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+metrics = Metrics('sui_master', METRICS_DIR)
+metrics.histogram('http_request_duration_seconds', 'Time to response headers per route', ('method', 'route', 'status'))
+metrics.histogram('node_request_duration_seconds', 'Master to node API call latency', ('node',))
+metrics.counter('node_request_errors_total', 'Failed master to node API calls', ('node', 'kind'))
+metrics.counter('node_connections_total', 'Node client connection events', ('event',))
+metrics.counter('subscription_cache_events_total', 'Subscription cache lookups and refreshes', ('event',))
+metrics.counter('subscription_fragments_total', 'Per-node subscription fragments served from memo or rebuilt', ('event',))
+metrics.counter('user_subscriptions_total', 'Per-user subscriptions served from memo, rendered or evicted', ('event',))
+metrics.counter('usage_batches_total', 'Per-user traffic batches received from nodes', ('result',))
+metrics.counter('user_quota_changes_total', 'Users disabled over quota or re-enabled under it', ('action',))
+metrics.counter('rate_limit_rejections_total', 'Requests rejected by a rate limiter', ('limiter',))
+metrics.counter('node_container_events_total', 'Container state changes pushed by nodes', ('action',))
+
+
+@app.before_request
+def start_request_timer():
+    request.environ['sui.started'] = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = request.environ.get('sui.started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', (request.method, route, str(response.status_code)),
+                        time.perf_counter() - started)
+    return response
+
+
+# ============================================================================
+# NODE REGISTRY - pluggable storage for registered nodes
+# ============================================================================
+class NodeRegistry(ABC):
+    """Storage interface for registered nodes ({node_id: node dict})"""
+
+    @abstractmethod
+    def all(self):
         pass
-    return {'current': VERSION, 'latest': VERSION, 'update_available': False}
 
+    @abstractmethod
+    def get(self, node_id):
+        pass
 
-@app.route('/')
-@rate_limit(api_limiter)
-def index():
-    settings = load_settings()
-    return render_template('index.html', nodes=load_nodes(), settings=settings, version=VERSION)
+    @abstractmethod
+    def find_by_domain(self, domain):
+        pass
 
+    @abstractmethod
+    def add(self, node_id, node):
+        pass
 
-@app.route('/api/nodes', methods=['GET'])
-@rate_limit(api_limiter)
-def list_nodes():
-    return jsonify(load_nodes())
+    def update(self, node_id, **fields):
+        return self.update_many({node_id: fields}).get(node_id)
 
+    @abstractmethod
+    def update_many(self, updates):
+        """Merge fields into several nodes atomically, returns the updated nodes"""
 
-@app.route('/api/nodes', methods=['POST'])
-@rate_limit(api_limiter)
-def add_node():
-    data = request.json or {}
-    try:
-        name = sanitize_name(data.get('name'))
-        domain = sanitize_domain(data.get('domain'))
-        if not name or not domain:
-            return jsonify({'error': 'Missing name or domain'}), 400
-    except ValueError as e:
-        return jsonify({'error': str(e)}), 400
-    
-    nodes = load_nodes()
-    node_id = hashlib.md5(domain.encode()).hexdigest()[:8]
-    nodes[node_id] = {
-        'name': name,
-        'domain': domain,
-        'https': data.get('https', True),
-        'added_at': datetime.now().isoformat(),
-        'status': 'unknown'
-    }
-    save_nodes(nodes)
-    return jsonify({'id': node_id, 'node': nodes[node_id]})
+    @abstractmethod
+    def delete(self, node_id):
+        pass
 
 
-@app.route('/api/nodes/<node_id>', methods=['DELETE'])
-@rate_limit(api_limiter)
-def delete_node(node_id):
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id in nodes:
-        del nodes[node_id]
-        save_nodes(nodes)
-        return jsonify({'success': True})
-    return jsonify({'error': 'Node not found'}), 404
+class JsonNodeRegistry(NodeRegistry):
+    """Legacy nodes.json backend; read-modify-write is serialized with flock"""
 
+    def __init__(self, path):
+        self.path = path
 
-@app.route('/api/nodes/<node_id>/status')
-@rate_limit(api_limiter)
-def node_status(node_id):
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    result = call_node_api(nodes[node_id], 'status')
-    nodes[node_id]['status'] = 'online' if 'error' not in result else 'offline'
-    nodes[node_id]['last_check'] = datetime.now().isoformat()
-    save_nodes(nodes)
-    return jsonify(result)
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(f'{self.path}.lock', 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
 
+    def all(self):
+        return load_json(self.path, {})
 
-@app.route('/api/nodes/<node_id>/services')
-@rate_limit(api_limiter)
-def node_services(node_id):
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'services'))
+    def get(self, node_id):
+        return self.all().get(node_id)
 
+    def find_by_domain(self, domain):
+        for node_id, node in self.all().items():
+            if node.get('domain') == domain:
+                return node_id, node
+        return None
 
-@app.route('/api/nodes/<node_id>/restart/<service>', methods=['POST'])
-@rate_limit(auth_limiter)
-def restart_service(node_id, service):
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    try:
-        service = sanitize_service(service)
-    except ValueError as e:
-        return jsonify({'error': str(e)}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], f'restart/{service}', 'POST'))
+    def add(self, node_id, node):
+        with self._locked():
+            nodes = self.all()
+            nodes[node_id] = node
+            save_json(self.path, nodes)
 
+    def update_many(self, updates):
+        with self._locked():
+            nodes = self.all()
+            changed = {}
+            for node_id, fields in updates.items():
+                if node_id in nodes:
+                    nodes[node_id].update(fields)
+                    changed[node_id] = nodes[node_id]
+            if changed:
+                save_json(self.path, nodes)
+            return changed
 
-@app.route('/api/nodes/<node_id>/config/<service>', methods=['GET', 'POST'])
-@rate_limit(api_limiter)
-def config(node_id, service):
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    try:
-        service = sanitize_service(service)
-    except ValueError as e:
-        return jsonify({'error': str(e)}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    
-    if request.method == 'POST':
-        return jsonify(call_node_api(nodes[node_id], f'config/{service}', 'POST', request.json))
-    return jsonify(call_node_api(nodes[node_id], f'config/{service}'))
+    def delete(self, node_id):
+        with self._locked():
+            nodes = self.all()
+            if nodes.pop(node_id, None) is None:
+                return False
+            save_json(self.path, nodes)
+            return True
 
 
-@app.route('/api/nodes/<node_id>/logs/<service>')
-@rate_limit(api_limiter)
-def node_logs(node_id, service):
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    try:
-        service = sanitize_service(service)
-    except ValueError as e:
-        return jsonify({'error': str(e)}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    lines = request.args.get('lines', '100')
-    return jsonify(call_node_api(nodes[node_id], f'logs/{service}?lines={lines}'))
+class SqliteNodeRegistry(NodeRegistry):
+    """SQLite (WAL) backend with an in-process read cache.
 
+    Every write bumps a change counter and stamps the rows it touched, so a
+    cached copy is refreshed by reading only the rows changed since.
+    """
 
-@app.route('/api/nodes/<node_id>/update', methods=['POST'])
-@rate_limit(auth_limiter)
-def update_node(node_id):
-    """Trigger update on a specific node"""
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'update', 'POST', timeout=120))
+    def __init__(self, path, legacy_json=None):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.cache_version = -1
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._write() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS nodes ('
+                       'id TEXT PRIMARY KEY, domain TEXT NOT NULL UNIQUE, '
+                       'data TEXT NOT NULL, rev INTEGER NOT NULL DEFAULT 0)')
+            db.execute('CREATE INDEX IF NOT EXISTS nodes_rev ON nodes(rev)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+            migrated = legacy_json and self._migrate(db, legacy_json)
+        if migrated:
+            # Only once the import is committed; a rollback leaves nodes.json where it was
+            os.replace(legacy_json, f'{legacy_json}.migrated')
 
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = connect_sqlite(self.path)
+        return db
 
-@app.route('/api/nodes/<node_id>/restart-all', methods=['POST'])
-@rate_limit(auth_limiter)
-def restart_node_all(node_id):
-    """Restart all containers on a node"""
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'restart-all', 'POST', timeout=60))
+    class _Transaction:
+        def __init__(self, db):
+            self.db = db
 
+        def __enter__(self):
+            self.db.execute('BEGIN IMMEDIATE')
+            return self.db
 
-@app.route('/api/nodes/<node_id>/proxies')
-@rate_limit(api_limiter)
-def node_proxies(node_id):
-    """Get all proxy configurations from a node"""
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'proxies'))
+        def __exit__(self, exc_type, exc, tb):
+            self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
 
+    def _write(self):
+        return self._Transaction(self._db())
 
-@app.route('/api/nodes/<node_id>/firewall', methods=['GET'])
-@rate_limit(api_limiter)
-def get_node_firewall(node_id):
-    """Get firewall status from a node"""
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'firewall'))
+    @staticmethod
+    def _bump(db):
+        db.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        return db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
 
+    def _migrate(self, db, legacy_json):
+        """Import nodes.json into an empty registry; True when the caller should archive it"""
+        if not os.path.exists(legacy_json) or db.execute('SELECT 1 FROM nodes LIMIT 1').fetchone():
+            return False
+        rows, domains = [], {}
+        for node_id, node in load_json(legacy_json, {}).items():
+            domain = node.get('domain', node_id)
+            if domain in domains:
+                # domain is UNIQUE; the node stays in nodes.json.migrated
+                app.logger.warning(f'nodes.json: not importing node {node_id}, '
+                                   f'its domain {domain} is already used by node {domains[domain]}')
+                continue
+            domains[domain] = node_id
+            rows.append((node_id, domain, json.dumps(node)))
+        rev = self._bump(db)
+        db.executemany('INSERT INTO nodes (id, domain, data, rev) VALUES (?, ?, ?, ?)',
+                       [(*row, rev) for row in rows])
+        app.logger.info(f'Imported {len(rows)} node(s) from nodes.json into {self.path}')
+        return True
 
-@app.route('/api/nodes/<node_id>/firewall', methods=['POST'])
-@rate_limit(auth_limiter)
-def set_node_firewall(node_id):
-    """Configure firewall on a node"""
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'firewall', 'POST', request.json))
+    def _refresh(self):
+        db = self._db()
+        version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+        with self.lock:
+            if version == self.cache_version:
+                return
+            rows = db.execute('SELECT id, data FROM nodes WHERE rev > ?', (self.cache_version,)).fetchall()
+            for node_id, data in rows:
+                self.cache[node_id] = json.loads(data)
+            count = db.execute('SELECT COUNT(*) FROM nodes').fetchone()[0]
+            if count != len(self.cache):
+                # Rows were deleted since the last refresh
+                ids = {row[0] for row in db.execute('SELECT id FROM nodes')}
+                self.cache = {k: v for k, v in self.cache.items() if k in ids}
+            self.cache_version = version
 
+    def all(self):
+        self._refresh()
+        with self.lock:
+            return {k: dict(v) for k, v in self.cache.items()}
 
-# Settings & Update APIs
-@app.route('/api/settings', methods=['GET', 'POST'])
-@rate_limit(api_limiter)
-def settings():
-    if request.method == 'GET':
-        return jsonify(load_settings())
-    
-    data = request.json or {}
-    current = load_settings()
-    if 'auto_update' in data:
-        current['auto_update'] = bool(data['auto_update'])
-    save_settings(current)
-    return jsonify(current)
+    def get(self, node_id):
+        self._refresh()
+        node = self.cache.get(node_id)
+        return dict(node) if node is not None else None
 
+    def find_by_domain(self, domain):
+        row = self._db().execute('SELECT id, data FROM nodes WHERE domain = ?', (domain,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
 
-@app.route('/api/update/check')
-@rate_limit(api_limiter)
-def update_check():
-    """Check for available updates"""
-    result = check_for_updates()
-    settings = load_settings()
-    settings['last_update_check'] = datetime.now().isoformat()
-    save_settings(settings)
-    return jsonify(result)
+    def add(self, node_id, node):
+        with self._write() as db:
+            rev = self._bump(db)
+            db.execute('DELETE FROM nodes WHERE domain = ? AND id != ?', (node['domain'], node_id))
+            db.execute('INSERT OR REPLACE INTO nodes (id, domain, data, rev) VALUES (?, ?, ?, ?)',
+                       (node_id, node['domain'], json.dumps(node), rev))
 
+    def update_many(self, updates):
+        changed = {}
+        with self._write() as db:
+            rev = self._bump(db)
+            for node_id, fields in updates.items():
+                row = db.execute('SELECT data FROM nodes WHERE id = ?', (node_id,)).fetchone()
+                if row:
+                    node = json.loads(row[0])
+                    node.update(fields)
+                    db.execute('UPDATE nodes SET data = ?, rev = ? WHERE id = ?', (json.dumps(node), rev, node_id))
+                    changed[node_id] = node
+        return changed
 
-@app.route('/api/update/master', methods=['POST'])
-@rate_limit(auth_limiter)
-def update_master():
-    """Update master to latest version and restart"""
-    import shutil
-    import threading
-    import zipfile
-    import io
-    
-    try:
-        # Get the directory where app.py is located
-        app_dir = os.path.dirname(os.path.abspath(__file__))
-        templates_dir = os.path.join(app_dir, 'templates')
-        
-        # Download latest using requests (curl not available in container)
+    def delete(self, node_id):
+        with self._write() as db:
+            self._bump(db)
+            return db.execute('DELETE FROM nodes WHERE id = ?', (node_id,)).rowcount > 0
+
+
+def create_node_registry():
+    if NODE_REGISTRY == 'json':
+        return JsonNodeRegistry(NODES_FILE)
+    return SqliteNodeRegistry(NODES_DB, legacy_json=NODES_FILE)
+
+
+node_registry = create_node_registry()
+
+
+def load_nodes():
+    return node_registry.all()
+
+
+def load_settings():
+    return load_json(SETTINGS_FILE, {'auto_update': False, 'last_update_check': None})
+
+
+def save_settings(settings):
+    save_json(SETTINGS_FILE, settings)
+
+
+# ============================================================================
+# SUBSCRIPTION CACHE - shared by all gunicorn workers
+# ============================================================================
+class SubscriptionCache:
+    """Cross-worker subscription cache on a SQLite file.
+
+    Fresh entries are served for `ttl` seconds; after that they are served stale
+    (up to `stale_ttl`) while exactly one refresh runs in the background. The
+    refresh is single-flight across threads and workers via a per-key flock, and
+    cold misses wait on the same lock instead of fanning out again. Entries are
+    evicted least-recently-used once the size or entry bound is exceeded.
+    """
+
+    def __init__(self, path, ttl=300, stale_ttl=86400, max_bytes=64 * 1024 * 1024, max_entries=64):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.lock_dir = os.path.join(os.path.dirname(path), 'cache-locks')
+        self.local = threading.local()
+        self.stats = defaultdict(int)  # per-worker counters
+        self.initialized = False
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            db = connect_sqlite(self.path)
+            if not self.initialized:
+                db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                           'key TEXT PRIMARY KEY, value BLOB NOT NULL, mimetype TEXT NOT NULL, '
+                           'created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)')
+                db.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)')
+                self.initialized = True
+            self.local.db = db
+        return db
+
+    def _lock_path(self, key):
+        return os.path.join(self.lock_dir, hashlib.sha1(key.encode()).hexdigest()[:16] + '.lock')
+
+    def get(self, key):
+        """Returns (value, mimetype, age) or None"""
+        db = self._db()
+        row = db.execute('SELECT value, mimetype, created, accessed FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        age = now - row[2]
+        if age >= self.stale_ttl:
+            return None
+        if now - row[3] > 5:
+            # LRU bookkeeping, at most one write per key every few seconds
+            db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        return row[0], row[1], age
+
+    def version(self, key):
+        """(created, age) of a servable entry without reading its value, or None"""
+        row = self._db().execute('SELECT created FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or time.time() - row[0] >= self.stale_ttl:
+            return None
+        return row[0], time.time() - row[0]
+
+    def revalidate(self, key, builder):
+        """Serve-stale bookkeeping for callers that kept their own copy: refresh in the background"""
+        self.stats['stale_hits'] += 1
+        self._refresh_in_background(key, builder)
+
+    def set(self, key, value, mimetype):
+        if isinstance(value, str):
+            value = value.encode()
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT OR REPLACE INTO entries (key, value, mimetype, created, accessed, size) '
+                       'VALUES (?, ?, ?, ?, ?, ?)', (key, value, mimetype, now, now, len(value)))
+            count, total = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+            if count > self.max_entries or total > self.max_bytes:
+                for old_key, size in db.execute('SELECT key, size FROM entries WHERE key != ? ORDER BY accessed',
+                                                (key,)).fetchall():
+                    if count <= self.max_entries and total <= self.max_bytes:
+                        break
+                    db.execute('DELETE FROM entries WHERE key = ?', (old_key,))
+                    count, total = count - 1, total - size
+                    self.stats['evictions'] += 1
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def clear(self):
+        self._db().execute('DELETE FROM entries')
+
+    def _refresh(self, key, builder, lock_file):
+        try:
+            value, mimetype = builder()
+            self.set(key, value, mimetype)
+            self.stats['refreshes'] += 1
+            return value, mimetype
+        except Exception as e:
+            self.stats['refresh_errors'] += 1
+            app.logger.error(f"Subscription refresh failed for {key}: {e}")
+            raise
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _refresh_in_background(self, key, builder):
+        lock_file = open(self._lock_path(key), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()  # another thread or worker is already refreshing
+            return
+        entry = self.get(key)
+        if entry and entry[2] < self.ttl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            return
+
+        def run():
+            try:
+                self._refresh(key, builder, lock_file)
+            except Exception:
+                pass
+        threading.Thread(target=run, name=f'refresh-{key}', daemon=True).start()
+
+    def get_or_build(self, key, builder):
+        """Serve from cache, coalescing rebuilds; builder() returns (value, mimetype)"""
+        entry = self.get(key)
+        if entry:
+            value, mimetype, age = entry
+            if age < self.ttl:
+                self.stats['hits'] += 1
+            else:
+                self.stats['stale_hits'] += 1
+                self._refresh_in_background(key, builder)
+            return value, mimetype
+        self.stats['misses'] += 1
+        lock_file = open(self._lock_path(key), 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        entry = self.get(key)
+        if entry and entry[2] < self.ttl:
+            # Built by whoever held the lock while we waited
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            self.stats['coalesced'] += 1
+            return entry[0], entry[1]
+        return self._refresh(key, builder, lock_file)
+
+    def info(self):
+        count, total = self._db().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        lookups = self.stats['hits'] + self.stats['stale_hits'] + self.stats['misses']
+        return {
+            'entries': count,
+            'bytes': total,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'stale_ttl': self.stale_ttl,
+            'hit_ratio': round((self.stats['hits'] + self.stats['stale_hits']) / lookups, 4) if lookups else 0.0,
+            **self.stats
+        }
+
+
+subscription_cache = SubscriptionCache(
+    CACHE_DB, SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_STALE_TTL,
+    SUBSCRIPTION_CACHE_MAX_BYTES, SUBSCRIPTION_CACHE_MAX_ENTRIES
+)
+
+
+def get_node_api_url(node):
+    protocol = 'https' if node.get('https', True) else 'http'
+    return f"{protocol}://{node['domain']}/{get_hidden_path(CLUSTER_SECRET)}/api/v1"
+
+
+# ============================================================================
+# NODE CLIENT - one asyncio loop per worker drives every master->node call
+# ============================================================================
+class NodeResponse:
+    __slots__ = ('status', 'headers', 'body')
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+    def json(self):
+        return json.loads(self.body)
+
+    def text(self):
+        return self.body.decode(errors='replace')
+
+
+class _NodeConnection:
+    __slots__ = ('reader', 'writer', 'last_used')
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def usable(self, idle_timeout):
+        return (not self.writer.is_closing() and not self.reader.at_eof()
+                and time.monotonic() - self.last_used < idle_timeout)
+
+    def close(self):
+        self.writer.close()
+
+
+class NodeStream:
+    """Body of a streamed node response; read() returns b'' once it is exhausted"""
+    __slots__ = ('chunks', 'writer')
+
+    def __init__(self, chunks, writer):
+        self.chunks = chunks
+        self.writer = writer
+
+    async def read(self):
+        try:
+            return await self.chunks.__anext__()
+        except StopAsyncIteration:
+            self.close()
+            return b''
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self.writer.close()
+
+
+class NodeClient:
+    """HTTP/1.1 client on asyncio streams with keep-alive pools per node.
+
+    A single event loop thread per worker runs every node call, so thousands of
+    requests can be in flight without a thread each. Sync callers use call() and
+    fan_out(); coroutines running on the loop use request() directly. Pools are
+    bounded per node (max_per_node), idle connections are closed after
+    idle_timeout and the least recently used nodes are dropped beyond max_nodes.
+    """
+
+    MAX_BODY = 64 * 1024 * 1024
+
+    def __init__(self, max_per_node=4, max_nodes=256, idle_timeout=120, concurrency=512):
+        self.max_per_node = max_per_node
+        self.max_nodes = max_nodes
+        self.idle_timeout = idle_timeout
+        self.concurrency = concurrency
+        self.loop = None
+        self.start_lock = threading.Lock()
+        self.pools = OrderedDict()  # origin -> [idle connections]
+        self.slots = {}  # origin -> asyncio.Semaphore(max_per_node)
+        self.in_flight = {}  # origin -> requests holding or waiting for its slot
+        self.limit = None
+        self.stats = defaultdict(int)
+        self.ssl_context = None
+
+    # -- loop management ---------------------------------------------------
+    def _ensure_loop(self):
+        if self.loop is not None:
+            return self.loop
+        with self.start_lock:
+            if self.loop is None:
+                import certifi
+                self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+                loop = asyncio.new_event_loop()
+                self.limit = asyncio.Semaphore(self.concurrency)
+                threading.Thread(target=loop.run_forever, name='node-client', daemon=True).start()
+                asyncio.run_coroutine_threadsafe(self._reaper(), loop)
+                self.loop = loop
+        return self.loop
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the client loop from a sync caller"""
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        try:
+            return future.result(timeout)
+        except FuturesTimeout:
+            future.cancel()
+            raise
+
+    def submit(self, coro):
+        """Schedule a coroutine on the client loop without waiting for it"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 5))
+            for origin in list(self.pools):
+                idle = self.pools[origin]
+                keep = [c for c in idle if c.usable(self.idle_timeout)]
+                for conn in idle:
+                    if conn not in keep:
+                        conn.close()
+                        self.stats['evicted_connections'] += 1
+                self.pools[origin] = keep
+            # Least recently used first; a node with requests in flight keeps its slots
+            excess = len(self.pools) - self.max_nodes
+            for origin in [o for o in self.pools if o not in self.in_flight][:max(excess, 0)]:
+                for conn in self.pools.pop(origin):
+                    conn.close()
+                self.slots.pop(origin, None)
+                self.stats['evicted_nodes'] += 1
+
+    # -- connections ---------------------------------------------------------
+    async def _acquire(self, scheme, host, port, origin):
+        idle = self.pools.setdefault(origin, [])
+        self.pools.move_to_end(origin)
+        while idle:
+            conn = idle.pop()
+            if conn.usable(self.idle_timeout):
+                self.stats['reused_connections'] += 1
+                return conn, True
+            conn.close()
+        reader, writer = await self._connect(scheme, host, port)
+        self.stats['new_connections'] += 1
+        return _NodeConnection(reader, writer), False
+
+    async def _connect(self, scheme, host, port):
+        return await asyncio.open_connection(
+            host, port, ssl=self.ssl_context if scheme == 'https' else None,
+            server_hostname=host if scheme == 'https' else None, limit=2 ** 20
+        )
+
+    def _release(self, origin, conn):
+        idle = self.pools.setdefault(origin, [])
+        if len(idle) < self.max_per_node:
+            conn.last_used = time.monotonic()
+            idle.append(conn)
+        else:
+            conn.close()
+
+    @staticmethod
+    async def _read_head(reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        version, status = lines[0].split(' ', 2)[:2]
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                name = name.strip().lower()
+                headers[name] = f'{headers[name]}, {value.strip()}' if name in headers else value.strip()
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        return int(status), headers, keep_alive
+
+    async def _read_chunks(self, reader, headers, status, method):
+        """Yield body chunks; the generator finishing means the body was fully read"""
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            return
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass  # trailers
+                    return
+                yield await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining:
+                chunk = await reader.read(min(remaining, 65536))
+                if not chunk:
+                    raise ConnectionError('connection closed mid-body')
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while chunk := await reader.read(65536):
+                yield chunk
+
+    def _prepare(self, node, path, method, headers, body):
+        scheme = 'https' if node.get('https', True) else 'http'
+        url = urlsplit(f"{scheme}://{node['domain']}")
+        host, port = url.hostname, url.port or (443 if scheme == 'https' else 80)
+        request_headers = {
+            'Host': url.netloc,
+            'User-Agent': f'SUI-Master/{VERSION}',
+            'Accept-Encoding': 'identity',
+            'Connection': 'keep-alive',
+            **(headers or {})
+        }
+        if body is not None:
+            request_headers['Content-Length'] = str(len(body))
+        head = f'{method} {path} HTTP/1.1\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in request_headers.items())
+        return scheme, host, port, f'{scheme}://{url.netloc}', head.encode('latin-1') + b'\r\n' + (body or b'')
+
+    async def _exchange(self, scheme, host, port, origin, method, payload):
+        for attempt in range(2):
+            conn, reused = await self._acquire(scheme, host, port, origin)
+            try:
+                conn.writer.write(payload)
+                await conn.writer.drain()
+                status, response_headers, keep_alive = await self._read_head(conn.reader)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                conn.close()
+                # A reused keep-alive connection may have been closed by the
+                # server; retry once on a fresh one (never for non-GET calls)
+                if reused and attempt == 0 and method == 'GET':
+                    continue
+                raise ConnectionError(f'connection to {origin} failed: {e}') from e
+            except BaseException:
+                conn.close()
+                raise
+            return conn, status, response_headers, keep_alive
+
+    async def request(self, node, method, path, headers=None, body=None, timeout=30):
+        """One request, body fully read; returns NodeResponse.
+
+        The node's slot is held until the connection is back in the pool or
+        closed, so max_per_node bounds the connections open to a node.
+        """
+        self.stats['requests'] += 1
+        started = time.perf_counter()
+        scheme, host, port, origin, payload = self._prepare(node, path, method, headers, body)
+        slot = self.slots.setdefault(origin, asyncio.Semaphore(self.max_per_node))
+        self.in_flight[origin] = self.in_flight.get(origin, 0) + 1
+        try:
+            async with asyncio.timeout(timeout), self.limit, slot:
+                conn, status, response_headers, keep_alive = await self._exchange(
+                    scheme, host, port, origin, method, payload)
+                try:
+                    chunks, size = [], 0
+                    async for chunk in self._read_chunks(conn.reader, response_headers, status, method):
+                        size += len(chunk)
+                        if size > self.MAX_BODY:
+                            raise ValueError('response body too large')
+                        chunks.append(chunk)
+                except BaseException:
+                    conn.close()
+                    raise
+                if keep_alive:
+                    self._release(origin, conn)
+                else:
+                    conn.close()
+                metrics.observe('node_request_duration_seconds', (node['domain'],), time.perf_counter() - started)
+                if status >= 400:
+                    metrics.inc('node_request_errors_total', (node['domain'], f'http_{status}'))
+                return NodeResponse(status, response_headers, b''.join(chunks))
+        except TimeoutError:
+            self.stats['timeouts'] += 1
+            metrics.inc('node_request_errors_total', (node['domain'], 'timeout'))
+            raise TimeoutError(f'node did not answer within {timeout}s') from None
+        except Exception:
+            self.stats['errors'] += 1
+            metrics.inc('node_request_errors_total', (node['domain'], 'error'))
+            raise
+        finally:
+            self.in_flight[origin] -= 1
+            if not self.in_flight[origin]:
+                del self.in_flight[origin]
+
+    async def call(self, node, endpoint, method='GET', data=None, timeout=30, headers=None):
+        """Node API call returning the decoded JSON body or {'error': ...}"""
+        path = urlsplit(get_node_api_url(node)).path + '/' + endpoint
+        headers = {'X-SUI-Token': CLUSTER_SECRET, **(headers or {})}
+        body = None
+        if method != 'GET':
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+        try:
+            resp = await self.request(node, method, path, headers, body, timeout)
+            if resp.status == 304:
+                return {'not_modified': True}
+            return resp.json() if resp.ok else {'error': resp.text()}
+        except Exception as e:
+            return {'error': str(e) or type(e).__name__}
+
+    async def open_stream(self, node, method, path, headers=None, timeout=30):
+        """Start a request whose body is consumed incrementally.
+
+        Returns (status, headers, NodeStream). Streams use a dedicated connection
+        outside the pools and per-node slots, so a long log tail never holds up
+        regular calls to the same node.
+        """
+        scheme, host, port, origin, payload = self._prepare(
+            node, path, method, {**(headers or {}), 'Connection': 'close'}, None)
+        self.stats['streams'] += 1
+        writer = None
+        try:
+            async with asyncio.timeout(timeout):
+                reader, writer = await self._connect(scheme, host, port)
+                writer.write(payload)
+                await writer.drain()
+                status, response_headers, _ = await self._read_head(reader)
+        except BaseException as e:
+            if writer is not None:
+                writer.close()
+            self.stats['errors'] += 1
+            if isinstance(e, TimeoutError):
+                raise TimeoutError(f'node did not answer within {timeout}s') from None
+            raise
+        return status, response_headers, NodeStream(self._read_chunks(reader, response_headers, status, method), writer)
+
+    # -- fan-out ---------------------------------------------------------------
+    async def gather(self, calls, concurrency=None, deadline=None):
+        """Await {key: coroutine} with bounded concurrency and one overall deadline.
+
+        Returns (results, timed_out): calls still running at the deadline are
+        cancelled and listed; everything that finished is kept.
+        """
+        if not calls:
+            return {}, []
+        gate = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def bounded(coro):
+            try:
+                async with gate:
+                    return await coro
+            finally:
+                coro.close()  # no-op once awaited; closes calls cancelled while still queued on the gate
+
+        tasks = {asyncio.ensure_future(bounded(coro)): key for key, coro in calls.items()}
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        results = {}
+        for task in done:
+            exc = task.exception()
+            results[tasks[task]] = {'error': str(exc) or type(exc).__name__} if exc else task.result()
+        return results, [tasks[task] for task in pending]
+
+    def fan_out(self, nodes, fn, concurrency=None, deadline=None):
+        """Sync entry point: run async fn(node_id, node) for every node"""
+        if not nodes:
+            return {}, []
+        return self.run(self.gather({node_id: fn(node_id, node) for node_id, node in nodes.items()},
+                                    concurrency, deadline))
+
+    def pool_stats(self):
+        new, reused = self.stats['new_connections'], self.stats['reused_connections']
+        used = new + reused
+        return {
+            'nodes': len(self.pools),
+            'idle_connections': sum(len(idle) for idle in self.pools.values()),
+            'requests': self.stats['requests'],
+            'errors': self.stats['errors'],
+            'timeouts': self.stats['timeouts'],
+            'streams': self.stats['streams'],
+            'new_connections': new,
+            'reused_connections': reused,
+            'reuse_rate': round(reused / used, 4) if used else 0.0,
+            'handshake_rate': round(new / used, 4) if used else 0.0,
+            'evicted_connections': self.stats['evicted_connections'],
+            'evicted_nodes': self.stats['evicted_nodes'],
+            'pool_maxsize': self.max_per_node,
+            'max_nodes': self.max_nodes,
+            'idle_timeout': self.idle_timeout,
+            'concurrency': self.concurrency
+        }
+
+
+node_client = NodeClient(NODE_POOL_MAXSIZE, NODE_POOL_MAX_NODES, NODE_POOL_IDLE_TIMEOUT, NODE_FANOUT_CONCURRENCY)
+
+
+def call_node_api(node, endpoint, method='GET', data=None, timeout=30, headers=None):
+    try:
+        return node_client.run(node_client.call(node, endpoint, method, data, timeout, headers), timeout + 5)
+    except Exception as e:
+        return {'error': str(e) or type(e).__name__}
+
+
+class NodeStreamRelay:
+    """Sync iterator over a NodeStream, closable from any thread.
+
+    A chunk is pulled from the node only after the previous one was handed on,
+    so a slow consumer slows reads from the node instead of queueing data here.
+    """
+
+    def __init__(self, stream, idle_timeout):
+        self.stream = stream
+        self.idle_timeout = idle_timeout
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stream is None:
+            raise StopIteration
+        try:
+            chunk = node_client.run(self.stream.read(), self.idle_timeout)
+        except BaseException:
+            self.close()
+            raise
+        if not chunk:
+            self.close()
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        if self.stream is not None:
+            node_client.loop.call_soon_threadsafe(self.stream.close)
+            self.stream = None
+
+
+def stream_node_api(node, endpoint, idle_timeout=LOG_STREAM_IDLE_TIMEOUT, headers=None):
+    """Open a streamed node API call; returns (status, headers, NodeStreamRelay)"""
+    path = urlsplit(get_node_api_url(node)).path + '/' + endpoint
+    headers = {'X-SUI-Token': CLUSTER_SECRET, **(headers or {})}
+    status, response_headers, stream = node_client.run(
+        node_client.open_stream(node, 'GET', path, headers, idle_timeout), idle_timeout + 5)
+    return status, response_headers, NodeStreamRelay(stream, idle_timeout)
+
+
+def fan_out_nodes(nodes, fn, max_workers=None, deadline=None):
+    """Run async fn(node_id, node) for many nodes on the node client loop.
+
+    Returns (results, timed_out): results collected before the deadline are kept,
+    nodes that did not answer in time are listed instead of failing the whole call.
+    """
+    return node_client.fan_out(nodes, fn, max_workers, deadline)
+
+
+# ============================================================================
+# NODE HEALTH - background poller with in-memory status table
+# ============================================================================
+class NodeHealthTable:
+    """In-memory node status, flushed to the node registry with write-behind batching.
+
+    Only changed entries are written, in one transaction per flush; other workers
+    see them through the registry's change counter.
+    """
+
+    HEALTH_FIELDS = ('status', 'last_check', 'last_seen', 'latency_ms', 'uptime', 'failures', 'error',
+                     'services', 'services_changed')
+
+    def __init__(self):
+        self.table = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def record(self, node_id, result, latency):
+        with self.lock:
+            entry = dict(self.table.get(node_id, {}))
+            entry['last_check'] = datetime.now().isoformat()
+            entry['latency_ms'] = round(latency * 1000, 1)
+            if 'error' in result:
+                entry['status'] = 'offline'
+                entry['error'] = result['error'][:200]
+                entry['failures'] = entry.get('failures', 0) + 1
+            else:
+                entry['status'] = 'online'
+                entry['uptime'] = result.get('uptime', '')
+                entry['last_seen'] = entry['last_check']
+                entry['failures'] = 0
+                entry['error'] = None
+            self.table[node_id] = entry
+            self.dirty.add(node_id)
+            return entry
+
+    def forget(self, node_id):
+        with self.lock:
+            self.table.pop(node_id, None)
+            self.dirty.discard(node_id)
+
+    def overlay(self, nodes):
+        """Apply entries not flushed yet on top of registry data"""
+        with self.lock:
+            for node_id in self.dirty:
+                if node_id in nodes:
+                    nodes[node_id].update(self.table[node_id])
+        return nodes
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            updates = {node_id: self.table[node_id] for node_id in self.dirty}
+            self.dirty = set()
+        try:
+            node_registry.update_many(updates)
+        except Exception:
+            with self.lock:
+                self.dirty.update(k for k in updates if k in self.table)
+            raise
+
+
+node_health = NodeHealthTable()
+
+
+async def poll_node_health(node_id, node, timeout=HEALTH_POLL_TIMEOUT):
+    started = time.monotonic()
+    result = await node_client.call(node, 'status', timeout=timeout)
+    return result, node_health.record(node_id, result, time.monotonic() - started)
+
+
+def check_node_health(node_id, node, timeout=HEALTH_POLL_TIMEOUT):
+    return node_client.run(poll_node_health(node_id, node, timeout), timeout + 5)
+
+
+def load_nodes_with_health():
+    """Registered nodes with the latest polled status (no network calls)"""
+    return node_health.overlay(load_nodes())
+
+
+class NodeHealthPoller:
+    """Polls every node on a jittered interval; one worker polls, all of them flush"""
+
+    def __init__(self, interval, jitter, concurrency, flush_interval):
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.flush_interval = flush_interval
+        self.leader = LeaderLock(os.path.join(DATA_DIR, 'health-poller.lock'))
+        self.next_poll = 0
+        self.last_cycle = {}
+
+    def poll_once(self):
+        nodes = load_nodes()
+        started = time.monotonic()
+        results, timed_out = fan_out_nodes(
+            nodes, poll_node_sample, self.concurrency,
+            deadline=HEALTH_POLL_TIMEOUT * (len(nodes) // max(self.concurrency, 1) + 2)
+        )
+        for node_id in timed_out:
+            node_health.record(node_id, {'error': 'health check timed out'}, HEALTH_POLL_TIMEOUT)
+        try:
+            record_fleet_samples(results, timed_out, time.time())
+        except OSError as e:
+            app.logger.error(f'Fleet history write failed: {e}')
+        self.last_cycle = {
+            'nodes': len(nodes),
+            'timed_out': len(timed_out),
+            'duration_ms': round((time.monotonic() - started) * 1000, 1),
+            'finished_at': datetime.now().isoformat()
+        }
+
+    def run(self):
+        while True:
+            now = time.monotonic()
+            try:
+                if now >= self.next_poll and self.leader.acquire():
+                    self.poll_once()
+                    spread = self.interval * self.jitter
+                    self.next_poll = time.monotonic() + self.interval + random.uniform(-spread, spread)
+                node_health.flush()
+            except Exception as e:
+                app.logger.error(f"Health poller error: {e}")
+            time.sleep(min(self.flush_interval, max(self.interval, 1)))
+
+
+health_poller = NodeHealthPoller(HEALTH_POLL_INTERVAL, HEALTH_POLL_JITTER, HEALTH_POLL_CONCURRENCY, HEALTH_FLUSH_INTERVAL)
+_background_lock = threading.Lock()
+_background_started = False
+
+
+@app.before_request
+def start_background_tasks():
+    """Start per-worker background threads on the first request"""
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+        if HEALTH_POLL_INTERVAL > 0:
+            threading.Thread(target=health_poller.run, name='health-poller', daemon=True).start()
+        threading.Thread(target=metrics.run, args=(METRICS_FLUSH_INTERVAL,), name='metrics', daemon=True).start()
+
+
+# ============================================================================
+# FLEET TIME SERIES - per-node health and traffic history in fixed ring files
+# ============================================================================
+class FleetSeriesStore:
+    """Per-node history of availability, RTT, bytes and connections.
+
+    Every node has one file under TSDB_DIR holding a fixed ring per resolution
+    (RESOLUTIONS), so disk use is constant per node and retention is the ring
+    length. A bucket sits at slot (ts // step) % capacity and stores its own
+    start, which tells a current bucket from one left over from an earlier lap;
+    each sample updates the matching bucket of every resolution, which is the
+    downsampling. Range queries read only the slots of the requested window.
+    Only the health poller leader writes; readers take a shared flock.
+    """
+
+    RESOLUTIONS = (('1m', 60, 1440), ('15m', 900, 672), ('1h', 3600, 2160), ('1d', 86400, 730))
+    # start, samples, online, rtt sum, rtt max, traffic samples, bytes up, bytes down, conn max, conn sum
+    RECORD = struct.Struct('<dIIdfIddfd')
+    COLUMNS = ['start', 'availability', 'rtt_avg_ms', 'rtt_max_ms', 'bytes_up', 'bytes_down', 'conn_max', 'conn_avg']
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.offsets = {}
+        offset = 0
+        for name, step, cap in self.RESOLUTIONS:
+            self.offsets[name] = (offset, step, cap)
+            offset += cap * self.RECORD.size
+        self.file_size = offset
+        self.traffic_synced = {}  # node_id -> start of the newest agent minute ingested
+        self.traffic_checked = {}  # node_id -> when the agent stats were last requested
+
+    def _path(self, node_id):
+        return os.path.join(self.directory, f'{node_id}.ring')
+
+    def _open(self, node_id, create):
+        path = self._path(node_id)
+        if not create and not os.path.exists(path):
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size != self.file_size:
+            os.ftruncate(fd, self.file_size)
+        return fd
+
+    def _update(self, fd, ts, apply):
+        """Read-modify-write the bucket containing ts in every resolution"""
+        for offset, step, cap in self.offsets.values():
+            start = ts - ts % step
+            position = offset + (int(ts // step) % cap) * self.RECORD.size
+            record = list(self.RECORD.unpack(os.pread(fd, self.RECORD.size, position)))
+            if record[0] != start:
+                record = [start, 0, 0, 0.0, 0.0, 0, 0.0, 0.0, 0.0, 0.0]
+            apply(record)
+            os.pwrite(fd, self.RECORD.pack(*record), position)
+
+    def record(self, node_id, ts, online, rtt_ms, traffic=()):
+        """One health sample plus completed agent traffic minutes [[start, up, down, conn_max, conn_avg], ...]"""
+        def health(record):
+            record[1] += 1
+            record[2] += 1 if online else 0
+            if online:
+                record[3] += rtt_ms
+                record[4] = max(record[4], rtt_ms)
+
+        fd = self._open(node_id, create=True)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._update(fd, ts, health)
+            for start, up, down, conn_max, conn_avg in traffic:
+                def add_traffic(record, up=up, down=down, conn_max=conn_max, conn_avg=conn_avg):
+                    record[5] += 1
+                    record[6] += up
+                    record[7] += down
+                    record[8] = max(record[8], conn_max)
+                    record[9] += conn_avg
+                self._update(fd, start, add_traffic)
+        finally:
+            os.close(fd)
+
+    def _read(self, fd, resolution, since, until):
+        offset, step, cap = self.offsets[resolution]
+        first = int(max(since, until - (cap - 1) * step) // step)
+        last = int(until // step)
+        records = []
+        # The window maps to at most two contiguous runs of slots
+        index = first
+        while index <= last:
+            slot = index % cap
+            count = min(last - index + 1, cap - slot)
+            data = os.pread(fd, count * self.RECORD.size, offset + slot * self.RECORD.size)
+            for i, record in enumerate(self.RECORD.iter_unpack(data)):
+                if record[0] == (index + i) * step and record[1] + record[5]:
+                    records.append(record)
+            index += count
+        return records
+
+    @staticmethod
+    def _point(record):
+        start, samples, online, rtt_sum, rtt_max, traffic, up, down, conn_max, conn_sum = record
+        return [
+            int(start),
+            round(online / samples, 4) if samples else None,
+            round(rtt_sum / online, 1) if online else None,
+            round(rtt_max, 1) if online else None,
+            int(up), int(down), int(conn_max),
+            round(conn_sum / traffic, 2) if traffic else 0
+        ]
+
+    def pick_resolution(self, since, until, max_points=1500):
+        """Finest resolution that still covers since and stays under max_points"""
+        now = time.time()
+        for name, step, cap in self.RESOLUTIONS:
+            if now - since <= cap * step and (until - since) / step <= max_points:
+                return name
+        return self.RESOLUTIONS[-1][0]
+
+    def query(self, node_id, resolution, since, until):
+        fd = self._open(node_id, create=False)
+        if fd is None:
+            return []
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            return [self._point(record) for record in self._read(fd, resolution, since, until)]
+        finally:
+            os.close(fd)
+
+    def query_fleet(self, node_ids, resolution, since, until):
+        """Per-bucket fleet totals: availability and RTT averaged over nodes, bytes and connections summed"""
+        buckets = {}
+        for node_id in node_ids:
+            fd = self._open(node_id, create=False)
+            if fd is None:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                for record in self._read(fd, resolution, since, until):
+                    total = buckets.setdefault(record[0], [record[0], 0, 0, 0.0, 0.0, 0, 0.0, 0.0, 0.0, 0.0])
+                    for i in (1, 2, 3, 6, 7):
+                        total[i] += record[i]
+                    total[4] = max(total[4], record[4])
+                    if record[5]:
+                        # Fleet connections: sum of per-node peaks (an upper bound) and of per-node averages
+                        total[5] = 1
+                        total[8] += record[8]
+                        total[9] += record[9] / record[5]
+            finally:
+                os.close(fd)
+        return [self._point(record) for _, record in sorted(buckets.items())]
+
+    def traffic_since(self, node_id):
+        """Start of the newest agent minute already ingested for node_id (looked up once per process)"""
+        if node_id not in self.traffic_synced:
+            newest = 0
+            fd = self._open(node_id, create=False)
+            if fd is not None:
+                try:
+                    now = time.time()
+                    records = self._read(fd, '1m', now - 86400, now)
+                    newest = max((r[0] for r in records if r[5]), default=0)
+                finally:
+                    os.close(fd)
+            self.traffic_synced[node_id] = newest
+        return self.traffic_synced[node_id]
+
+    def forget(self, node_id):
+        self.traffic_synced.pop(node_id, None)
+        self.traffic_checked.pop(node_id, None)
+        try:
+            os.unlink(self._path(node_id))
+        except FileNotFoundError:
+            pass
+
+
+fleet_series = FleetSeriesStore(TSDB_DIR)
+
+
+async def poll_node_sample(node_id, node):
+    """Health check plus the agent's completed traffic minutes since the last ingest"""
+    result, entry = await poll_node_health(node_id, node)
+    traffic = []
+    if 'error' not in result:
+        since = fleet_series.traffic_since(node_id)
+        now = time.time()
+        if now - since >= 120 and now - fleet_series.traffic_checked.get(node_id, 0) >= 60:
+            fleet_series.traffic_checked[node_id] = now
+            start = since + 1 if since else now - 86400
+            stats = await node_client.call(node, f'stats?series=total&resolution=1m&since={start:.0f}',
+                                           timeout=HEALTH_POLL_TIMEOUT)
+            # The current minute is still filling up; take it on a later poll
+            current = time.time() // 60 * 60
+            traffic = [row for row in (stats.get('series') or {}).get('total', []) if since < row[0] < current]
+    return result, entry, traffic
+
+
+def record_fleet_samples(results, timed_out, ts):
+    for node_id, value in results.items():
+        if isinstance(value, dict):
+            continue  # the poll itself failed
+        result, entry, traffic = value
+        fleet_series.record(node_id, ts, 'error' not in result, entry.get('latency_ms') or 0, traffic)
+        if traffic:
+            fleet_series.traffic_synced[node_id] = max(row[0] for row in traffic)
+    for node_id in timed_out:
+        fleet_series.record(node_id, ts, False, 0)
+
+
+# ============================================================================
+# JOBS - long-running fleet operations, progress visible to every worker
+# ============================================================================
+class JobStore:
+    """Progress documents of background jobs (rollouts), kept in jobs.db"""
+
+    STALE_AFTER = 60  # a running job that has not written progress for this long is dead
+    HEARTBEAT = 10  # runners touch their job this often, so long steps do not look dead
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = connect_sqlite(self.path)
+            db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                       'id TEXT PRIMARY KEY, kind TEXT NOT NULL, state TEXT NOT NULL, '
+                       'created REAL NOT NULL, updated REAL NOT NULL, data TEXT NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS jobs_kind ON jobs(kind, created)')
+        return db
+
+    def create(self, kind, data, exclusive=False):
+        """New job id; with exclusive, None while another job of this kind is active.
+
+        The check and the insert are one statement, so of two workers claiming
+        the same kind at once only one gets a job.
+        """
+        job_id = hashlib.sha1(f'{kind}:{time.time()}:{random.random()}'.encode()).hexdigest()[:12]
+        now = time.time()
+        cursor = self._db().execute(
+            'INSERT INTO jobs (id, kind, state, created, updated, data) SELECT ?, ?, ?, ?, ?, ? '
+            "WHERE NOT ? OR NOT EXISTS (SELECT 1 FROM jobs WHERE kind = ? AND state IN ('running', 'aborting') "
+            'AND updated >= ?)',
+            (job_id, kind, data['state'], now, now, json.dumps(data), exclusive, kind, now - self.STALE_AFTER))
+        return job_id if cursor.rowcount else None
+
+    def save(self, job_id, data):
+        # A progress write from the runner must not undo an abort requested in between
+        self._db().execute("UPDATE jobs SET state = CASE WHEN state = 'aborting' AND ? = 'running' THEN state "
+                           "ELSE ? END, updated = ?, data = ? WHERE id = ?",
+                           (data['state'], data['state'], time.time(), json.dumps(data), job_id))
+
+    def touch(self, job_id):
+        self._db().execute('UPDATE jobs SET updated = ? WHERE id = ?', (time.time(), job_id))
+
+    async def heartbeat(self, job_id):
+        """Run alongside a job until cancelled; steps may take longer than STALE_AFTER between progress writes"""
+        while True:
+            await asyncio.sleep(self.HEARTBEAT)
+            await asyncio.to_thread(self.touch, job_id)
+
+    def _decode(self, row):
+        job_id, state, updated, data = row
+        data = json.loads(data)
+        data['state'] = state  # the column also carries abort requests
+        if state in ('running', 'aborting') and time.time() - updated > self.STALE_AFTER:
+            data['state'] = 'lost'
+            data['error'] = data.get('error') or 'the worker running this job went away'
+        return {'id': job_id, **data}
+
+    def get(self, job_id):
+        row = self._db().execute('SELECT id, state, updated, data FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._decode(row) if row else None
+
+    def state(self, job_id):
+        row = self._db().execute('SELECT state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def request_abort(self, job_id):
+        return self._db().execute("UPDATE jobs SET state = 'aborting' WHERE id = ? AND state = 'running'",
+                                  (job_id,)).rowcount > 0
+
+    def recent(self, kind, limit=10):
+        rows = self._db().execute('SELECT id, state, updated, data FROM jobs WHERE kind = ? '
+                                  'ORDER BY created DESC LIMIT ?', (kind, limit)).fetchall()
+        return [self._decode(row) for row in rows]
+
+    def active(self, kind):
+        return [job for job in self.recent(kind) if job['state'] in ('running', 'aborting')]
+
+
+job_store = JobStore(JOBS_DB)
+
+
+class RollingUpdate:
+    """Update nodes in a sliding window: canary batch first, each node gated on health.
+
+    The rollout aborts once the failure ratio among finished nodes exceeds
+    max_failure_ratio (any canary failure aborts immediately); nodes not started
+    by then are marked skipped.
+    """
+
+    def __init__(self, nodes, parallelism=5, canary=1, max_failure_ratio=0.2,
+                 update_timeout=120, health_timeout=180):
+        self.nodes = nodes
+        self.parallelism = max(1, parallelism)
+        self.canary = max(0, min(canary, len(nodes)))
+        self.max_failure_ratio = max_failure_ratio
+        self.update_timeout = update_timeout
+        self.health_timeout = health_timeout
+        self.lock = threading.Lock()
+        self.job_id = None
+        self.progress = {
+            'state': 'running',
+            'phase': 'canary' if self.canary else 'rolling',
+            'started_at': datetime.now().isoformat(),
+            'finished_at': None,
+            'settings': {'parallelism': self.parallelism, 'canary': self.canary,
+                         'max_failure_ratio': max_failure_ratio, 'health_timeout': health_timeout},
+            'nodes': {node_id: {'name': node['name'], 'state': 'pending'} for node_id, node in nodes.items()},
+            'counts': {'total': len(nodes), 'done': 0, 'failed': 0, 'skipped': 0},
+            'error': None
+        }
+
+    def start(self):
+        """Job id of the started rollout, or None while another rollout is running"""
+        self.job_id = job_store.create('rollout', self.progress, exclusive=True)
+        if self.job_id:
+            node_client.submit(self.run())
+        return self.job_id
+
+    def _set(self, node_id=None, **fields):
+        with self.lock:
+            if node_id:
+                self.progress['nodes'][node_id].update(fields)
+            else:
+                self.progress.update(fields)
+            states = [n['state'] for n in self.progress['nodes'].values()]
+            for key in ('done', 'failed', 'skipped'):
+                self.progress['counts'][key] = states.count(key)
+            job_store.save(self.job_id, self.progress)
+
+    async def _update(self, node_id=None, **fields):
+        # Progress writes hit SQLite; keep them off the event loop
+        await asyncio.to_thread(self._set, node_id, **fields)
+
+    async def _wait_healthy(self, node_id, node):
+        deadline = time.monotonic() + self.health_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(5)
+            result, _ = await poll_node_health(node_id, node, timeout=10)
+            if 'error' in result:
+                continue
+            services = (await node_client.call(node, 'services', timeout=10)).get('services', {})
+            if services.get('singbox') == 'running':
+                return True
+        return False
+
+    async def update_node(self, node_id):
+        node = self.nodes[node_id]
+        started = time.monotonic()
+        await self._update(node_id, state='updating', started_at=datetime.now().isoformat())
+        result = await node_client.call(node, 'update', 'POST', timeout=self.update_timeout)
+        # The agent restarts itself while updating, so a dropped connection is
+        # expected; only an explicit failure report fails the node right away.
+        if result.get('success') is False:
+            ok, error = False, (result.get('error') or result.get('output', ''))[-500:]
+        else:
+            await self._update(node_id, state='waiting_health')
+            ok = await self._wait_healthy(node_id, node)
+            error = None if ok else f'not healthy within {self.health_timeout}s'
+        await self._update(node_id, state='done' if ok else 'failed', error=error,
+                  finished_at=datetime.now().isoformat(), ms=round((time.monotonic() - started) * 1000))
+        return ok
+
+    def _should_abort(self):
+        if job_store.state(self.job_id) == 'aborting':
+            return 'aborted by user'
+        counts = self.progress['counts']
+        finished = counts['done'] + counts['failed']
+        if self.progress['phase'] == 'canary' and counts['failed']:
+            return 'canary failed'
+        if finished and counts['failed'] / finished > self.max_failure_ratio:
+            return f"failure ratio {counts['failed']}/{finished} above {self.max_failure_ratio}"
+        return None
+
+    async def run(self):
+        order = list(self.nodes)
+        reason = None
+        heartbeat = asyncio.ensure_future(job_store.heartbeat(self.job_id))
+        try:
+            if self.canary:
+                await asyncio.gather(*(self.update_node(node_id) for node_id in order[:self.canary]))
+                reason = await asyncio.to_thread(self._should_abort)
+                await self._update(phase='rolling')
+            waiting, running = order[self.canary:], set()
+            while not reason and (waiting or running):
+                while waiting and len(running) < self.parallelism:
+                    running.add(asyncio.ensure_future(self.update_node(waiting.pop(0))))
+                _, running = await asyncio.wait(running, timeout=5, return_when=asyncio.FIRST_COMPLETED)
+                reason = await asyncio.to_thread(self._should_abort)
+            if reason:
+                if running:
+                    await asyncio.wait(running)  # let in-flight nodes finish and report
+                for node_id in waiting:
+                    await self._update(node_id, state='skipped')
+        except Exception as e:
+            reason = f'rollout crashed: {e}'
+        finally:
+            heartbeat.cancel()
+        await self._update(state='aborted' if reason else 'completed', error=reason,
+                           finished_at=datetime.now().isoformat())
+
+
+def check_for_updates():
+    """Check GitHub for latest version"""
+    try:
+        resp = requests.get(f"{GITHUB_RAW}/master/app.py", timeout=10)
+        if resp.ok:
+            match = re.search(r'VERSION\s*=\s*["\']([^"\']+)["\']', resp.text)
+            if match:
+                return {'current': VERSION, 'latest': match.group(1), 'update_available': match.group(1) != VERSION}
+    except Exception:
+        pass
+    return {'current': VERSION, 'latest': VERSION, 'update_available': False}
+
+
+@app.route('/')
+@rate_limit(api_limiter)
+def index():
+    settings = load_settings()
+    return render_template('index.html', nodes=load_nodes_with_health(), settings=settings, version=VERSION)
+
+
+@app.route('/api/nodes', methods=['GET'])
+@rate_limit(api_limiter)
+def list_nodes():
+    return jsonify(load_nodes_with_health())
+
+
+@app.route('/api/nodes/health')
+@rate_limit(api_limiter)
+def nodes_health():
+    """Polled status of every node, served from memory"""
+    health = {
+        node_id: {k: node.get(k) for k in NodeHealthTable.HEALTH_FIELDS}
+        for node_id, node in load_nodes_with_health().items()
+    }
+    return jsonify({'nodes': health, 'poller': {
+        'interval': HEALTH_POLL_INTERVAL,
+        'leader': health_poller.leader.lock_file is not None,
+        'last_cycle': health_poller.last_cycle
+    }})
+
+
+NODE_EVENT_ACTIONS = {'create', 'start', 'restart', 'unpause', 'pause', 'die', 'stop', 'destroy', 'oom', 'sync',
+                      'health_status: healthy', 'health_status: unhealthy', 'health_status: starting'}
+
+
+@app.route('/api/nodes/events', methods=['POST'])
+@rate_limit(event_limiter)
+def node_events():
+    """Container state changes pushed by a node agent (authenticated with the cluster secret)"""
+    if not CLUSTER_SECRET or not hmac.compare_digest(request.headers.get('X-SUI-Token', ''), CLUSTER_SECRET):
+        auth_limiter.is_allowed(get_client_ip())
+        return jsonify({'error': 'Unauthorized'}), 401
+    data = request.get_json(silent=True) or {}
+    found = node_registry.find_by_domain(str(data.get('domain', '')))
+    if not found:
+        return jsonify({'error': 'Node not found'}), 404
+    node_id, node = found
+    try:
+        changed = float(data.get('changed') or 0)
+        if not 0 <= changed < float('inf'):
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({'error': 'changed must be a unix timestamp'}), 400
+    events = [e for e in data.get('events') or [] if isinstance(e, dict) and e.get('action') in NODE_EVENT_ACTIONS]
+    for event in events:
+        metrics.inc('node_container_events_total', (event['action'],))
+        if event['action'] == 'oom' or (event['action'] == 'die' and event.get('exit_code')):
+            app.logger.warning(f"Node {node.get('name', node_id)}: {event.get('service')} {event['action']} "
+                               f"(exit code {event.get('exit_code')})")
+    fields = {'recent_events': ((node.get('recent_events') or []) + events)[-NODE_RECENT_EVENTS:]}
+    # Batches can arrive out of order after retries; only a newer table replaces the stored one
+    if isinstance(data.get('services'), dict) and changed >= (node.get('services_changed') or 0):
+        fields.update(services=data['services'], services_changed=changed)
+    node_registry.update(node_id, **fields)
+    return jsonify({'success': True, 'accepted': len(events)})
+
+
+@app.route('/api/nodes/usage', methods=['POST'])
+@rate_limit(event_limiter)
+def node_usage():
+    """Per-user byte deltas shipped by a node agent: {domain, boot, seq, usage: {user_id: [up, down]}}"""
+    if not CLUSTER_SECRET or not hmac.compare_digest(request.headers.get('X-SUI-Token', ''), CLUSTER_SECRET):
+        auth_limiter.is_allowed(get_client_ip())
+        return jsonify({'error': 'Unauthorized'}), 401
+    data = request.get_json(silent=True) or {}
+    found = node_registry.find_by_domain(str(data.get('domain', '')))
+    if not found:
+        return jsonify({'error': 'Node not found'}), 404
+    usage = data.get('usage')
+    if not isinstance(usage, dict) or not isinstance(data.get('seq'), int):
+        return jsonify({'error': 'usage and seq are required'}), 400
+    if not user_registry.claim_batch(found[0], str(data.get('boot', '')), data['seq']):
+        metrics.inc('usage_batches_total', ('duplicate',))
+        return jsonify({'success': True, 'duplicate': True})
+    valid = {user_id: counters for user_id, counters in usage.items()
+             if USER_ID_PATTERN.match(user_id) and isinstance(counters, list) and len(counters) == 2
+             and all(isinstance(n, int) and 0 <= n < 1 << 50 for n in counters)}
+    usage_ingest.add(valid)
+    metrics.inc('usage_batches_total', ('accepted',))
+    return jsonify({'success': True, 'accepted': len(valid), 'rejected': len(usage) - len(valid)})
+
+
+@app.route('/api/nodes', methods=['POST'])
+@rate_limit(api_limiter)
+def add_node():
+    data = request.json or {}
+    try:
+        name = sanitize_name(data.get('name'))
+        domain = sanitize_domain(data.get('domain'))
+        if not name or not domain:
+            return jsonify({'error': 'Missing name or domain'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    node_id = hashlib.md5(domain.encode()).hexdigest()[:8]
+    node = {
+        'name': name,
+        'domain': domain,
+        'https': data.get('https', True),
+        'added_at': datetime.now().isoformat(),
+        'status': 'unknown'
+    }
+    node_registry.add(node_id, node)
+    if user_registry.count():
+        user_sync.schedule()  # give the new node the current users
+    return jsonify({'id': node_id, 'node': node})
+
+
+@app.route('/api/nodes/<node_id>', methods=['DELETE'])
+@rate_limit(api_limiter)
+def delete_node(node_id):
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node_health.forget(node_id)
+    fleet_series.forget(node_id)
+    config_bases.forget(node_id)
+    if node_registry.delete(node_id):
+        return jsonify({'success': True})
+    return jsonify({'error': 'Node not found'}), 404
+
+
+@app.route('/api/nodes/<node_id>/status')
+@rate_limit(api_limiter)
+def node_status(node_id):
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    result, _ = check_node_health(node_id, node, timeout=30)
+    return jsonify(result)
+
+
+def select_nodes():
+    """Nodes named by ?nodes=a,b or a JSON body {"nodes": [...]}; "all" or nothing means every node"""
+    data = request.get_json(silent=True) or {}
+    selection = data.get('nodes', request.args.get('nodes', 'all'))
+    nodes = load_nodes()
+    if selection == 'all':
+        return nodes, []
+    if isinstance(selection, str):
+        selection = [s for s in selection.split(',') if s]
+    if not isinstance(selection, list):
+        raise ValueError('nodes must be "all" or a list of node IDs')
+    invalid = [node_id for node_id in selection if not isinstance(node_id, str) or not NODE_ID_PATTERN.match(node_id)]
+    if invalid:
+        raise ValueError(f'Invalid node ID: {invalid[0]}')
+    return {node_id: nodes[node_id] for node_id in selection if node_id in nodes}, [n for n in selection if n not in nodes]
+
+
+def batch_node_call(call):
+    """Fan call(node_id, node) out over the selected nodes under one deadline"""
+    try:
+        nodes, missing = select_nodes()
+        deadline = min(float(request.args.get('deadline', BATCH_DEADLINE)), BATCH_DEADLINE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    async def timed(node_id, node):
+        started = time.monotonic()
+        result = await call(node_id, node, deadline)
+        return {'ok': 'error' not in result, 'ms': round((time.monotonic() - started) * 1000, 1), 'result': result}
+
+    started = time.monotonic()
+    results, timed_out = fan_out_nodes(nodes, timed, BATCH_CONCURRENCY, deadline)
+    return jsonify({
+        'nodes': results,
+        'timed_out': timed_out,
+        'missing': missing,
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+        'complete': not timed_out
+    })
+
+
+@app.route('/api/nodes/batch/status', methods=['GET', 'POST'])
+@rate_limit(api_limiter)
+def batch_status():
+    """Status of many nodes in one call (partial results when some nodes are slow)"""
+    async def status(node_id, node, deadline):
+        return (await poll_node_health(node_id, node, timeout=deadline))[0]
+    return batch_node_call(status)
+
+
+@app.route('/api/nodes/batch/services', methods=['GET', 'POST'])
+@rate_limit(api_limiter)
+def batch_services():
+    """Container status of many nodes in one call"""
+    return batch_node_call(lambda node_id, node, deadline: node_client.call(node, 'services', timeout=deadline))
+
+
+LOG_SEARCH_FILTERS = ('since', 'until', 'level', 'q', 'regex', 'client', 'destination')
+
+
+@app.route('/api/logs/search', methods=['GET', 'POST'])
+@rate_limit(api_limiter)
+def log_search():
+    """Run one log query on many nodes and stream a single timestamp-ordered NDJSON result.
+
+    A "node" line is written as each node answers. Once every node has answered
+    or the deadline passed, the per-node lists (already sorted by the agents)
+    are k-way merged with a heap and streamed as "record" lines, followed by a
+    "summary" line listing nodes that timed out.
+    """
+    try:
+        service = sanitize_service(request.args.get('service', 'singbox'))
+        nodes, missing = select_nodes()
+        deadline = min(float(request.args.get('deadline', BATCH_DEADLINE)), BATCH_DEADLINE)
+        per_node = min(max(int(request.args.get('limit', '200')), 1), 5000)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    newest_first = request.args.get('order', 'desc') != 'asc'
+    params = {name: request.args[name] for name in LOG_SEARCH_FILTERS if request.args.get(name)}
+    params.update(limit=per_node, order='desc' if newest_first else 'asc')
+    endpoint = f'logs/{service}/query?{urlencode(params)}'
+    arrivals = queue.Queue()
+
+    async def query(node_id, node):
+        started = time.monotonic()
+        result = await node_client.call(node, endpoint, timeout=deadline)
+        arrivals.put((node_id, result, round((time.monotonic() - started) * 1000, 1)))
+
+    started = time.monotonic()
+    node_client.submit(node_client.gather(
+        {node_id: query(node_id, node) for node_id, node in nodes.items()}, BATCH_CONCURRENCY, deadline))
+
+    def generate():
+        answered, sources = {}, []
+        while len(answered) < len(nodes):
+            try:
+                node_id, result, ms = arrivals.get(timeout=max(started + deadline + 0.25 - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if 'error' in result:
+                answered[node_id] = {'ok': False, 'error': result['error'], 'ms': ms}
+            else:
+                records = result.get('records') or []
+                sources.append([(record['ts'], node_id, record) for record in records])
+                answered[node_id] = {'ok': True, 'count': len(records), 'truncated': result.get('truncated', False), 'ms': ms}
+            yield json.dumps({'type': 'node', 'node': node_id, **answered[node_id]}) + '\n'
+
+        returned, lines = 0, []
+        for _, node_id, record in heapq.merge(*sources, key=lambda item: item[0], reverse=newest_first):
+            lines.append(json.dumps({'type': 'record', 'node': node_id, 'name': nodes[node_id].get('name'), **record}))
+            returned += 1
+            if len(lines) >= 200:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+        timed_out = [node_id for node_id in nodes if node_id not in answered]
+        yield json.dumps({
+            'type': 'summary',
+            'service': service,
+            'nodes': len(nodes),
+            'answered': len(answered),
+            'timed_out': timed_out,
+            'missing': missing,
+            'returned': returned,
+            'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
+            'complete': not timed_out
+        }) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/nodes/<node_id>/services')
+@rate_limit(api_limiter)
+def node_services(node_id):
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'services'))
+
+
+@app.route('/api/nodes/<node_id>/restart/<service>', methods=['POST'])
+@rate_limit(auth_limiter)
+def restart_service(node_id, service):
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    try:
+        service = sanitize_service(service)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, f'restart/{service}', 'POST'))
+
+
+@app.route('/api/nodes/<node_id>/config/<service>', methods=['GET', 'POST'])
+@rate_limit(api_limiter)
+def config(node_id, service):
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    try:
+        service = sanitize_service(service)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        # An apply waits for sing-box check, the reload health check and a possible rollback
+        return jsonify(call_node_api(node, f'config/{service}', 'POST', data, timeout=90 if data.get('apply') else 30))
+    return jsonify(call_node_api(node, f'config/{service}'))
+
+
+@app.route('/api/nodes/<node_id>/logs/<service>')
+@rate_limit(api_limiter)
+def node_logs(node_id, service):
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    try:
+        service = sanitize_service(service)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    lines = request.args.get('lines', '100')
+    return jsonify(call_node_api(node, f'logs/{service}?lines={lines}'))
+
+
+@app.route('/api/nodes/<node_id>/logs/<service>/stream')
+@rate_limit(api_limiter)
+def node_logs_stream(node_id, service):
+    """Relay a node's log stream as Server-Sent Events (tail, follow, since/Last-Event-ID)"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    try:
+        service = sanitize_service(service)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    params = {'tail': request.args.get('tail', '100'), 'follow': request.args.get('follow', '0')}
+    since = request.args.get('since') or request.headers.get('Last-Event-ID')
+    if since:
+        params['since'] = since
+    try:
+        status, _, relay = stream_node_api(node, f'logs/{service}/stream?{urlencode(params)}')
+    except Exception as e:
+        return jsonify({'error': str(e) or type(e).__name__}), 502
+    if status != 200:
+        relay.close()
+        return jsonify({'error': f'Node answered {status}'}), 502
+    return Response(relay, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/nodes/<node_id>/update', methods=['POST'])
+@rate_limit(auth_limiter)
+def update_node(node_id):
+    """Trigger update on a specific node"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'update', 'POST', timeout=120))
+
+
+@app.route('/api/nodes/<node_id>/restart-all', methods=['POST'])
+@rate_limit(auth_limiter)
+def restart_node_all(node_id):
+    """Restart all containers on a node"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'restart-all', 'POST', timeout=60))
+
+
+@app.route('/api/nodes/<node_id>/proxies')
+@rate_limit(api_limiter)
+def node_proxies(node_id):
+    """Get all proxy configurations from a node"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'proxies'))
+
+
+@app.route('/api/nodes/<node_id>/firewall', methods=['GET'])
+@rate_limit(api_limiter)
+def get_node_firewall(node_id):
+    """Get firewall status from a node"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'firewall'))
+
+
+@app.route('/api/nodes/<node_id>/firewall', methods=['POST'])
+@rate_limit(auth_limiter)
+def set_node_firewall(node_id):
+    """Configure firewall on a node"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'firewall', 'POST', request.json))
+
+
+# Settings & Update APIs
+@app.route('/api/settings', methods=['GET', 'POST'])
+@rate_limit(api_limiter)
+def settings():
+    if request.method == 'GET':
+        return jsonify(load_settings())
+    
+    data = request.json or {}
+    current = load_settings()
+    if 'auto_update' in data:
+        current['auto_update'] = bool(data['auto_update'])
+    save_settings(current)
+    return jsonify(current)
+
+
+@app.route('/api/update/check')
+@rate_limit(api_limiter)
+def update_check():
+    """Check for available updates"""
+    result = check_for_updates()
+    settings = load_settings()
+    settings['last_update_check'] = datetime.now().isoformat()
+    save_settings(settings)
+    return jsonify(result)
+
+
+@app.route('/api/update/master', methods=['POST'])
+@rate_limit(auth_limiter)
+def update_master():
+    """Update master to latest version and restart"""
+    import shutil
+    import threading
+    import zipfile
+    import io
+    
+    try:
+        # Get the directory where app.py is located
+        app_dir = os.path.dirname(os.path.abspath(__file__))
+        templates_dir = os.path.join(app_dir, 'templates')
+        
+        # Download latest using requests (curl not available in container)
         resp = requests.get('https://github.com/pjonix/SUIS/archive/main.zip', timeout=30)
         if resp.status_code != 200:
             return jsonify({'success': False, 'error': f'Download failed: HTTP {resp.status_code}'})
@@ -409,7 +2408,8 @@ def update_master():
             zf.extractall('/tmp/')
         
         # Backup and copy new files
-        for f in ['app.py']:
+        # gunicorn.conf.py takes effect on restart; Dockerfile and requirements on the next image build
+        for f in ['app.py', 'gunicorn.conf.py', 'Dockerfile', 'requirements.txt']:
             src = f'/tmp/SUIS-main/master/{f}'
             dst = os.path.join(app_dir, f)
             if os.path.exists(src):
@@ -441,269 +2441,1771 @@ def update_master():
         return jsonify({'success': False, 'error': str(e)})
 
 
-@app.route('/api/update/all-nodes', methods=['POST'])
-@rate_limit(auth_limiter)
-def update_all_nodes():
-    """Trigger update on all nodes"""
-    nodes = load_nodes()
-    results = {}
-    for node_id, node in nodes.items():
-        results[node_id] = call_node_api(node, 'update', 'POST', timeout=120)
-    return jsonify(results)
+@app.route('/api/update/all-nodes', methods=['POST'])
+@rate_limit(auth_limiter)
+def update_all_nodes():
+    """Start a rolling update of all (or the selected) nodes; poll the returned rollout for progress"""
+    data = request.get_json(silent=True) or {}
+    try:
+        nodes, missing = select_nodes()
+        parallelism = int(data.get('parallelism', ROLLOUT_PARALLELISM))
+        canary = int(data.get('canary', ROLLOUT_CANARY))
+        max_failure_ratio = float(data.get('max_failure_ratio', ROLLOUT_MAX_FAILURE_RATIO))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    if not nodes:
+        return jsonify({'error': 'No nodes to update'}), 400
+    rollout = RollingUpdate(nodes, min(max(parallelism, 1), 50), canary, max_failure_ratio,
+                            ROLLOUT_UPDATE_TIMEOUT, ROLLOUT_HEALTH_TIMEOUT)
+    rollout_id = rollout.start()
+    if rollout_id is None:
+        active = job_store.active('rollout')
+        return jsonify({'error': 'A rollout is already running', 'rollout': active[0]['id'] if active else None}), 409
+    return jsonify({'rollout_id': rollout_id, 'nodes': len(nodes), 'missing': missing,
+                    'status_url': f'/api/update/rollouts/{rollout_id}'}), 202
+
+
+@app.route('/api/update/rollouts')
+@rate_limit(api_limiter)
+def list_rollouts():
+    return jsonify({'rollouts': job_store.recent('rollout')})
+
+
+@app.route('/api/update/rollouts/<rollout_id>')
+def rollout_status(rollout_id):
+    """Per-node progress of a rollout (not rate limited so the dashboard can poll it)"""
+    job = job_store.get(rollout_id)
+    if not job:
+        return jsonify({'error': 'Rollout not found'}), 404
+    return jsonify(job)
+
+
+@app.route('/api/update/rollouts/<rollout_id>/abort', methods=['POST'])
+@rate_limit(auth_limiter)
+def abort_rollout(rollout_id):
+    if not job_store.request_abort(rollout_id):
+        return jsonify({'error': 'Rollout not running'}), 409
+    return jsonify({'success': True})
+
+
+@app.route('/api/master/restart', methods=['POST'])
+@rate_limit(auth_limiter)
+def restart_master():
+    """Restart Master container"""
+    try:
+        result = subprocess.run(
+            ['sh', '-c', 'cd /opt/sui-solo/master && docker compose restart'],
+            capture_output=True, text=True, timeout=60
+        )
+        return jsonify({'success': result.returncode == 0, 'output': result.stdout + result.stderr})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+@app.route('/api/gateway/restart', methods=['POST'])
+@rate_limit(auth_limiter)
+def restart_gateway():
+    """Restart Gateway container"""
+    try:
+        result = subprocess.run(
+            ['sh', '-c', 'cd /opt/sui-solo/gateway && docker compose restart'],
+            capture_output=True, text=True, timeout=60
+        )
+        return jsonify({'success': result.returncode == 0, 'output': result.stdout + result.stderr})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+
+# ============================================================================
+# SUBSCRIPTION API - Enhanced with Preset Support
+# ============================================================================
+@app.route('/api/nodes/<node_id>/presets')
+@rate_limit(api_limiter)
+def node_presets(node_id):
+    """Get preset configurations from a node"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'presets'))
+
+
+@app.route('/api/nodes/<node_id>/presets', methods=['POST'])
+@rate_limit(api_limiter)
+def update_node_presets(node_id):
+    """Update preset configurations on a node"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'presets', 'POST', request.json))
+
+
+@app.route('/api/nodes/<node_id>/subscribe')
+@rate_limit(api_limiter)
+def node_subscribe(node_id):
+    """Get subscription links from a specific node"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    node = node_registry.get(node_id)
+    if not node:
+        return jsonify({'error': 'Node not found'}), 404
+    return jsonify(call_node_api(node, 'subscribe'))
+
+
+class NodeLinkSets:
+    """Last link set fetched from each node, keyed by the agent's ETag.
+
+    The link sets live in cache.db so every worker revalidates with the same
+    ETags; parsed entries and rendered fragments are memoized per node and only
+    rebuilt when that node's ETag (or its name/domain) changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.memo = {}  # (node_id, kind) -> (version, value)
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = connect_sqlite(self.path)
+            db.execute('CREATE TABLE IF NOT EXISTS node_links ('
+                       'node_id TEXT PRIMARY KEY, etag TEXT NOT NULL, links TEXT NOT NULL, fetched REAL NOT NULL)')
+        return db
+
+    def load(self):
+        return {node_id: (etag, json.loads(links))
+                for node_id, etag, links in self._db().execute('SELECT node_id, etag, links FROM node_links')}
+
+    def store(self, node_id, etag, links):
+        self._db().execute('INSERT OR REPLACE INTO node_links (node_id, etag, links, fetched) VALUES (?, ?, ?, ?)',
+                           (node_id, etag, json.dumps(links), time.time()))
+
+    def forget(self, node_id):
+        self._db().execute('DELETE FROM node_links WHERE node_id = ?', (node_id,))
+        with self.lock:
+            for key in [k for k in self.memo if k[0] == node_id]:
+                del self.memo[key]
+
+    def _memoized(self, node_id, kind, version, build):
+        with self.lock:
+            cached = self.memo.get((node_id, kind))
+        if cached and cached[0] == version:
+            self.stats['fragment_hits'] += 1
+            return cached[1]
+        self.stats['fragment_builds'] += 1
+        value = build()
+        with self.lock:
+            self.memo[(node_id, kind)] = (version, value)
+        return value
+
+    def entries(self, node_id, node, etag, links):
+        version = f"{etag}|{node['name']}|{node['domain']}"
+        return self._memoized(node_id, 'entries', version, lambda: parse_subscription_links(
+            [dict(link_info, node_name=node['name'], node_domain=node['domain']) for link_info in links]
+        ))
+
+    def fragment(self, node_id, node, etag, links, format_type):
+        version = f"{etag}|{node['name']}|{node['domain']}"
+        fragment_fn = SUBSCRIPTION_RENDERERS[format_type][0]
+        return self._memoized(node_id, format_type, version,
+                              lambda: fragment_fn(self.entries(node_id, node, etag, links)))
+
+
+node_link_sets = NodeLinkSets(CACHE_DB)
+
+
+@metrics.collector
+def collect_component_counters():
+    for event in ('hits', 'stale_hits', 'misses', 'coalesced', 'refreshes', 'refresh_errors', 'evictions'):
+        yield 'subscription_cache_events_total', (event,), subscription_cache.stats[event]
+    for event in ('fragment_hits', 'fragment_builds'):
+        yield 'subscription_fragments_total', (event.split('_')[1],), node_link_sets.stats[event]
+    for event in ('hits', 'renders', 'evictions'):
+        yield 'user_subscriptions_total', (event,), user_subscriptions.stats[event]
+    for action in ('disabled', 'enabled'):
+        yield 'user_quota_changes_total', (action,), usage_ingest.stats[f'quota_{action}']
+    for event in ('new_connections', 'reused_connections', 'evicted_connections', 'evicted_nodes', 'streams'):
+        yield 'node_connections_total', (event,), node_client.stats[event]
+    for limiter in (api_limiter, auth_limiter, event_limiter):
+        yield 'rate_limit_rejections_total', (limiter.name,), limiter.rejected
+
+
+def apply_node_links(node_id, result, known):
+    """Fold one /subscribe answer into the stored link sets; returns (etag, links) or the last known set"""
+    if result.get('not_modified'):
+        node_link_sets.stats['not_modified'] += 1
+        return known
+    if 'links' not in result:
+        raise RuntimeError(result.get('error', 'no links in response'))
+    links = result['links']
+    etag = result.get('etag') or hashlib.sha256(json.dumps(links, sort_keys=True).encode()).hexdigest()
+    node_link_sets.store(node_id, etag, links)
+    node_link_sets.stats['fetched'] += 1
+    return etag, links
+
+
+# ============================================================================
+# SUBSCRIPTION MODEL - links are parsed once, every format renders from it
+# ============================================================================
+@dataclass(slots=True)
+class ProxyEntry:
+    """One proxy endpoint, normalized from a share link"""
+    protocol: str                   # vless | vmess | hysteria2 | trojan | shadowsocks
+    name: str
+    server: str
+    port: int
+    link: str = ''                  # original share link (base64/raw output)
+    label: str = ''                 # link type reported by the node
+    node_name: str = ''
+    node_domain: str = ''
+    uuid: str = ''
+    password: str = ''
+    method: str = ''                # shadowsocks cipher
+    security: str = ''              # vmess cipher
+    alter_id: int = 0
+    flow: str = ''
+    network: str = 'tcp'            # tcp | ws | grpc | http
+    path: str = ''
+    host: str = ''
+    service_name: str = ''
+    tls: bool = False
+    sni: str = ''
+    alpn: tuple = ()
+    fingerprint: str = ''
+    insecure: bool = False
+    reality_public_key: str = ''
+    reality_short_id: str = ''
+    obfs: str = ''
+    obfs_password: str = ''
+
+    def link_info(self):
+        return {'type': self.label or self.protocol, 'link': self.link, 'port': self.port,
+                'node_name': self.node_name, 'node_domain': self.node_domain}
+
+
+def _b64decode(data):
+    data = data.strip()
+    return base64.urlsafe_b64decode(data.replace('+', '-').replace('/', '_') + '=' * (-len(data) % 4))
+
+
+def _split_alpn(value):
+    return tuple(a for a in (value or '').split(',') if a)
+
+
+def _parse_url_entry(protocol, link):
+    url = urlsplit(link)
+    params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    credential = unquote(url.username or '')
+    entry = ProxyEntry(protocol=protocol, name=unquote(url.fragment), server=url.hostname or '', port=url.port or 0)
+    security = params.get('security', 'tls' if protocol in ('hysteria2', 'trojan') else '')
+    entry.tls = security in ('tls', 'reality')
+    entry.sni = params.get('sni', params.get('peer', ''))
+    entry.alpn = _split_alpn(params.get('alpn'))
+    entry.fingerprint = params.get('fp', '')
+    entry.insecure = params.get('insecure', params.get('allowInsecure', '0')) in ('1', 'true')
+    entry.network = params.get('type', 'tcp')
+    entry.path = params.get('path', '')
+    entry.host = params.get('host', '')
+    entry.service_name = params.get('serviceName', '')
+    if security == 'reality':
+        entry.reality_public_key = params.get('pbk', '')
+        entry.reality_short_id = params.get('sid', '')
+    if protocol == 'vless':
+        entry.uuid = credential
+        entry.flow = params.get('flow', '')
+    else:
+        entry.password = credential
+        entry.obfs = params.get('obfs', '')
+        entry.obfs_password = params.get('obfs-password', '')
+    return entry
+
+
+def _parse_vmess(link):
+    data = json.loads(_b64decode(link[len('vmess://'):]))
+    return ProxyEntry(
+        protocol='vmess', name=data.get('ps', ''), server=data.get('add', ''), port=int(data.get('port') or 0),
+        uuid=data.get('id', ''), alter_id=int(data.get('aid') or 0), security=data.get('scy', 'auto'),
+        network=data.get('net', 'tcp'), path=data.get('path', ''), host=data.get('host', ''),
+        tls=data.get('tls') == 'tls', sni=data.get('sni', ''), alpn=_split_alpn(data.get('alpn')),
+        fingerprint=data.get('fp', '')
+    )
+
+
+def _parse_shadowsocks(link):
+    url = urlsplit(link)
+    if url.username and url.password is None and '@' in url.netloc:
+        # SIP002: ss://base64(method:password)@host:port#name
+        method, _, password = _b64decode(unquote(url.username)).decode().partition(':')
+        host, port = url.hostname, url.port
+    else:
+        # Legacy: ss://base64(method:password@host:port)#name
+        decoded = _b64decode(url.netloc).decode()
+        userinfo, _, hostport = decoded.rpartition('@')
+        method, _, password = userinfo.partition(':')
+        host, _, port = hostport.rpartition(':')
+    return ProxyEntry(protocol='shadowsocks', name=unquote(url.fragment), server=host or '', port=int(port or 0),
+                      method=method, password=password)
+
+
+LINK_PARSERS = {
+    'vless': lambda link: _parse_url_entry('vless', link),
+    'trojan': lambda link: _parse_url_entry('trojan', link),
+    'hysteria2': lambda link: _parse_url_entry('hysteria2', link),
+    'hy2': lambda link: _parse_url_entry('hysteria2', link),
+    'vmess': _parse_vmess,
+    'ss': _parse_shadowsocks,
+}
+
+
+def parse_link_info(link_info):
+    """Normalize one node link into a ProxyEntry; raises ValueError on bad links"""
+    link = link_info.get('link', '')
+    scheme = link.partition('://')[0].lower()
+    if scheme not in LINK_PARSERS:
+        raise ValueError(f'unsupported link scheme: {scheme or link[:16]}')
+    try:
+        entry = LINK_PARSERS[scheme](link)
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+        raise ValueError(f'malformed {scheme} link: {e}') from e
+    entry.link = link
+    entry.label = link_info.get('type', entry.protocol)
+    entry.node_name = link_info.get('node_name', '')
+    entry.node_domain = link_info.get('node_domain', '')
+    entry.server = entry.server or entry.node_domain
+    entry.port = entry.port or int(link_info.get('port') or 0)
+    entry.sni = entry.sni or (entry.node_domain if entry.tls else '')
+    entry.name = f"{entry.node_name}-{entry.label}" if entry.node_name else (entry.name or entry.server)
+    return entry
+
+
+def parse_subscription_links(all_links):
+    """Parse fetched links once; malformed links are logged and skipped"""
+    entries = []
+    for link_info in all_links:
+        try:
+            entry = parse_link_info(link_info)
+        except ValueError as e:
+            app.logger.warning(f"Skipping link from {link_info.get('node_domain', '?')}: {e}")
+            continue
+        entries.append(entry)
+    return entries
+
+
+def _unique_names(items, key):
+    """Clash proxy names and sing-box tags must be unique across all nodes"""
+    names, unique = {}, []
+    for item in items:
+        base = name = item[key]
+        while name in names:
+            names[base] += 1
+            name = f'{base}-{names[base]}'
+        names[name] = 1
+        unique.append(item if name == base else {**item, key: name})
+    return unique
+
+
+# Each format renders per-node fragments, then assembles them into one document
+def base64_fragment(entries):
+    return '\n'.join(e.link for e in entries)
+
+
+def assemble_base64(fragments):
+    return base64.b64encode('\n'.join(f for f in fragments if f).encode()).decode()
+
+
+def raw_fragment(entries):
+    return [e.link_info() for e in entries]
+
+
+def assemble_raw(fragments):
+    return {'links': [link_info for fragment in fragments for link_info in fragment]}
+
+
+def clash_proxy(e):
+    proxy = {'name': e.name, 'type': 'ss' if e.protocol == 'shadowsocks' else e.protocol,
+             'server': e.server, 'port': e.port}
+    if e.protocol == 'vless':
+        proxy['uuid'] = e.uuid
+        if e.flow:
+            proxy['flow'] = e.flow
+    elif e.protocol == 'vmess':
+        proxy.update({'uuid': e.uuid, 'alterId': e.alter_id, 'cipher': e.security or 'auto'})
+    elif e.protocol == 'shadowsocks':
+        proxy.update({'cipher': e.method, 'password': e.password})
+        return proxy
+    else:
+        proxy['password'] = e.password
+    if e.protocol in ('vless', 'vmess'):
+        proxy['tls'] = e.tls
+    if e.obfs:
+        proxy['obfs'] = e.obfs
+        proxy['obfs-password'] = e.obfs_password
+    if e.tls:
+        proxy['sni' if e.protocol in ('hysteria2', 'trojan') else 'servername'] = e.sni
+        if e.alpn:
+            proxy['alpn'] = list(e.alpn)
+        if e.insecure:
+            proxy['skip-cert-verify'] = True
+        if e.fingerprint:
+            proxy['client-fingerprint'] = e.fingerprint
+    if e.reality_public_key:
+        proxy['reality-opts'] = {'public-key': e.reality_public_key, 'short-id': e.reality_short_id}
+    if e.protocol != 'hysteria2' and e.network != 'tcp':
+        proxy['network'] = e.network
+        if e.network == 'ws':
+            proxy['ws-opts'] = {'path': e.path or '/', **({'headers': {'Host': e.host}} if e.host else {})}
+        elif e.network == 'grpc':
+            proxy['grpc-opts'] = {'grpc-service-name': e.service_name}
+    return proxy
+
+
+def clash_fragment(entries):
+    return [clash_proxy(e) for e in entries]
+
+
+def assemble_clash(fragments):
+    proxies = _unique_names([p for fragment in fragments for p in fragment], 'name')
+    return {
+        'proxies': proxies,
+        'proxy-groups': [{
+            'name': 'auto',
+            'type': 'url-test',
+            'proxies': [p['name'] for p in proxies],
+            'url': 'http://www.gstatic.com/generate_204',
+            'interval': 300
+        }]
+    }
+
+
+def singbox_outbound(e):
+    outbound = {'type': e.protocol, 'tag': e.name, 'server': e.server, 'server_port': e.port}
+    if e.protocol == 'shadowsocks':
+        outbound.update({'method': e.method, 'password': e.password})
+        return outbound
+    if e.protocol == 'vless':
+        outbound['uuid'] = e.uuid
+        if e.flow:
+            outbound['flow'] = e.flow
+    elif e.protocol == 'vmess':
+        outbound.update({'uuid': e.uuid, 'alter_id': e.alter_id, 'security': e.security or 'auto'})
+    else:
+        outbound['password'] = e.password
+    if e.obfs:
+        outbound['obfs'] = {'type': e.obfs, 'password': e.obfs_password}
+    if e.tls:
+        tls = {'enabled': True, 'server_name': e.sni}
+        if e.alpn:
+            tls['alpn'] = list(e.alpn)
+        if e.insecure:
+            tls['insecure'] = True
+        if e.fingerprint:
+            tls['utls'] = {'enabled': True, 'fingerprint': e.fingerprint}
+        if e.reality_public_key:
+            tls['reality'] = {'enabled': True, 'public_key': e.reality_public_key, 'short_id': e.reality_short_id}
+        outbound['tls'] = tls
+    if e.protocol != 'hysteria2' and e.network in ('ws', 'grpc', 'http'):
+        transport = {'type': e.network}
+        if e.network == 'grpc':
+            transport['service_name'] = e.service_name
+        else:
+            transport['path'] = e.path or '/'
+        if e.host and e.network == 'ws':
+            transport['headers'] = {'Host': e.host}
+        elif e.host and e.network == 'http':
+            transport['host'] = [e.host]
+        outbound['transport'] = transport
+    return outbound
+
+
+def singbox_fragment(entries):
+    return [singbox_outbound(e) for e in entries]
+
+
+def assemble_singbox(fragments):
+    outbounds = _unique_names([o for fragment in fragments for o in fragment], 'tag')
+    return {
+        'log': {'level': 'info'},
+        'outbounds': outbounds + [{'type': 'direct', 'tag': 'direct'}],
+        'route': {'final': outbounds[0]['tag'] if outbounds else 'direct'}
+    }
+
+
+SUBSCRIPTION_RENDERERS = {
+    'base64': (base64_fragment, assemble_base64, 'text/plain'),
+    'clash': (clash_fragment, assemble_clash, 'application/json'),
+    'singbox': (singbox_fragment, assemble_singbox, 'application/json'),
+    'raw': (raw_fragment, assemble_raw, 'application/json'),
+}
+SUBSCRIPTION_FORMATS = set(SUBSCRIPTION_RENDERERS)
+
+
+def _encode_subscription(body, mimetype):
+    return (body if isinstance(body, str) else json.dumps(body)), mimetype
+
+
+def render_subscription(format_type, entries):
+    """Render one list of parsed entries, returns (body, mimetype)"""
+    fragment_fn, assemble_fn, mimetype = SUBSCRIPTION_RENDERERS[format_type]
+    return _encode_subscription(assemble_fn([fragment_fn(entries)]), mimetype)
+
+
+def collect_node_link_sets():
+    """Revalidate every online node's link set concurrently.
+
+    Nodes answering 304, failing or timing out keep their last known link set.
+    Returns [(node_id, node, etag, links)] in node id order.
+    """
+    nodes = load_nodes_with_health()
+    online_nodes = {node_id: node for node_id, node in nodes.items() if node.get('status') == 'online'}
+    known = node_link_sets.load()
+
+    def revalidate(node_id, node):
+        etag = known.get(node_id, (None,))[0]
+        return node_client.call(node, 'subscribe', timeout=5, headers={'If-None-Match': etag} if etag else None)
+
+    results, timed_out = fan_out_nodes(online_nodes, revalidate, deadline=10)
+    if timed_out:
+        app.logger.error(f"Subscription fetch timed out for nodes: {', '.join(timed_out)}")
+    link_sets = []
+    for node_id in sorted(online_nodes):
+        current = known.get(node_id)
+        if node_id in results:
+            try:
+                current = apply_node_links(node_id, results[node_id], current)
+            except RuntimeError as e:
+                app.logger.error(f"Failed to fetch subscription from {online_nodes[node_id]['domain']}: {e}")
+        if current:
+            link_sets.append((node_id, online_nodes[node_id], *current))
+    for node_id in set(known) - set(nodes):
+        node_link_sets.forget(node_id)
+    return link_sets
+
+
+def build_subscription(format_type):
+    """Render the aggregated subscription, returns (body, mimetype)"""
+    assemble_fn, mimetype = SUBSCRIPTION_RENDERERS[format_type][1:]
+    fragments = [node_link_sets.fragment(node_id, node, etag, links, format_type)
+                 for node_id, node, etag, links in collect_node_link_sets()]
+    return _encode_subscription(assemble_fn(fragments), mimetype)
+
+
+@app.route('/api/subscribe')
+@rate_limit(api_limiter)
+def subscribe():
+    """Aggregated subscription from all online nodes (shared cache, stale-while-revalidate)"""
+    format_type = request.args.get('format', 'base64')  # base64, clash, singbox
+    if format_type not in SUBSCRIPTION_FORMATS:
+        format_type = 'raw'
+    body, mimetype = subscription_cache.get_or_build(
+        f'subscription_{format_type}', lambda: build_subscription(format_type)
+    )
+    return Response(body, mimetype=mimetype)
+
+
+@app.route('/api/subscribe/stats')
+@rate_limit(api_limiter)
+def subscribe_stats():
+    """Subscription cache size and hit/miss/refresh counters (this worker)"""
+    return jsonify({**subscription_cache.info(), 'node_links': dict(node_link_sets.stats)})
+
+
+@app.route('/api/subscribe/url')
+@rate_limit(api_limiter)
+def subscribe_url():
+    """Get subscription URL info"""
+    master_domain = os.environ.get('MASTER_DOMAIN', '')
+    # Try to get domain from request if not set in env
+    if not master_domain:
+        master_domain = request.host.split(':')[0]
+    hidden_path = get_hidden_path(CLUSTER_SECRET)
+    return jsonify({
+        'base64': f"https://{master_domain}/{hidden_path}/sub",
+        'clash': f"https://{master_domain}/{hidden_path}/sub?format=clash",
+        'singbox': f"https://{master_domain}/{hidden_path}/sub?format=singbox",
+        'public_base64': f"https://{master_domain}/api/subscribe",
+        'public_clash': f"https://{master_domain}/api/subscribe?format=clash",
+        'public_singbox': f"https://{master_domain}/api/subscribe?format=singbox"
+    })
+
+
+# Hidden subscription endpoint (more secure)
+@app.route(f'/<path:hidden>/sub')
+@rate_limit(api_limiter)
+def hidden_subscribe(hidden):
+    """Hidden subscription endpoint"""
+    if hidden != get_hidden_path(CLUSTER_SECRET):
+        return jsonify({'error': 'Not found'}), 404
+    return subscribe()
+
+
+# ============================================================================
+# USERS - per-user credentials on every node, one subscription URL per user
+# ============================================================================
+class UserRegistry:
+    """Subscription users in SQLite (WAL).
+
+    Each user has an id (also the sing-box user name on nodes), a uuid for
+    vless, a password for hysteria2 and an unguessable subscription token.
+    Rows carry the registry version of their last change, so memoized
+    subscriptions know when a user's credentials moved on. Traffic totals
+    live next to the users, one row per user and period (UTC day and month).
+    """
+
+    COLUMNS = ('id', 'name', 'token', 'uuid', 'password', 'enabled', 'created', 'rev', 'quota_bytes', 'disabled_reason')
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._write() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS users ('
+                       'id TEXT PRIMARY KEY, name TEXT NOT NULL UNIQUE, token TEXT NOT NULL UNIQUE, '
+                       'uuid TEXT NOT NULL, password TEXT NOT NULL, enabled INTEGER NOT NULL DEFAULT 1, '
+                       'created REAL NOT NULL, rev INTEGER NOT NULL, '
+                       "quota_bytes INTEGER NOT NULL DEFAULT 0, disabled_reason TEXT NOT NULL DEFAULT '')")
+            columns = {row[1] for row in db.execute('PRAGMA table_info(users)')}
+            if 'quota_bytes' not in columns:
+                # users.db from before quotas
+                db.execute('ALTER TABLE users ADD COLUMN quota_bytes INTEGER NOT NULL DEFAULT 0')
+                db.execute("ALTER TABLE users ADD COLUMN disabled_reason TEXT NOT NULL DEFAULT ''")
+            db.execute('CREATE TABLE IF NOT EXISTS usage ('
+                       'user_id TEXT NOT NULL, period TEXT NOT NULL, up INTEGER NOT NULL, down INTEGER NOT NULL, '
+                       'PRIMARY KEY (user_id, period)) WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS usage_batches ('
+                       'node_id TEXT PRIMARY KEY, boot TEXT NOT NULL, seq INTEGER NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+            db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = connect_sqlite(self.path)
+        return db
+
+    def _write(self):
+        return SqliteNodeRegistry._Transaction(self._db())
+
+    def _row(self, row):
+        return dict(zip(self.COLUMNS, row), enabled=bool(row[5])) if row else None
+
+    def _select(self, where='', params=()):
+        return f"SELECT {', '.join(self.COLUMNS)} FROM users {where}", params
+
+    def get(self, user_id):
+        return self._row(self._db().execute(*self._select('WHERE id = ?', (user_id,))).fetchone())
+
+    def by_token(self, token):
+        """Token lookup, served by the unique index"""
+        return self._row(self._db().execute(*self._select('WHERE token = ?', (token,))).fetchone())
+
+    def page(self, offset=0, limit=100):
+        """(users with this month's bytes as month_bytes, total user count)"""
+        users = [self._row(row) for row in
+                 self._db().execute(*self._select('ORDER BY created, id LIMIT ? OFFSET ?', (limit, offset)))]
+        month = self.periods(time.time())[1]
+        used = dict(self._db().execute(
+            f"SELECT user_id, up + down FROM usage WHERE period = ? AND user_id IN ({', '.join('?' * len(users))})",
+            (month, *(u['id'] for u in users))))
+        for user in users:
+            user['month_bytes'] = used.get(user['id'], 0)
+        return users, self.count()
+
+    def count(self):
+        return self._db().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def credentials(self):
+        """What nodes need for every enabled user: [{'name', 'uuid', 'password'}]"""
+        return [{'name': user_id, 'uuid': uuid, 'password': password} for user_id, uuid, password in
+                self._db().execute('SELECT id, uuid, password FROM users WHERE enabled = 1 ORDER BY id')]
+
+    def add(self, name):
+        """Create a user; raises ValueError when the name is taken"""
+        user_id = f'{MANAGED_USER_PREFIX}{secrets.token_hex(6)}'
+        with self._write() as db:
+            rev = SqliteNodeRegistry._bump(db)
+            try:
+                db.execute('INSERT INTO users (id, name, token, uuid, password, enabled, created, rev) '
+                           'VALUES (?, ?, ?, ?, ?, 1, ?, ?)',
+                           (user_id, name, secrets.token_urlsafe(24), str(uuid_lib.uuid4()),
+                            secrets.token_urlsafe(16), time.time(), rev))
+            except sqlite3.IntegrityError:
+                raise ValueError(f'User {name!r} already exists')
+        return self.get(user_id)
+
+    def update(self, user_id, **fields):
+        """Set columns (token, enabled, quota_bytes, ...) on one user; returns the user or None"""
+        with self._write() as db:
+            rev = SqliteNodeRegistry._bump(db)
+            assignments = ', '.join(f'{column} = ?' for column in fields)
+            updated = db.execute(f'UPDATE users SET {assignments}, rev = ? WHERE id = ?',
+                                 (*fields.values(), rev, user_id)).rowcount
+        return self.get(user_id) if updated else None
+
+    def delete(self, user_id):
+        with self._write() as db:
+            SqliteNodeRegistry._bump(db)
+            db.execute('DELETE FROM usage WHERE user_id = ?', (user_id,))
+            return db.execute('DELETE FROM users WHERE id = ?', (user_id,)).rowcount > 0
+
+    @staticmethod
+    def periods(ts):
+        day = time.strftime('%Y-%m-%d', time.gmtime(ts))
+        return day, day[:7]
+
+    def claim_batch(self, node_id, boot, seq):
+        """False when this node's batch was already accepted (a retry after a lost response)"""
+        with self._write() as db:
+            row = db.execute('SELECT boot, seq FROM usage_batches WHERE node_id = ?', (node_id,)).fetchone()
+            if row and row[0] == boot and seq <= row[1]:
+                return False
+            db.execute('INSERT OR REPLACE INTO usage_batches (node_id, boot, seq) VALUES (?, ?, ?)',
+                       (node_id, boot, seq))
+            return True
+
+    def add_usage(self, totals, ts):
+        """Add {user_id: [up, down]} to the day and month totals of ts (unknown users are skipped)"""
+        rows = [(user_id, period, up, down, user_id)
+                for user_id, (up, down) in totals.items() for period in self.periods(ts)]
+        with self._write() as db:
+            db.executemany('INSERT INTO usage (user_id, period, up, down) SELECT ?, ?, ?, ? '
+                           'WHERE EXISTS (SELECT 1 FROM users WHERE id = ?) '
+                           'ON CONFLICT (user_id, period) DO UPDATE SET '
+                           'up = up + excluded.up, down = down + excluded.down', rows)
+
+    def usage(self, user_id, monthly=False, limit=31):
+        """[[period, up, down], ...] newest first, days or months"""
+        pattern = '____-__' if monthly else '____-__-__'
+        return [list(row) for row in self._db().execute(
+            'SELECT period, up, down FROM usage WHERE user_id = ? AND period LIKE ? ORDER BY period DESC LIMIT ?',
+            (user_id, pattern, limit))]
+
+    def enforce_quotas(self, ts):
+        """Disable users over their monthly quota and re-enable quota-disabled users that are back
+        under it (new month or raised quota), in one transaction; returns (disabled, enabled) ids"""
+        month = self.periods(ts)[1]
+        with self._write() as db:
+            over = [row[0] for row in db.execute(
+                'SELECT u.id FROM users u JOIN usage g ON g.user_id = u.id AND g.period = ? '
+                'WHERE u.enabled = 1 AND u.quota_bytes > 0 AND g.up + g.down >= u.quota_bytes', (month,))]
+            back = [row[0] for row in db.execute(
+                'SELECT u.id FROM users u LEFT JOIN usage g ON g.user_id = u.id AND g.period = ? '
+                "WHERE u.enabled = 0 AND u.disabled_reason = 'quota' "
+                'AND (u.quota_bytes = 0 OR COALESCE(g.up + g.down, 0) < u.quota_bytes)', (month,))]
+            if over or back:
+                rev = SqliteNodeRegistry._bump(db)
+                db.executemany("UPDATE users SET enabled = 0, disabled_reason = 'quota', rev = ? WHERE id = ?",
+                               [(rev, user_id) for user_id in over])
+                db.executemany("UPDATE users SET enabled = 1, disabled_reason = '', rev = ? WHERE id = ?",
+                               [(rev, user_id) for user_id in back])
+        return over, back
+
+
+user_registry = UserRegistry(USERS_DB)
+
+# Inbound types that carry one credential per user on the nodes
+USER_PROTOCOLS = ('vless', 'hysteria2')
+
+
+def personalize_entry(entry, user):
+    """Copy of a fleet entry carrying the user's credential, share link included"""
+    field = 'uuid' if entry.protocol == 'vless' else 'password'
+    url = urlsplit(entry.link)
+    netloc = f"{quote(user[field], safe='')}@{url.netloc.rpartition('@')[2]}"
+    return replace(entry, link=urlunsplit(url._replace(netloc=netloc)), **{field: user[field]})
+
+
+class UserSubscriptions:
+    """Rendered per-user subscriptions, memoized in this worker.
+
+    All users share the fleet link set (the cached raw subscription); a
+    user's document is that set with the user's credentials swapped in. A
+    body is rendered on the user's first fetch and stays valid while both
+    the fleet links and the user's row are unchanged, so a request is one
+    token lookup, one cache version lookup and a dict hit, and adding or
+    removing a user never re-renders anyone else.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.memo = OrderedDict()  # (user_id, format) -> ((fleet version, user rev), body, mimetype)
+        self.fleet = (None, [])
+        self.lock = threading.Lock()
+        self.stats = defaultdict(int)
+
+    def _fleet_entries(self):
+        """(version, entries) of the fleet link set; the version is the cache entry's creation time"""
+        def builder():
+            return build_subscription('raw')
+
+        stamp = subscription_cache.version('subscription_raw')
+        with self.lock:
+            fleet = self.fleet
+        if stamp is not None and fleet[0] == stamp[0]:
+            # One indexed lookup; the raw body is only read again when the entry was replaced
+            if stamp[1] >= subscription_cache.ttl:
+                subscription_cache.revalidate('subscription_raw', builder)
+            return fleet
+        # Read before the body: if a refresh lands in between, the next call re-parses once
+        version = stamp[0] if stamp else None
+        body, _ = subscription_cache.get_or_build('subscription_raw', builder)
+        entries = [e for e in parse_subscription_links(json.loads(body)['links']) if e.protocol in USER_PROTOCOLS]
+        with self.lock:
+            self.fleet = (version, entries)
+        return version, entries
+
+    def get(self, user, format_type):
+        """(body, mimetype) of the user's subscription in format_type"""
+        version, entries = self._fleet_entries()
+        key, stamp = (user['id'], format_type), (version, user['rev'])
+        with self.lock:
+            cached = self.memo.get(key)
+            if cached and cached[0] == stamp:
+                self.memo.move_to_end(key)
+                self.stats['hits'] += 1
+                return cached[1], cached[2]
+        self.stats['renders'] += 1
+        body, mimetype = render_subscription(format_type, [personalize_entry(e, user) for e in entries])
+        with self.lock:
+            self.memo[key] = (stamp, body, mimetype)
+            self.memo.move_to_end(key)
+            while len(self.memo) > self.max_entries:
+                self.memo.popitem(last=False)
+                self.stats['evictions'] += 1
+        return body, mimetype
+
+    def forget(self, user_id):
+        with self.lock:
+            for format_type in SUBSCRIPTION_FORMATS:
+                self.memo.pop((user_id, format_type), None)
+
+
+user_subscriptions = UserSubscriptions(USER_SUBSCRIPTION_MEMO)
+
+
+class UserSync:
+    """Pushes the enabled users to every online node.
+
+    Changes schedule a push; those arriving within `delay` of each other go
+    out as one. Nodes that were offline catch up on the next push or a
+    POST /api/users/sync. Nodes replace only the users they got from master and skip
+    the reload when nothing changed, so pushing the full set is idempotent.
+    """
+
+    def __init__(self, delay, timeout):
+        self.delay = delay
+        self.timeout = timeout
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last = {}
+
+    def schedule(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='user-sync', daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def _run(self):
+        while True:
+            self.wake.wait()
+            time.sleep(self.delay)
+            self.wake.clear()
+            try:
+                self.push()
+            except Exception as e:
+                app.logger.error(f"User sync failed: {e}")
+
+    def push(self, nodes=None):
+        """Send the user set to nodes (default: all not known to be offline), returns the summary"""
+        if nodes is None:
+            nodes = {k: v for k, v in load_nodes_with_health().items() if v.get('status') != 'offline'}
+        users = user_registry.credentials()
+
+        async def send(node_id, node):
+            return await node_client.call(node, 'users', 'POST', {'users': users}, timeout=self.timeout)
+
+        results, timed_out = fan_out_nodes(nodes, send, deadline=self.timeout + 10)
+        summary = {node_id: {'success': bool(result.get('success')), 'changed': result.get('changed'),
+                             **({'error': result['error']} if result.get('error') else {})}
+                   for node_id, result in results.items()}
+        summary.update({node_id: {'success': False, 'error': 'timed out'} for node_id in timed_out})
+        failed = [node_id for node_id, result in summary.items() if not result['success']]
+        if failed:
+            app.logger.error(f"User sync failed on nodes: {', '.join(sorted(failed))}")
+        self.last = {'at': time.time(), 'users': len(users), 'nodes': summary}
+        return self.last
+
 
+user_sync = UserSync(USER_SYNC_DELAY, USER_SYNC_TIMEOUT)
 
-@app.route('/api/master/restart', methods=['POST'])
-@rate_limit(auth_limiter)
-def restart_master():
-    """Restart Master container"""
+
+class UsageIngest:
+    """Per-user traffic batches from nodes, merged in memory and written in bulk.
+
+    Accepted batches fold into `pending` (two counters per user, however many
+    nodes report them); every `interval` one transaction adds them to the day
+    and month totals, then the quota pass runs and any users it disabled or
+    re-enabled go out to the nodes as one user sync. A node's batch ids are
+    claimed in SQLite on arrival, so a retried batch is dropped by whichever
+    worker receives it. Usage of the last interval is lost if a worker dies
+    before its flush.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}  # user_id -> [bytes up, bytes down]
+        self.thread = None
+        self.stats = defaultdict(int)
+
+    def add(self, usage):
+        with self.lock:
+            for user_id, (up, down) in usage.items():
+                entry = self.pending.get(user_id)
+                if entry is None:
+                    self.pending[user_id] = [up, down]
+                else:
+                    entry[0] += up
+                    entry[1] += down
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='usage-flush', daemon=True)
+                self.thread.start()
+
+    def flush(self):
+        """Write pending totals and enforce quotas; returns the number of users written"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        now = time.time()
+        if pending:
+            try:
+                user_registry.add_usage(pending, now)
+            except Exception:
+                self.add(pending)  # keep them for the next flush
+                raise
+            self.stats['flushed_users'] += len(pending)
+        disabled, enabled = user_registry.enforce_quotas(now)
+        if disabled or enabled:
+            self.stats['quota_disabled'] += len(disabled)
+            self.stats['quota_enabled'] += len(enabled)
+            app.logger.info(f"Quota: disabled {len(disabled)} user(s), re-enabled {len(enabled)}")
+            user_sync.schedule()
+        return len(pending)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error(f"Usage flush failed: {e}")
+
+
+usage_ingest = UsageIngest(USAGE_FLUSH_INTERVAL)
+
+
+def user_info(user, base=None):
+    """User row for the API, with its subscription URLs"""
+    base = base or f"https://{os.environ.get('MASTER_DOMAIN') or request.host.split(':')[0]}"
+    url = f"{base}/sub/{user['token']}"
+    return {**user, 'subscription': {'base64': url, 'clash': f'{url}?format=clash', 'singbox': f'{url}?format=singbox'}}
+
+
+@app.route('/api/users', methods=['GET'])
+@rate_limit(api_limiter)
+def list_users():
+    """Users page by page (?offset=&limit=, limit up to 1000)"""
     try:
-        result = subprocess.run(
-            ['sh', '-c', 'cd /opt/sui-solo/master && docker compose restart'],
-            capture_output=True, text=True, timeout=60
-        )
-        return jsonify({'success': result.returncode == 0, 'output': result.stdout + result.stderr})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    users, total = user_registry.page(offset, limit)
+    return jsonify({'users': [user_info(u) for u in users], 'total': total, 'offset': offset, 'limit': limit})
 
 
-@app.route('/api/gateway/restart', methods=['POST'])
-@rate_limit(auth_limiter)
-def restart_gateway():
-    """Restart Gateway container"""
+@app.route('/api/users', methods=['POST'])
+@rate_limit(api_limiter)
+def add_user():
+    name = sanitize_name((request.json or {}).get('name')).strip()
+    if not name:
+        return jsonify({'error': 'Missing name'}), 400
     try:
-        result = subprocess.run(
-            ['sh', '-c', 'cd /opt/sui-solo/gateway && docker compose restart'],
-            capture_output=True, text=True, timeout=60
-        )
-        return jsonify({'success': result.returncode == 0, 'output': result.stdout + result.stderr})
-    except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        user = user_registry.add(name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    user_sync.schedule()
+    return jsonify(user_info(user))
 
 
-# ============================================================================
-# SUBSCRIPTION API - Enhanced with Preset Support
-# ============================================================================
-@app.route('/api/nodes/<node_id>/presets')
+@app.route('/api/users/<user_id>', methods=['DELETE'])
 @rate_limit(api_limiter)
-def node_presets(node_id):
-    """Get preset configurations from a node"""
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'presets'))
+def delete_user(user_id):
+    if not USER_ID_PATTERN.match(user_id):
+        return jsonify({'error': 'Invalid user ID'}), 400
+    if not user_registry.delete(user_id):
+        return jsonify({'error': 'User not found'}), 404
+    user_subscriptions.forget(user_id)
+    user_sync.schedule()
+    return jsonify({'success': True})
 
 
-@app.route('/api/nodes/<node_id>/presets', methods=['POST'])
+@app.route('/api/users/<user_id>', methods=['PATCH'])
 @rate_limit(api_limiter)
-def update_node_presets(node_id):
-    """Update preset configurations on a node"""
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'presets', 'POST', request.json))
+def update_user(user_id):
+    """Set enabled and/or quota_bytes (monthly, 0 = unlimited)"""
+    if not USER_ID_PATTERN.match(user_id):
+        return jsonify({'error': 'Invalid user ID'}), 400
+    data = request.json or {}
+    fields = {}
+    if 'enabled' in data:
+        if not isinstance(data['enabled'], bool):
+            return jsonify({'error': 'enabled must be true or false'}), 400
+        fields.update(enabled=int(data['enabled']), disabled_reason='' if data['enabled'] else 'manual')
+    if 'quota_bytes' in data:
+        if not isinstance(data['quota_bytes'], int) or isinstance(data['quota_bytes'], bool) or data['quota_bytes'] < 0:
+            return jsonify({'error': 'quota_bytes must be a non-negative integer'}), 400
+        fields['quota_bytes'] = data['quota_bytes']
+    if not fields:
+        return jsonify({'error': 'Nothing to update'}), 400
+    before = user_registry.get(user_id)
+    user = user_registry.update(user_id, **fields)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    if before['enabled'] != user['enabled']:
+        user_sync.schedule()
+    return jsonify(user_info(user))
 
 
-@app.route('/api/nodes/<node_id>/subscribe')
+@app.route('/api/users/<user_id>/usage')
 @rate_limit(api_limiter)
-def node_subscribe(node_id):
-    """Get subscription links from a specific node"""
-    if not NODE_ID_PATTERN.match(node_id):
-        return jsonify({'error': 'Invalid node ID'}), 400
-    nodes = load_nodes()
-    if node_id not in nodes:
-        return jsonify({'error': 'Node not found'}), 404
-    return jsonify(call_node_api(nodes[node_id], 'subscribe'))
+def user_usage(user_id):
+    """Traffic totals per UTC day (default, last 31) or per month (?period=month)"""
+    if not USER_ID_PATTERN.match(user_id):
+        return jsonify({'error': 'Invalid user ID'}), 400
+    user = user_registry.get(user_id)
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    monthly = request.args.get('period') == 'month'
+    return jsonify({'user': user_id, 'period': 'month' if monthly else 'day', 'columns': ['period', 'up', 'down'],
+                    'usage': user_registry.usage(user_id, monthly, 12 if monthly else 31),
+                    'quota_bytes': user['quota_bytes'], 'enabled': user['enabled']})
 
 
-def fetch_node_subscription(node):
-    """Fetch subscription from a single node"""
-    try:
-        result = call_node_api(node, 'subscribe', timeout=5)
-        if 'links' in result:
-            links = []
-            for link_info in result['links']:
-                link_info['node_name'] = node['name']
-                link_info['node_domain'] = node['domain']
-                links.append(link_info)
-            return links
-    except Exception as e:
-        app.logger.error(f"Failed to fetch subscription from {node['domain']}: {e}")
-    return []
+@app.route('/api/users/<user_id>/token', methods=['POST'])
+@rate_limit(api_limiter)
+def rotate_user_token(user_id):
+    """New subscription token (the old URL stops working); credentials on nodes are unchanged"""
+    if not USER_ID_PATTERN.match(user_id):
+        return jsonify({'error': 'Invalid user ID'}), 400
+    user = user_registry.update(user_id, token=secrets.token_urlsafe(24))
+    if not user:
+        return jsonify({'error': 'User not found'}), 404
+    return jsonify(user_info(user))
 
 
-@app.route('/api/subscribe')
+@app.route('/api/users/sync', methods=['GET', 'POST'])
 @rate_limit(api_limiter)
-def subscribe():
-    """Generate aggregated subscription from all online nodes (with cache)"""
-    import base64
-    
-    format_type = request.args.get('format', 'base64')  # base64, clash, singbox
-    cache_key = f'subscription_{format_type}'
-    
-    # Try cache first
-    cached = subscription_cache.get(cache_key)
-    if cached:
-        if format_type == 'base64':
-            return Response(cached, mimetype='text/plain')
-        return jsonify(cached)
-    
-    # Fetch fresh data
-    nodes = load_nodes()
-    all_links = []
-    
-    # Fetch subscriptions from all online nodes concurrently
-    online_nodes = [node for node in nodes.values() if node.get('status') == 'online']
-    
-    if online_nodes:
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            futures = {executor.submit(fetch_node_subscription, node): node for node in online_nodes}
-            
-            for future in as_completed(futures, timeout=10):
-                try:
-                    node_links = future.result()
-                    all_links.extend(node_links)
-                except Exception as e:
-                    app.logger.error(f"Subscription fetch error: {e}")
-    
-    if format_type == 'base64':
-        # Return base64 encoded links
-        links_text = '\n'.join([l['link'] for l in all_links])
-        result = base64.b64encode(links_text.encode()).decode()
-        subscription_cache.set(cache_key, result)
-        return Response(result, mimetype='text/plain')
-    
-    elif format_type == 'clash':
-        # Return Clash format
-        proxies = []
-        for link_info in all_links:
-            proxy = {
-                'name': f"{link_info['node_name']}-{link_info['type']}",
-                'server': link_info['node_domain'],
-                'port': link_info['port']
-            }
-            if 'vless' in link_info['type']:
-                proxy['type'] = 'vless'
-                # Parse UUID from link
-                if link_info['link'].startswith('vless://'):
-                    proxy['uuid'] = link_info['link'].split('://')[1].split('@')[0]
-                proxy['tls'] = True
-                if 'vision' in link_info['type']:
-                    proxy['flow'] = 'xtls-rprx-vision'
-            elif 'vmess' in link_info['type']:
-                proxy['type'] = 'vmess'
-                # Decode vmess link
-                try:
-                    vmess_data = json.loads(base64.b64decode(link_info['link'].replace('vmess://', '')))
-                    proxy['uuid'] = vmess_data.get('id', '')
-                    proxy['alterId'] = int(vmess_data.get('aid', 0))
-                    proxy['network'] = vmess_data.get('net', 'tcp')
-                    if proxy['network'] == 'ws':
-                        proxy['ws-opts'] = {'path': vmess_data.get('path', '/')}
-                    proxy['tls'] = vmess_data.get('tls') == 'tls'
-                except:
+def sync_users():
+    """POST pushes the user set to all online nodes now; GET shows the last push"""
+    if request.method == 'GET':
+        return jsonify(user_sync.last)
+    return jsonify(user_sync.push())
+
+
+@app.route('/sub/<token>')
+@rate_limit(api_limiter)
+def user_subscribe(token):
+    """Per-user subscription, keyed by the user's token"""
+    user = user_registry.by_token(token) if USER_TOKEN_PATTERN.match(token) else None
+    if not user or not user['enabled']:
+        return jsonify({'error': 'Not found'}), 404
+    format_type = request.args.get('format', 'base64')
+    if format_type not in SUBSCRIPTION_FORMATS:
+        format_type = 'raw'
+    body, mimetype = user_subscriptions.get(user, format_type)
+    return Response(body, mimetype=mimetype)
+
+
+# ============================================================================
+# CONFIG TEMPLATES - node templates compiled once, rendered for many nodes
+# ============================================================================
+# Everything from here up to TemplateCatalog is kept identical to node/agent.py (tests/test_shared_code.bats)
+TEMPLATE_PLACEHOLDER = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\{\{\s*\.([A-Za-z_][A-Za-z0-9_]*)\s*\}\}')
+
+# Parameter types: values are checked before they reach a template (no quotes, braces or whitespace)
+TEMPLATE_PARAM_TYPES = {
+    'uuid': re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'),
+    'domain': re.compile(r'^[a-zA-Z0-9]([a-zA-Z0-9\-\.]{0,253}[a-zA-Z0-9])?$'),
+    'email': re.compile(r'^[^@\s"\\{}]+@[^@\s"\\{}]+$'),
+    'secret': re.compile(r'^[A-Za-z0-9._~+/=$-]{1,256}$'),
+    'name': re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$'),
+    'hex': re.compile(r'^[0-9a-f]{1,64}$'),
+    'port': None,  # integer 1-65535
+}
+
+# name -> (file under the agent's templates directory, json | text, {parameter: type})
+CONFIG_TEMPLATES = {
+    'singbox': ('singbox-config.json.template', 'json', {
+        'VLESS_UUID': 'uuid', 'NODE_DOMAIN': 'domain', 'ACME_EMAIL': 'email',
+        'GATEWAY_CONTAINER': 'name', 'HY2_PASSWORD': 'secret', 'CLASH_API_SECRET': 'secret',
+    }),
+    'caddy': ('Caddyfile.template', 'text', {
+        'MasterDomain': 'domain', 'NodeDomain': 'domain', 'PathPrefix': 'hex', 'AdGuardAdminPass': 'secret',
+    }),
+}
+
+
+def _clone(value):
+    if isinstance(value, dict):
+        return {k: _clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    return value
+
+
+class ConfigTemplate:
+    """One template compiled for repeated rendering.
+
+    Text templates become (literal, parameter) pairs joined per render. JSON
+    templates are parsed once into a tree of builders: subtrees without
+    placeholders are cloned, a string that is exactly one placeholder takes
+    the typed value (a port stays an integer) and other strings interpolate.
+    Rendering a JSON template returns the config as objects, ready for the
+    validator, with no escaping or re-parsing.
+    """
+
+    def __init__(self, name, source, kind, params):
+        self.name = name
+        self.kind = kind
+        self.params = params
+        self.source = source
+        self.hash = hashlib.sha256(source.encode()).hexdigest()[:16]
+        self.used = set()
+        if kind == 'json':
+            self.build = self._compile_value(json.loads(source))[0]
+        else:
+            self.build = self._compile_string(source)
+        unknown = self.used - set(params)
+        if unknown:
+            raise ValueError(f"{name}: undeclared placeholder(s) {', '.join(sorted(unknown))}")
+
+    def _placeholder(self, match):
+        name = match.group(1) or match.group(2)
+        self.used.add(name)
+        return name
+
+    def _compile_string(self, text):
+        """Builder for one string: constant, one typed placeholder, or literal/placeholder pairs"""
+        pairs, last = [], 0
+        for match in TEMPLATE_PLACEHOLDER.finditer(text):
+            pairs.append((text[last:match.start()], self._placeholder(match)))
+            last = match.end()
+        if not pairs:
+            return lambda values: text
+        tail = text[last:]
+        if len(pairs) == 1 and not pairs[0][0] and not tail:
+            name = pairs[0][1]
+            return lambda values: values[name]
+        return lambda values: ''.join([literal + str(values[name]) for literal, name in pairs]) + tail
+
+    def _compile_value(self, node):
+        """(builder, constant) for one JSON value"""
+        if isinstance(node, str):
+            build = self._compile_string(node)
+            return build, TEMPLATE_PLACEHOLDER.search(node) is None
+        if isinstance(node, dict):
+            items = [(self._compile_string(k), *self._compile_value(v)) for k, v in node.items()]
+            if all(constant for _, _, constant in items) and not TEMPLATE_PLACEHOLDER.search(''.join(node)):
+                return (lambda values: _clone(node)), True
+            return (lambda values: {key(values): value(values) for key, value, _ in items}), False
+        if isinstance(node, list):
+            items = [self._compile_value(v) for v in node]
+            if all(constant for _, constant in items):
+                return (lambda values: _clone(node)), True
+            return (lambda values: [item(values) for item, _ in items]), False
+        return (lambda values: node), True
+
+    def check(self, params):
+        """(typed values, errors) where errors is [{'param', 'message'}] covering every problem"""
+        values, errors = {}, []
+        for name in sorted(set(params) - set(self.params)):
+            errors.append({'param': name, 'message': 'unknown parameter'})
+        for name, kind in self.params.items():
+            if name not in params:
+                if name in self.used:
+                    errors.append({'param': name, 'message': f'required ({kind})'})
+                continue
+            value = params[name]
+            if kind == 'port':
+                if isinstance(value, str) and value.isdigit():
+                    value = int(value)
+                if not isinstance(value, int) or isinstance(value, bool) or not 1 <= value <= 65535:
+                    errors.append({'param': name, 'message': 'must be a port (1-65535)'})
                     continue
-            elif 'hysteria2' in link_info['type']:
-                proxy['type'] = 'hysteria2'
-                # Parse password from link
-                if link_info['link'].startswith('hysteria2://'):
-                    proxy['password'] = link_info['link'].split('://')[1].split('@')[0]
-                proxy['sni'] = link_info['node_domain']
-            proxies.append(proxy)
-        
-        clash_config = {
-            'proxies': proxies,
-            'proxy-groups': [{
-                'name': 'auto',
-                'type': 'url-test',
-                'proxies': [p['name'] for p in proxies],
-                'url': 'http://www.gstatic.com/generate_204',
-                'interval': 300
-            }]
+            elif not isinstance(value, str) or not TEMPLATE_PARAM_TYPES[kind].match(value):
+                errors.append({'param': name, 'message': f'must be a valid {kind}'})
+                continue
+            values[name] = value
+        return values, errors
+
+    def render(self, params):
+        """(output, errors): a dict for JSON templates, a string for text ones; output is None on errors"""
+        values, errors = self.check(params)
+        if errors:
+            return None, errors
+        return self.build(values), []
+
+
+class TemplateCatalog:
+    """Node config templates, compiled once per source.
+
+    Agents ship the templates in their image, so the sources come from one
+    online node (GET /api/v1/templates). A compiled template is reused while
+    its source hash is unchanged; after `ttl` the sources are refetched in the
+    background and the cached compiles keep serving if that fails.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.compiled = {}  # name -> ConfigTemplate
+        self.fetched = 0  # last refresh (or failed background attempt)
+        self.refreshing = False
+
+    def compile(self, name, source):
+        """ConfigTemplate for source, reusing the compiled one while the source is unchanged"""
+        _, kind, params = CONFIG_TEMPLATES[name]
+        digest = hashlib.sha256(source.encode()).hexdigest()[:16]
+        with self.lock:
+            template = self.compiled.get(name)
+            if template is not None and template.hash == digest:
+                return template
+        template = ConfigTemplate(name, source, kind, params)
+        with self.lock:
+            self.compiled[name] = template
+        return template
+
+    def refresh(self):
+        nodes = {k: v for k, v in load_nodes_with_health().items() if v.get('status') != 'offline'}
+        # Ask up to three nodes at once; the first in id order that answers wins
+        results, _ = node_client.fan_out(dict(sorted(nodes.items())[:3]),
+                                         lambda node_id, node: node_client.call(node, 'templates', timeout=10),
+                                         deadline=10)
+        templates = next((result['templates'] for _, result in sorted(results.items())
+                          if isinstance(result.get('templates'), dict)), None)
+        if templates is None:
+            raise LookupError('No online node returned its templates')
+        for name, info in templates.items():
+            if name in CONFIG_TEMPLATES and isinstance(info, dict) and isinstance(info.get('source'), str):
+                self.compile(name, info['source'])
+        self.fetched = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                self.fetched = time.monotonic()  # retried after another ttl
+                app.logger.warning(f'Template refresh failed, serving the cached compiles: {e}')
+            finally:
+                self.refreshing = False
+        threading.Thread(target=run, name='template-refresh', daemon=True).start()
+
+    def get(self, name):
+        """Compiled template (KeyError if unknown, LookupError if no node has it, ValueError if it is broken)"""
+        if name not in CONFIG_TEMPLATES:
+            raise KeyError(name)
+        if name not in self.compiled:
+            self.refresh()  # nothing to serve yet
+        elif time.monotonic() - self.fetched > self.ttl:
+            self._refresh_in_background()
+        if name not in self.compiled:
+            raise LookupError(f'No node provides the {name} template')
+        return self.compiled[name]
+
+
+template_catalog = TemplateCatalog(TEMPLATE_SOURCE_TTL)
+
+
+def template_defaults(nodes):
+    """Parameters known from the registry per node; request params and per-node overrides take precedence"""
+    shared = {'MasterDomain': os.environ.get('MASTER_DOMAIN') or request.host.split(':')[0],
+              'PathPrefix': get_hidden_path(CLUSTER_SECRET)}
+    return {node_id: {**shared, 'NODE_DOMAIN': node['domain'], 'NodeDomain': node['domain']}
+            for node_id, node in nodes.items()}
+
+
+def select_template_nodes(selection):
+    """(nodes, overrides, missing) for "all" | [node_id, ...] | {node_id: {...overrides}}; ValueError if malformed"""
+    overrides = selection if isinstance(selection, dict) else {}
+    nodes = load_nodes()
+    if selection == 'all':
+        selection = sorted(nodes)
+    elif not isinstance(selection, (list, dict)):
+        raise ValueError('nodes must be "all", a list of node IDs or an object of overrides')
+    for node_id in selection:
+        if not isinstance(node_id, str) or not NODE_ID_PATTERN.match(node_id):
+            raise ValueError(f'Invalid node ID: {node_id}')
+        if not isinstance(overrides.get(node_id, {}), dict):
+            raise ValueError(f'Overrides for {node_id} must be an object')
+    return ({node_id: nodes[node_id] for node_id in selection if node_id in nodes}, overrides,
+            [node_id for node_id in selection if node_id not in nodes])
+
+
+def render_for_nodes(template, nodes, params, overrides):
+    """node_id -> (output, errors); registry defaults < params < the node's overrides"""
+    rendered = {}
+    for node_id, defaults in template_defaults(nodes).items():
+        defaults = {k: v for k, v in defaults.items() if k in template.params}
+        rendered[node_id] = template.render({**defaults, **params, **overrides.get(node_id, {})})
+    return rendered
+
+
+@app.route('/api/templates/<name>/render', methods=['POST'])
+@rate_limit(api_limiter)
+def render_node_templates(name):
+    """Render a template for many nodes in one pass.
+
+    Body: {"params": {...shared}, "nodes": "all" | [node_id, ...] | {node_id: {...overrides}}}.
+    Node domains and the API path prefix come from the registry; per-node
+    secrets (VLESS_UUID, HY2_PASSWORD, ...) must be given as overrides.
+    sing-box output is structured JSON; the agent schema-checks it on apply.
+    """
+    data = request.get_json(silent=True) or {}
+    params = data.get('params', {})
+    if not isinstance(params, dict):
+        return jsonify({'error': 'params must be an object'}), 400
+    try:
+        nodes, overrides, missing = select_template_nodes(data.get('nodes', 'all'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        template = template_catalog.get(name)
+    except KeyError:
+        return jsonify({'error': f'Unknown template: {name}'}), 404
+    except (LookupError, ValueError) as e:
+        return jsonify({'error': str(e)}), 502
+
+    started = time.perf_counter()
+    output_key = 'config' if template.kind == 'json' else 'content'
+    results, failed = {}, 0
+    for node_id, (output, errors) in render_for_nodes(template, nodes, params, overrides).items():
+        if errors:
+            failed += 1
+            results[node_id] = {'success': False, 'errors': errors}
+        else:
+            results[node_id] = {'success': True, output_key: output}
+    return jsonify({
+        'template': name,
+        'hash': template.hash,
+        'nodes': results,
+        'missing': missing,
+        'rendered': len(results) - failed,
+        'failed': failed,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+    })
+
+
+# ============================================================================
+# CONFIG ROLLOUT - push a target config only where the node's hash differs
+# ============================================================================
+# Kept identical to config_digest in node/agent.py (tests/test_shared_code.bats)
+def config_digest(service, content):
+    """Content hash agent and master compare; sing-box JSON is hashed in canonical form so formatting does not count"""
+    if service == 'singbox':
+        try:
+            config = json.loads(content) if isinstance(content, str) else content
+            content = json.dumps(config, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        except json.JSONDecodeError:
+            pass
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def make_merge_patch(source, target):
+    """JSON merge patch (RFC 7386) turning source into target; lists and scalars are replaced whole"""
+    if not isinstance(source, dict) or not isinstance(target, dict):
+        return target
+    patch = {key: None for key in source.keys() - target.keys()}
+    for key, value in target.items():
+        if key not in source:
+            patch[key] = value
+        elif source[key] != value:
+            patch[key] = make_merge_patch(source[key], value)
+    return patch
+
+
+def _contains_null(value):
+    if value is None:
+        return True
+    if isinstance(value, dict):
+        return any(_contains_null(v) for v in value.values())
+    if isinstance(value, list):
+        return any(_contains_null(v) for v in value)
+    return False
+
+
+def merge_managed_users(config, users):
+    """Put the master-managed users into every vless/hysteria2 inbound, as the agent does on a user sync"""
+    for inbound in config.get('inbounds', []):
+        if inbound.get('type') not in USER_PROTOCOLS:
+            continue
+        field = 'uuid' if inbound['type'] == 'vless' else 'password'
+        current = inbound.get('users') or []
+        kept = [u for u in current if not str(u.get('name', '')).startswith(MANAGED_USER_PREFIX)]
+        flow = next((u['flow'] for u in current if 'flow' in u), None) if field == 'uuid' else None
+        inbound['users'] = kept + [{'name': u['name'], field: u[field], **({'flow': flow} if flow is not None else {})}
+                                   for u in users]
+    return config
+
+
+class ConfigBases:
+    """The sing-box config master last pushed to each node, kept in cache.db as the base for merge patches"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = connect_sqlite(self.path)
+            db.execute('CREATE TABLE IF NOT EXISTS config_bases ('
+                       'node_id TEXT NOT NULL, service TEXT NOT NULL, hash TEXT NOT NULL, content TEXT NOT NULL, '
+                       'PRIMARY KEY (node_id, service))')
+        return db
+
+    def get(self, node_id, service):
+        """(hash, content) or None"""
+        return self._db().execute('SELECT hash, content FROM config_bases WHERE node_id = ? AND service = ?',
+                                  (node_id, service)).fetchone()
+
+    def store(self, node_id, service, digest, content):
+        self._db().execute('INSERT OR REPLACE INTO config_bases (node_id, service, hash, content) VALUES (?, ?, ?, ?)',
+                           (node_id, service, digest, content))
+
+    def forget(self, node_id):
+        self._db().execute('DELETE FROM config_bases WHERE node_id = ?', (node_id,))
+
+
+config_bases = ConfigBases(CACHE_DB)
+
+
+class ConfigRollout:
+    """Push per-node target configs to the nodes whose content hash differs.
+
+    Every node is asked for its config hash first and left alone when it
+    already matches. The others get a merge patch when the node still holds
+    the sing-box config master last pushed there and the patch is smaller
+    than the file, otherwise the full content. At most `parallelism` nodes
+    are in flight; outcome, transfer size and timings per node go to the job.
+    """
+
+    SAVE_INTERVAL = 0.5  # per-node progress is written to the job at most this often
+
+    def __init__(self, service, nodes, targets, parallelism=16, apply=True, patch=True, dry_run=False, timeout=90):
+        self.service = service
+        self.nodes = nodes
+        self.targets = targets  # node_id -> config (dict for singbox, text otherwise)
+        self.parallelism = max(1, parallelism)
+        self.apply = apply and service == 'singbox'
+        self.patch = patch and service == 'singbox'
+        self.dry_run = dry_run
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.job_id = None
+        self.saved = 0
+        self.encoded = {}  # id(target) -> (hash, serialized content); "content" rollouts share one target
+        self.progress = {
+            'state': 'running',
+            'service': service,
+            'started_at': datetime.now().isoformat(),
+            'finished_at': None,
+            'settings': {'parallelism': self.parallelism, 'apply': self.apply, 'patch': self.patch,
+                         'dry_run': dry_run},
+            'nodes': {node_id: {'name': node['name'], 'state': 'pending'} for node_id, node in nodes.items()},
+            'counts': {'total': len(nodes), 'unchanged': 0, 'differs': 0, 'done': 0, 'failed': 0, 'skipped': 0},
+            'error': None
         }
-        # Cache and return
-        subscription_cache.set(cache_key, clash_config)
-        return jsonify(clash_config)
-    
-    elif format_type == 'singbox':
-        # Return sing-box outbound format
-        outbounds = []
-        for link_info in all_links:
-            tag = f"{link_info['node_name']}-{link_info['type']}"
-            outbound = {'tag': tag, 'server': link_info['node_domain'], 'server_port': link_info['port']}
-            
-            if 'vless' in link_info['type']:
-                outbound['type'] = 'vless'
-                if link_info['link'].startswith('vless://'):
-                    outbound['uuid'] = link_info['link'].split('://')[1].split('@')[0]
-                outbound['flow'] = 'xtls-rprx-vision'
-                outbound['tls'] = {
-                    'enabled': True,
-                    'server_name': link_info['node_domain']
-                }
-            elif 'vmess' in link_info['type']:
-                outbound['type'] = 'vmess'
+
+    def start(self):
+        """Job id of the started rollout, or None while another config rollout is running"""
+        self.job_id = job_store.create('config', self.progress, exclusive=True)
+        if self.job_id:
+            node_client.submit(self.run())
+        return self.job_id
+
+    def _set(self, node_id=None, **fields):
+        with self.lock:
+            if node_id:
+                self.progress['nodes'][node_id].update(fields)
+            else:
+                self.progress.update(fields)
+            states = [n['state'] for n in self.progress['nodes'].values()]
+            for key in ('unchanged', 'differs', 'done', 'failed', 'skipped'):
+                self.progress['counts'][key] = states.count(key)
+            # Hundreds of nodes finish within seconds; batch their progress, always write job-level changes
+            if node_id is None or time.monotonic() - self.saved >= self.SAVE_INTERVAL:
+                job_store.save(self.job_id, self.progress)
+                self.saved = time.monotonic()
+
+    async def _update(self, node_id=None, **fields):
+        await asyncio.to_thread(self._set, node_id, **fields)
+
+    def _encode(self, target):
+        key = id(target)
+        if key not in self.encoded:
+            self.encoded[key] = (config_digest(self.service, target),
+                                 json.dumps(target) if self.service == 'singbox' else target)
+        return self.encoded[key]
+
+    def _payload(self, node_id, target, current_hash):
+        """(mode, request body, size) for a push: a merge patch against the last pushed base, or the full content"""
+        full = self._encode(target)[1]
+        if self.patch and not _contains_null(target):
+            base = config_bases.get(node_id, self.service)
+            if base and base[0] == current_hash:
+                patch = make_merge_patch(json.loads(base[1]), target)
+                size = len(json.dumps(patch))
+                if size < len(full):
+                    return 'patch', {'patch': patch, 'base_hash': current_hash}, size
+        return 'full', {'content': full}, len(full)
+
+    async def sync_node(self, node_id):
+        node, target = self.nodes[node_id], self.targets[node_id]
+        started = time.monotonic()
+        digest, full = await asyncio.to_thread(self._encode, target)
+        current = await node_client.call(node, f'config/{self.service}?hash_only=1', timeout=15)
+        fields = {'hash': digest, 'check_ms': round((time.monotonic() - started) * 1000, 1)}
+        if not current.get('hash'):
+            return await self._update(node_id, state='failed', error=current.get('error') or 'no config hash', **fields)
+        if current['hash'] == digest:
+            return await self._update(node_id, state='unchanged', **fields)
+        if self.dry_run:
+            return await self._update(node_id, state='differs', current_hash=current['hash'], **fields)
+
+        await self._update(node_id, state='pushing', **fields)
+        mode, body, size = await asyncio.to_thread(self._payload, node_id, target, current['hash'])
+        result = await node_client.call(node, f'config/{self.service}', 'POST', {**body, 'apply': self.apply},
+                                        timeout=self.timeout)
+        if mode == 'patch' and 'base_hash' in result.get('error', ''):
+            mode, body, size = 'full', {'content': full}, len(full)  # the node changed under us
+            result = await node_client.call(node, f'config/{self.service}', 'POST', {**body, 'apply': self.apply},
+                                            timeout=self.timeout)
+        error = None if result.get('success') else (result.get('error') or 'push failed')[-500:]
+        if not error and result.get('hash') != digest:
+            error = 'node reports a different hash after the push'
+        if not error and self.service == 'singbox':
+            await asyncio.to_thread(config_bases.store, node_id, self.service, digest, full)
+        await self._update(node_id, state='failed' if error else 'done', error=error, mode=mode,
+                           bytes=size, rolled_back=result.get('rolled_back'),
+                           ms=round((time.monotonic() - started) * 1000, 1))
+
+    async def run(self):
+        reason = None
+        semaphore = asyncio.Semaphore(self.parallelism)
+
+        async def bounded(node_id):
+            nonlocal reason
+            async with semaphore:
+                if reason is None and await asyncio.to_thread(job_store.state, self.job_id) == 'aborting':
+                    reason = 'aborted by user'
+                if reason:
+                    return await self._update(node_id, state='skipped')
                 try:
-                    vmess_data = json.loads(base64.b64decode(link_info['link'].replace('vmess://', '')))
-                    outbound['uuid'] = vmess_data.get('id', '')
-                    if vmess_data.get('net') == 'ws':
-                        outbound['transport'] = {'type': 'ws', 'path': vmess_data.get('path', '/')}
-                    if vmess_data.get('tls') == 'tls':
-                        outbound['tls'] = {'enabled': True, 'server_name': link_info['node_domain']}
-                except:
-                    continue
-            elif 'hysteria2' in link_info['type']:
-                outbound['type'] = 'hysteria2'
-                if link_info['link'].startswith('hysteria2://'):
-                    outbound['password'] = link_info['link'].split('://')[1].split('@')[0]
-                outbound['tls'] = {'enabled': True, 'server_name': link_info['node_domain']}
-            
-            outbounds.append(outbound)
-        
-        singbox_config = {
-            'log': {'level': 'info'},
-            'outbounds': outbounds + [{'type': 'direct', 'tag': 'direct'}],
-            'route': {'final': outbounds[0]['tag'] if outbounds else 'direct'}
-        }
-        # Cache and return
-        subscription_cache.set(cache_key, singbox_config)
-        return jsonify(singbox_config)
-    
-    # Default: return raw links
-    subscription_cache.set(cache_key, {'links': all_links})
-    return jsonify({'links': all_links})
+                    await self.sync_node(node_id)
+                except Exception as e:
+                    await self._update(node_id, state='failed', error=str(e) or type(e).__name__)
 
+        heartbeat = asyncio.ensure_future(job_store.heartbeat(self.job_id))
+        try:
+            await asyncio.gather(*(bounded(node_id) for node_id in self.nodes))
+        except Exception as e:
+            reason = f'rollout crashed: {e}'
+        finally:
+            heartbeat.cancel()
+        await self._update(state='aborted' if reason else 'completed', error=reason,
+                           finished_at=datetime.now().isoformat())
 
-@app.route('/api/subscribe/url')
+
+def rollout_targets(service, data, template, nodes, overrides):
+    """(node_id -> target config, node_id -> render errors) from a template + {"params"} or one {"content"}"""
+    failed = {}
+    if template is not None:
+        if (template.kind == 'json') != (service == 'singbox'):
+            raise ValueError(f"Template {data['template']} does not produce a {service} config")
+        params = data.get('params', {})
+        if not isinstance(params, dict):
+            raise ValueError('params must be an object')
+        targets = {}
+        for node_id, (output, errors) in render_for_nodes(template, nodes, params, overrides).items():
+            if errors:
+                failed[node_id] = errors
+            targets[node_id] = output
+    else:
+        content = data.get('content')
+        if service == 'singbox' and isinstance(content, str):
+            content = json.loads(content)
+        if not isinstance(content, dict if service == 'singbox' else str):
+            raise ValueError('content (or template) is required')
+        targets = {node_id: content for node_id in nodes}
+    if service == 'singbox' and not failed:
+        # Managed users live in the node configs; carry them over or the rollout would drop them
+        users = user_registry.credentials()
+        for target in {id(t): t for t in targets.values()}.values():
+            merge_managed_users(target, users)
+    return targets, failed
+
+
+@app.route('/api/config/rollouts', methods=['GET', 'POST'])
 @rate_limit(api_limiter)
-def subscribe_url():
-    """Get subscription URL info"""
-    master_domain = os.environ.get('MASTER_DOMAIN', '')
-    # Try to get domain from request if not set in env
-    if not master_domain:
-        master_domain = request.host.split(':')[0]
-    hidden_path = get_hidden_path(CLUSTER_SECRET)
+def config_rollouts():
+    """POST starts a config rollout and returns its job; GET lists recent ones.
+
+    Body: {"service", "template" + "params" | "content", "nodes": "all" | [...] | {node_id: {...overrides}},
+    "parallelism", "apply", "patch", "dry_run"}. dry_run only compares hashes.
+    """
+    if request.method == 'GET':
+        return jsonify({'rollouts': job_store.recent('config')})
+    data = request.get_json(silent=True) or {}
+    template = None
+    if 'template' in data:
+        if not isinstance(data['template'], str) or data['template'] not in CONFIG_TEMPLATES:
+            return jsonify({'error': f"Unknown template: {data['template']}"}), 404
+        try:
+            template = template_catalog.get(data['template'])
+        except (LookupError, ValueError) as e:
+            return jsonify({'error': str(e)}), 502
+    try:
+        service = sanitize_service(data.get('service', 'singbox'))
+        nodes, overrides, missing = select_template_nodes(data.get('nodes', 'all'))
+        targets, failed = rollout_targets(service, data, template, nodes, overrides)
+        parallelism = int(data.get('parallelism', CONFIG_ROLLOUT_PARALLELISM))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    if failed:
+        return jsonify({'error': f'Render failed on {len(failed)} node(s)', 'nodes': failed}), 400
+    if not nodes:
+        return jsonify({'error': 'No nodes selected'}), 400
+    rollout = ConfigRollout(service, nodes, targets, min(parallelism, 100), data.get('apply', True) is not False,
+                            data.get('patch', True) is not False, bool(data.get('dry_run')), CONFIG_ROLLOUT_TIMEOUT)
+    rollout_id = rollout.start()
+    if rollout_id is None:
+        active = job_store.active('config')
+        return jsonify({'error': 'A config rollout is already running',
+                        'rollout': active[0]['id'] if active else None}), 409
+    return jsonify({'rollout_id': rollout_id, 'nodes': len(nodes), 'missing': missing,
+                    'status_url': f'/api/config/rollouts/{rollout_id}'}), 202
+
+
+@app.route('/api/config/rollouts/<rollout_id>')
+def config_rollout_status(rollout_id):
+    """Per-node outcome of a config rollout (not rate limited so the dashboard can poll it)"""
+    job = job_store.get(rollout_id)
+    if not job or 'service' not in job:
+        return jsonify({'error': 'Rollout not found'}), 404
+    return jsonify(job)
+
+
+@app.route('/api/config/rollouts/<rollout_id>/abort', methods=['POST'])
+@rate_limit(auth_limiter)
+def abort_config_rollout(rollout_id):
+    if not job_store.request_abort(rollout_id):
+        return jsonify({'error': 'Rollout not running'}), 409
+    return jsonify({'success': True})
+
+
+@app.route('/api/pool/stats')
+@rate_limit(api_limiter)
+def pool_stats():
+    """Connection reuse and handshake counters for master->node calls"""
+    return jsonify(node_client.pool_stats())
+
+
+METRICS_RANGE_PATTERN = re.compile(r'^(\d+)([smhd])$')
+METRICS_RANGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def metrics_window():
+    """(resolution, since, until) from ?since=&until= (epoch seconds or a span back from now such as 24h)"""
+    now = time.time()
+
+    def parse(name, default):
+        value = request.args.get(name)
+        if not value:
+            return default
+        match = METRICS_RANGE_PATTERN.match(value)
+        if match:
+            return now - int(match.group(1)) * METRICS_RANGE_UNITS[match.group(2)]
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f'{name} must be epoch seconds or a span like 24h')
+
+    since, until = parse('since', now - 86400), min(parse('until', now), now)
+    if since >= until:
+        raise ValueError('since must be before until')
+    resolution = request.args.get('resolution', 'auto')
+    if resolution == 'auto':
+        resolution = fleet_series.pick_resolution(since, until)
+    elif resolution not in fleet_series.offsets:
+        raise ValueError(f'resolution must be auto or one of {", ".join(fleet_series.offsets)}')
+    return resolution, since, until
+
+
+def metrics_response(resolution, points, **extra):
     return jsonify({
-        'base64': f"https://{master_domain}/{hidden_path}/sub",
-        'clash': f"https://{master_domain}/{hidden_path}/sub?format=clash",
-        'singbox': f"https://{master_domain}/{hidden_path}/sub?format=singbox",
-        'public_base64': f"https://{master_domain}/api/subscribe",
-        'public_clash': f"https://{master_domain}/api/subscribe?format=clash",
-        'public_singbox': f"https://{master_domain}/api/subscribe?format=singbox"
+        'resolution': resolution,
+        'step': fleet_series.offsets[resolution][1],
+        'columns': fleet_series.COLUMNS,
+        'points': points,
+        **extra
     })
 
 
-# Hidden subscription endpoint (more secure)
-@app.route(f'/<path:hidden>/sub')
+@app.route('/api/metrics/nodes/<node_id>')
 @rate_limit(api_limiter)
-def hidden_subscribe(hidden):
-    """Hidden subscription endpoint"""
-    if hidden != get_hidden_path(CLUSTER_SECRET):
-        return jsonify({'error': 'Not found'}), 404
-    return subscribe()
+def node_metrics(node_id):
+    """History of one node: availability, RTT, traffic and connections per bucket"""
+    if not NODE_ID_PATTERN.match(node_id):
+        return jsonify({'error': 'Invalid node ID'}), 400
+    if not node_registry.get(node_id):
+        return jsonify({'error': 'Node not found'}), 404
+    try:
+        resolution, since, until = metrics_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return metrics_response(resolution, fleet_series.query(node_id, resolution, since, until), node=node_id)
+
+
+@app.route('/api/metrics/fleet')
+@rate_limit(api_limiter)
+def fleet_metrics():
+    """History summed over the selected nodes (?nodes=a,b or all)"""
+    try:
+        nodes, missing = select_nodes()
+        resolution, since, until = metrics_window()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return metrics_response(resolution, fleet_series.query_fleet(nodes, resolution, since, until),
+                            nodes=sorted(nodes), missing=missing)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition summed over all workers"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/health')
@@ -711,5 +4213,172 @@ def health():
     return jsonify({'status': 'healthy', 'version': VERSION})
 
 
+def benchmark_render(links=10000):
+    """Parse a generated subscription once and time every output format"""
+    reality = f"security=reality&sni=www.example.com&fp=chrome&pbk={'A' * 43}&sid=0123abcd"
+    makers = [
+        ('VLESS-Vision', 443, lambda i: f'vless://{uuid_lib.UUID(int=i)}@n{i}.example.com:443'
+                                        f'?encryption=none&flow=xtls-rprx-vision&{reality}&type=tcp#vless-{i}'),
+        ('VMess-WS', 443, lambda i: 'vmess://' + base64.b64encode(json.dumps({
+            'v': '2', 'ps': f'vmess-{i}', 'add': f'n{i}.example.com', 'port': '443', 'id': str(uuid_lib.UUID(int=i)),
+            'aid': '0', 'scy': 'auto', 'net': 'ws', 'path': '/ws', 'host': f'n{i}.example.com', 'tls': 'tls',
+        }).encode()).decode()),
+        ('Hysteria2', 50000, lambda i: f'hysteria2://secret{i}@n{i}.example.com:50000'
+                                       f'?sni=n{i}.example.com&alpn=h3&obfs=salamander&obfs-password=o{i}#hy2-{i}'),
+        ('Trojan-gRPC', 443, lambda i: f'trojan://secret{i}@n{i}.example.com:443'
+                                       f'?security=tls&type=grpc&serviceName=grpc#trojan-{i}'),
+        ('Shadowsocks', 8388, lambda i: 'ss://' + base64.urlsafe_b64encode(f'aes-256-gcm:secret{i}'.encode()).decode()
+                                        + f'@n{i}.example.com:8388#ss-{i}'),
+    ]
+    all_links = []
+    for i in range(links):
+        label, port, make = makers[i % len(makers)]
+        all_links.append({'type': label, 'link': make(i), 'port': port,
+                          'node_name': f'node{i // len(makers)}', 'node_domain': f'n{i}.example.com'})
+    entries = parse_subscription_links(all_links)
+    print(f'{len(all_links)} links, {len(entries)} parsed, {len(makers)} protocols')
+    cases = [('parse', lambda: parse_subscription_links(all_links))]
+    cases += [(format_type, lambda format_type=format_type: render_subscription(format_type, entries))
+              for format_type in sorted(SUBSCRIPTION_FORMATS)]
+    for label, fn in cases:
+        samples = []
+        for _ in range(5):
+            started = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - started)
+        size = len(render_subscription(label, entries)[0]) if label in SUBSCRIPTION_FORMATS else 0
+        print(f'{label:<8} {sorted(samples)[2] * 1000:8.1f} ms' + (f'   {size / 1e6:5.1f} MB' if size else ''))
+
+
+def benchmark_fanout(rounds=5, sizes=(10, 100, 1000)):
+    """Fan a status call out to local stub agents, one listener per node, and report throughput"""
+    import resource
+    from concurrent.futures import ThreadPoolExecutor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))  # listeners plus both ends of every connection
+    body = json.dumps({'status': 'running', 'services': {'singbox': 'running', 'caddy': 'running'}}).encode()
+    reply = b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+
+    async def stub_agent(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = re.search(rb'(?i)\r\ncontent-length:\s*(\d+)', head)
+                if length:
+                    await reader.readexactly(int(length.group(1)))
+                writer.write(reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def listen(count):
+        return [await asyncio.start_server(stub_agent, '127.0.0.1', 0) for _ in range(count)]
+
+    stub_loop = asyncio.new_event_loop()
+    threading.Thread(target=stub_loop.run_forever, name='stub-agents', daemon=True).start()
+    servers = asyncio.run_coroutine_threadsafe(listen(max(sizes)), stub_loop).result()
+    stubs = {f'{i:08x}': {'name': f'stub{i}', 'domain': f"127.0.0.1:{server.sockets[0].getsockname()[1]}", 'https': False}
+             for i, server in enumerate(servers)}
+    client = NodeClient(max_nodes=max(sizes))
+    session = requests.Session()
+
+    def asyncio_round(nodes):
+        results, _ = client.fan_out(nodes, lambda node_id, node: client.call(node, 'status', timeout=10), deadline=30)
+        return sum('error' in result for result in results.values())
+
+    def threads_round(nodes):
+        # The former subscribe() fan-out: blocking requests on ten threads
+        def status(node):
+            try:
+                return session.get(f'{get_node_api_url(node)}/status', headers={'X-SUI-Token': CLUSTER_SECRET},
+                                   timeout=10).json()
+            except (requests.RequestException, ValueError) as e:
+                return {'error': str(e)}
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            return sum('error' in result for result in pool.map(status, nodes.values()))
+
+    print(f'{rounds} rounds per size, stub agents on 127.0.0.1 (open files limit {hard})')
+    for size in sizes:
+        nodes = dict(list(stubs.items())[:size])
+        line = f'{size:>5} nodes'
+        for label, fn in (('asyncio', asyncio_round), ('threads(10)', threads_round)):
+            samples, errors = [], 0
+            for _ in range(rounds):
+                started = time.perf_counter()
+                errors += fn(nodes)
+                samples.append(time.perf_counter() - started)
+            warm = sorted(samples[1:] or samples)[len(samples[1:] or samples) // 2]
+            line += (f'   {label} cold {samples[0] * 1000:7.1f} ms, warm {warm * 1000:7.1f} ms'
+                     f' ({size / warm:8.0f} calls/s, {errors} errors)')
+        print(line)
+    print(f"asyncio connections: {client.stats['new_connections']} new, {client.stats['reused_connections']} reused")
+
+
+def benchmark_ratelimit(requests_count=200000):
+    """Adversarial scan: every request from a new address, with one abusive client mixed in"""
+    import tracemalloc
+    addresses = [f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(requests_count)]
+    hot, every = '203.0.113.7', 50
+
+    def former_limiter():
+        # The list-of-timestamps limiter RateLimiter replaced
+        seen = defaultdict(list)
+
+        def is_allowed(client_ip):
+            now = time.time()
+            seen[client_ip] = [t for t in seen[client_ip] if now - t < 60]
+            if len(seen[client_ip]) >= 30:
+                return False
+            seen[client_ip].append(now)
+            return True
+        return is_allowed, 0
+
+    def slot_table(name=None):
+        limiter = RateLimiter(max_requests=30, window_seconds=60, name=name)
+        return limiter.is_allowed, limiter.slots * limiter.SLOT.size
+
+    shared_name = f'bench-{os.getpid()}'
+    cases = [('list per ip', former_limiter), ('slot table', slot_table)]
+    if RATE_LIMIT_DIR:
+        cases.append(('shared mmap', lambda: slot_table(shared_name)))
+    print(f'{requests_count} requests from distinct addresses, every {every}th from one client (limit 30/min)')
+    try:
+        for label, make in cases:
+            is_allowed, table = make()
+            hot_allowed = 0
+            started = time.perf_counter()
+            for i, address in enumerate(addresses):
+                is_allowed(address)
+                if i % every == 0:
+                    hot_allowed += is_allowed(hot)
+            elapsed = time.perf_counter() - started
+            calls = requests_count + requests_count // every + 1
+            tracemalloc.start()
+            is_allowed, _ = make()
+            for address in addresses:
+                is_allowed(address)
+            heap = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f'{label:<12} {elapsed / calls * 1e9:7.0f} ns/call   heap {heap / 1e6:6.1f} MB   '
+                  f'table {table / 1e6:4.1f} MB   abusive client allowed {hot_allowed}')
+    finally:
+        if RATE_LIMIT_DIR:
+            try:
+                os.unlink(os.path.join(RATE_LIMIT_DIR, RATE_LIMIT_FILE.format(shared_name)))
+            except FileNotFoundError:
+                pass
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['bench-render']:
+        benchmark_render(*(int(arg) for arg in sys.argv[2:3]))
+        sys.exit(0)
+    if sys.argv[1:2] == ['bench-fanout']:
+        benchmark_fanout(*(int(arg) for arg in sys.argv[2:3]))
+        sys.exit(0)
+    if sys.argv[1:2] == ['bench-ratelimit']:
+        benchmark_ratelimit(*(int(arg) for arg in sys.argv[2:3]))
+        sys.exit(0)
     app.run(host='0.0.0.0', port=5000)
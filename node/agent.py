@@ -3,14 +3,33 @@
 
 import os
 import re
+import sys
+import mmap
+import random
+import fcntl
+import struct
+import bisect
 import hashlib
+import ipaddress
+import sqlite3
+import calendar
+import tempfile
+import threading
+import select
+import shutil
+import socket
 import subprocess
+import http.client
 import time
 import uuid as uuid_lib
 import json
-from collections import defaultdict
-from functools import wraps
-from flask import Flask, request, jsonify
+import urllib.request
+from urllib.parse import quote, urlencode, urlsplit
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import Flask, Response, request, jsonify, stream_with_context
 
 app = Flask(__name__)
 
@@ -19,26 +38,174 @@ NODE_DOMAIN = os.environ.get('NODE_DOMAIN', '')
 CONFIG_DIR = os.environ.get('CONFIG_DIR', '/config')
 SALT = "SUI_Solo_Secured_2025"
 
+# Docker Engine API (the agent needs the docker socket mounted)
+DOCKER_SOCKET = os.environ.get('DOCKER_SOCKET', '/var/run/docker.sock')
+DOCKER_API_TIMEOUT = int(os.environ.get('DOCKER_API_TIMEOUT', '30'))
 
-class RateLimiter:
-    def __init__(self, max_requests=10, window_seconds=60):
-        self.max_requests, self.window_seconds = max_requests, window_seconds
-        self.requests, self.blocked_until = defaultdict(list), defaultdict(float)
+# sing-box config apply (signal = SIGHUP reload in place, restart = container restart)
+SINGBOX_RELOAD_MODE = os.environ.get('SINGBOX_RELOAD_MODE', 'signal')
+SINGBOX_CONTAINER_CONFIG_DIR = os.environ.get('SINGBOX_CONTAINER_CONFIG_DIR', '/etc/sing-box')
+SINGBOX_APPLY_SETTLE = float(os.environ.get('SINGBOX_APPLY_SETTLE', '2'))
+SINGBOX_APPLY_HEALTH_TIMEOUT = float(os.environ.get('SINGBOX_APPLY_HEALTH_TIMEOUT', '10'))
 
-    def is_allowed(self, ip):
-        now = time.time()
-        if now < self.blocked_until[ip]:
-            return False
-        self.requests[ip] = [t for t in self.requests[ip] if now - t < self.window_seconds]
-        if len(self.requests[ip]) >= self.max_requests:
-            self.blocked_until[ip] = now + self.window_seconds * 2
-            return False
-        self.requests[ip].append(now)
-        return True
+# Config templates shipped with the agent (singbox-config.json.template, Caddyfile.template)
+TEMPLATES_DIR = os.environ.get('TEMPLATES_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+
+# Users pushed by master carry this name prefix; other users in the config are left alone
+MANAGED_USER_PREFIX = 'sui-'
+
+# Diagnostics (checks run concurrently; the response waits at most DEADLINE seconds)
+DIAGNOSTICS_DEADLINE = float(os.environ.get('DIAGNOSTICS_DEADLINE', '3'))
+DIAGNOSTICS_PROBE = os.environ.get('DIAGNOSTICS_PROBE', '8.8.8.8:53')
+
+# Container state changes pushed to the master (e.g. https://master.example.com/api/nodes/events; empty disables)
+MASTER_EVENTS_URL = os.environ.get('MASTER_EVENTS_URL', '')
+EVENTS_PUSH_DELAY = float(os.environ.get('EVENTS_PUSH_DELAY', '1'))
+EVENTS_QUEUE_MAX = int(os.environ.get('EVENTS_QUEUE_MAX', '1000'))
+
+# Log streaming (follow streams end after MAX_SECONDS; clients resume with since=)
+LOG_STREAM_MAX_SECONDS = int(os.environ.get('LOG_STREAM_MAX_SECONDS', '300'))
+LOG_STREAM_HEARTBEAT = int(os.environ.get('LOG_STREAM_HEARTBEAT', '15'))
+LOG_SINCE_PATTERN = re.compile(r'^[0-9][0-9TZ:.+\-]{0,39}$')
 
+# Log collector (ring buffer of parsed records per service; 0 records disables it)
+STATE_DIR = os.environ.get('STATE_DIR', os.path.join(CONFIG_DIR, 'state'))
+LOG_DB = os.path.join(STATE_DIR, 'logs.db')
+LOG_BUFFER_MAX_RECORDS = int(os.environ.get('LOG_BUFFER_MAX_RECORDS', '200000'))
+LOG_COLLECT_INTERVAL = float(os.environ.get('LOG_COLLECT_INTERVAL', '1'))
 
-auth_limiter = RateLimiter(5, 60)
-api_limiter = RateLimiter(20, 60)
+# Traffic stats sampled from the sing-box clash API (interval 0 disables sampling)
+SINGBOX_API_URL = os.environ.get('SINGBOX_API_URL', 'http://sui-singbox:9090')
+SINGBOX_API_SECRET = os.environ.get('SINGBOX_API_SECRET', '')
+STATS_SAMPLE_INTERVAL = int(os.environ.get('STATS_SAMPLE_INTERVAL', '10'))
+STATS_MAX_SERIES = int(os.environ.get('STATS_MAX_SERIES', '256'))
+# Where connection counters come from: clash (the sing-box clash API) or stub (synthetic traffic for tests)
+STATS_SOURCE = os.environ.get('STATS_SOURCE', 'clash')
+
+# Per-user traffic shipped to the master (e.g. https://master.example.com/api/nodes/usage; empty disables)
+MASTER_USAGE_URL = os.environ.get('MASTER_USAGE_URL', '')
+USAGE_PUSH_INTERVAL = float(os.environ.get('USAGE_PUSH_INTERVAL', '60'))
+
+# Per-boot state shared by the gunicorn workers (tmpfs when available)
+RUNTIME_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Rate limiting (slot table shared by all workers through RATE_LIMIT_DIR; empty = per process)
+RATE_LIMIT_SLOTS = int(os.environ.get('RATE_LIMIT_SLOTS', '4096'))
+RATE_LIMIT_DIR = os.environ.get('RATE_LIMIT_DIR', RUNTIME_DIR)
+RATE_LIMIT_FILE = 'sui-agent-ratelimit-{}.bin'
+
+# Metrics (each worker publishes its totals to METRICS_DIR for the metrics endpoint)
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(RUNTIME_DIR, 'sui-agent-metrics'))
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+
+# Kept identical to RateLimiter in master/app.py (tests/test_shared_code.bats)
+class RateLimiter:
+    """Sliding-window counter per client in a fixed-size slot table.
+
+    Each key costs one 32-byte slot (current and previous window counts), so
+    memory is bounded by RATE_LIMIT_SLOTS no matter how many addresses show up;
+    when a key's probe run is full the least recently seen, least busy slot is reused.
+    With a state directory the table lives in a shared mmap guarded by flock,
+    so every gunicorn worker enforces the same limit.
+    """
+
+    SLOT = struct.Struct('<QqIId')  # key hash, window index, current, previous, blocked until
+    PROBE = 8
+
+    def __init__(self, max_requests=10, window_seconds=60, name=None, slots=RATE_LIMIT_SLOTS, block_seconds=0):
+        self.name = name
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.block_seconds = block_seconds
+        self.slots = max(slots, self.PROBE)
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._fd = None
+        size = self.slots * self.SLOT.size
+        path = os.path.join(RATE_LIMIT_DIR, RATE_LIMIT_FILE.format(name)) if name and RATE_LIMIT_DIR else None
+        if path:
+            try:
+                self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(self._fd).st_size != size:
+                        os.ftruncate(self._fd, 0)
+                        os.ftruncate(self._fd, size)
+                finally:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                self._table = mmap.mmap(self._fd, size)
+            except OSError as e:
+                app.logger.warning(f'Rate limiter {name}: shared state unavailable ({e}), using per-process table')
+                if self._fd is not None:
+                    os.close(self._fd)
+                self._fd = None
+        if self._fd is None:
+            self._table = mmap.mmap(-1, size)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+
+    def _find(self, h):
+        """Slot offset for h: its own slot, else an empty one, else the stalest in the probe run.
+
+        Among slots last seen in the same window the one with the fewest requests
+        goes, so a scan from many addresses cannot evict (and reset) a busy client.
+        """
+        unpack, size = self.SLOT.unpack_from, self.SLOT.size
+        start = h % self.slots
+        victim, victim_rank = None, None
+        for i in range(self.PROBE):
+            offset = ((start + i) % self.slots) * size
+            key, window, current, _, _ = unpack(self._table, offset)
+            if key == h:
+                return offset, True
+            if key == 0:
+                return offset, False
+            if victim is None or (window, current) < victim_rank:
+                victim, victim_rank = offset, (window, current)
+        return victim, False
+
+    def is_allowed(self, client_ip, consume=True):
+        """Count a request from client_ip; with consume=False only report whether it would pass."""
+        h = self._hash(client_ip)
+        now = time.time()
+        window, position = divmod(now, self.window_seconds)
+        window = int(window)
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, found = self._find(h)
+                current = previous = 0
+                blocked_until = 0.0
+                if found:
+                    _, last, current, previous, blocked_until = self.SLOT.unpack_from(self._table, offset)
+                    if last != window:
+                        previous = current if last == window - 1 else 0
+                        current = 0
+                if now < blocked_until:
+                    allowed = False
+                else:
+                    estimate = previous * (1 - position / self.window_seconds) + current
+                    allowed = estimate < self.max_requests
+                    if not allowed and consume and self.block_seconds:
+                        blocked_until = now + self.block_seconds
+                if allowed and consume:
+                    current += 1
+                if consume or found:
+                    self.SLOT.pack_into(self._table, offset, h, window, current, previous, blocked_until)
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if not allowed:
+            self.rejected += 1
+        return allowed
+
+
+auth_limiter = RateLimiter(5, 60, name='auth', block_seconds=120)
+api_limiter = RateLimiter(20, 60, name='api', block_seconds=120)
 
 
 def get_client_ip():
@@ -57,79 +224,1297 @@ def rate_limit(limiter):
     return decorator
 
 
+# ============================================================================
+# METRICS - Prometheus text exposition, summed over threads and workers
+# ============================================================================
+# Kept identical to Metrics in master/app.py (tests/test_shared_code.bats)
+class Metrics:
+    """Counters and histograms with one shard per recording thread.
+
+    A thread only ever writes its own shard (a plain dict), so recording is a
+    dict update without locks; the shard list itself is locked once per new
+    thread. Each worker periodically writes its merged totals to METRICS_DIR
+    and render() sums every live worker's snapshot, so any worker can answer a
+    scrape for the whole service. Collectors add counters that components
+    already keep (cache stats, pool stats) at snapshot time.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, prefix, directory):
+        self.prefix = prefix
+        self.directory = directory
+        self.families = {}  # name -> (type, help, label names, buckets)
+        self.collectors = []
+        self.shards = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def counter(self, name, help_text, labels=()):
+        self.families[name] = ('counter', help_text, tuple(labels), None)
+
+    def histogram(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.families[name] = ('histogram', help_text, tuple(labels), tuple(buckets))
+
+    def collector(self, fn):
+        """fn() -> iterable of (counter name, label values, value); families must be declared"""
+        self.collectors.append(fn)
+        return fn
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        key = (name, labels)
+        slot = shard.get(key)
+        if slot is None:
+            slot = shard[key] = [0] * (len(self.families[name][3]) + 3)  # buckets, +Inf, sum, count
+        slot[bisect.bisect_left(self.families[name][3], value)] += 1
+        slot[-2] += value
+        slot[-1] += 1
+
+    def snapshot(self):
+        """This worker's totals as {'name\\x1flabel...': value or bucket list}"""
+        totals = {}
+        with self.lock:
+            shards = list(self.shards)
+        for shard in shards:
+            while True:
+                try:
+                    items = list(shard.items())
+                    break
+                except RuntimeError:
+                    continue  # resized by its owner thread mid-copy
+            for (name, labels), value in items:
+                _merge_metric(totals, '\x1f'.join((name, *labels)), value)
+        for fn in self.collectors:
+            try:
+                for name, labels, value in fn():
+                    _merge_metric(totals, '\x1f'.join((name, *labels)), value)
+            except Exception as e:
+                app.logger.warning(f'Metrics collector {fn.__name__} failed: {e}')
+        return totals
+
+    def flush(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f'{path}.tmp', path)
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.warning(f'Metrics flush failed: {e}')
+
+    def render(self):
+        totals = self.snapshot()
+        for entry in (os.listdir(self.directory) if os.path.isdir(self.directory) else []):
+            pid = entry.partition('.')[0]
+            if not entry.endswith('.json') or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                os.unlink(os.path.join(self.directory, entry))  # worker is gone
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(os.path.join(self.directory, entry)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # being replaced or just removed
+            for key, value in snapshot.items():
+                _merge_metric(totals, key, value)
+
+        series = defaultdict(list)
+        for key, value in totals.items():
+            name, *labels = key.split('\x1f')
+            series[name].append((tuple(labels), value))
+        out = []
+        for name, (kind, help_text, label_names, buckets) in self.families.items():
+            full = f'{self.prefix}_{name}'
+            out.append(f'# HELP {full} {help_text}')
+            out.append(f'# TYPE {full} {kind}')
+            for labels, value in sorted(series.get(name, [])):
+                pairs = [f'{k}="{_escape_label(v)}"' for k, v in zip(label_names, labels)]
+                if kind == 'counter':
+                    out.append(f'{full}{_label_set(pairs)} {value:g}')
+                    continue
+                cumulative = 0
+                for bound, count in zip((*buckets, '+Inf'), value):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    out.append(f'{full}_bucket{_label_set(pairs + [le])} {cumulative}')
+                out.append(f'{full}_sum{_label_set(pairs)} {value[-2]:g}')
+                out.append(f'{full}_count{_label_set(pairs)} {value[-1]}')
+        return '\n'.join(out) + '\n'
+
+
+def _merge_metric(totals, key, value):
+    if isinstance(value, list):
+        current = totals.get(key)
+        totals[key] = [a + b for a, b in zip(current, value)] if current else list(value)
+    else:
+        totals[key] = totals.get(key, 0) + value
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_set(pairs):
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+metrics = Metrics('sui_agent', METRICS_DIR)
+metrics.histogram('http_request_duration_seconds', 'Time to response headers per route', ('method', 'route', 'status'))
+metrics.histogram('subprocess_duration_seconds', 'Duration of allowed commands run by the agent', ('command',))
+metrics.counter('subprocess_failures_total', 'Allowed commands that failed or timed out', ('command',))
+metrics.histogram('docker_api_duration_seconds', 'Docker Engine API calls by operation', ('operation',))
+metrics.counter('docker_api_failures_total', 'Docker Engine API calls that failed', ('operation',))
+metrics.counter('rate_limit_rejections_total', 'Requests rejected by a rate limiter', ('limiter',))
+metrics.counter('log_collector_records_total', 'Container log lines handled by the collector', ('event',))
+metrics.histogram('config_apply_duration_seconds', 'sing-box config applies by outcome', ('result',),
+                  buckets=(0.5, 1, 2.5, 5, 10, 15, 20, 30, 60))
+metrics.histogram('diagnostics_check_duration_seconds', 'Time taken by each diagnostics check', ('check',))
+metrics.counter('container_events_total', 'Docker events seen, state changes and pushes to the master', ('event',))
+metrics.counter('usage_push_total', 'Per-user traffic batches shipped to the master', ('event',))
+
+
+@app.before_request
+def start_request_timer():
+    request.environ['sui.started'] = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = request.environ.get('sui.started')
+    if started is not None:
+        # Never expose the secret-derived path prefix in labels
+        route = request.url_rule.rule.replace(f'/{PATH_PREFIX}', '') if request.url_rule else 'unmatched'
+        metrics.observe('http_request_duration_seconds', (request.method, route, str(response.status_code)),
+                        time.perf_counter() - started)
+    return response
+
+
 def sanitize_service(s):
     if s not in {'singbox', 'adguard', 'caddy'}:
         raise ValueError(f'Invalid service: {s}')
     return s
 
 
+# Kept identical to LeaderLock in master/app.py (tests/test_shared_code.bats)
+class LeaderLock:
+    """Non-blocking flock that elects one worker for a background loop; held until the worker exits"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+
+    def acquire(self):
+        """True once this worker holds the lock; cheap enough to call on every iteration"""
+        if self.lock_file:
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock_file = open(self.path, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+
+# ============================================================================
+# CONFIG SCHEMA - sing-box validator compiled once from a declarative schema
+# ============================================================================
+class SchemaContext:
+    """Errors plus the tags defined and referenced during one validation pass"""
+
+    def __init__(self, max_errors):
+        self.errors = []
+        self.error_count = 0
+        self.max_errors = max_errors
+        self.tags = defaultdict(dict)  # namespace -> {tag: path}
+        self.refs = []  # (namespace, tag, path)
+
+    def error(self, path, message):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'path': format_path(path), 'message': message})
+
+
+def format_path(path):
+    """Path chain (parent, key) -> JSON path such as $.inbounds[0].users[3].uuid"""
+    keys = []
+    while path is not None:
+        path, key = path
+        keys.append(key)
+    return '$' + ''.join(f'[{k}]' if isinstance(k, int) else f'.{k}' for k in reversed(keys))
+
+
+_JSON_TYPES = {'object': {dict}, 'array': {list}, 'string': {str}, 'integer': {int},
+               'number': {int, float}, 'boolean': {bool}, 'any': None}
+
+
+def compile_schema(node):
+    """Schema node -> rule (accepted classes or None for any, type error message, extra check or None).
+
+    Values come straight from json.loads, so a type check is one set lookup
+    on the exact class (which also keeps bools out of integers). Paths are
+    (parent, key) chains that are only formatted when an error is reported,
+    and leaves that need no more than a type check cost their parent that
+    one lookup.
+
+    Keywords: type (name or list), listable (a value or a list of values),
+    enum, min, max, pattern, properties, required, discriminator + variants
+    (+ default_variant when the discriminator may be omitted), items, min_items, tag / ref (cross-reference namespaces), check (fn).
+    """
+    kinds = node.get('type', 'any')
+    kinds = (kinds,) if isinstance(kinds, str) else tuple(kinds)
+    types = None if 'any' in kinds else frozenset().union(*(_JSON_TYPES[kind] for kind in kinds))
+    message = f"must be {' or '.join(kinds)}"
+    extras = []
+
+    if 'enum' in node:
+        allowed = frozenset(node['enum'])
+        enum_message = f"must be one of: {', '.join(sorted(map(repr, allowed)))}"
+
+        def check_enum(value, path, ctx):
+            if value not in allowed:
+                ctx.error(path, enum_message)
+        extras.append(check_enum)
+    if 'min' in node or 'max' in node:
+        low, high = node.get('min', float('-inf')), node.get('max', float('inf'))
+        range_message = f"must be between {node.get('min', '-inf')} and {node.get('max', 'inf')}"
+
+        def check_range(value, path, ctx):
+            if not low <= value <= high:
+                ctx.error(path, range_message)
+        extras.append(check_range)
+    if 'pattern' in node:
+        match = re.compile(node['pattern']).match
+        pattern_message = node.get('pattern_message', f"must match {node['pattern']}")
+
+        def check_pattern(value, path, ctx):
+            if not match(value):
+                ctx.error(path, pattern_message)
+        extras.append(check_pattern)
+    if 'properties' in node or 'variants' in node:
+        extras.append(_compile_object(node))
+    if 'items' in node:
+        item_rule = compile_schema(node['items'])
+        min_items = node.get('min_items', 0)
+
+        def check_items(value, path, ctx):
+            if len(value) < min_items:
+                ctx.error(path, f'must have at least {min_items} item(s)')
+            item_types, item_message, item_extra = item_rule
+            for i, item in enumerate(value):
+                if item_types is not None and item.__class__ not in item_types:
+                    ctx.error((path, i), item_message)
+                elif item_extra is not None:
+                    item_extra(item, (path, i), ctx)
+        extras.append(check_items)
+    if 'tag' in node:
+        namespace = node['tag']
+
+        def collect_tag(value, path, ctx):
+            seen = ctx.tags[namespace]
+            if value in seen:
+                ctx.error(path, f'duplicate {namespace} tag {value!r} (also at {format_path(seen[value])})')
+            else:
+                seen[value] = path
+        extras.append(collect_tag)
+    if 'ref' in node:
+        namespace = node['ref']
+        extras.append(lambda value, path, ctx: ctx.refs.append((namespace, value, path)))
+    if 'check' in node:
+        extras.append(node['check'])
+
+    if not extras:
+        extra = None
+    elif len(extras) == 1:
+        extra = extras[0]
+    else:
+        def extra(value, path, ctx):
+            for fn in extras:
+                fn(value, path, ctx)
+
+    if node.get('listable'):
+        # sing-box "listable" fields take a single value or a list of them
+        scalar_types, scalar_extra = types, extra
+
+        def extra(value, path, ctx):
+            if value.__class__ is not list:
+                if scalar_extra is not None:
+                    scalar_extra(value, path, ctx)
+                return
+            for i, item in enumerate(value):
+                if scalar_types is not None and item.__class__ not in scalar_types:
+                    ctx.error((path, i), message)
+                elif scalar_extra is not None:
+                    scalar_extra(item, (path, i), ctx)
+        types, message = types | {list}, f'{message} or a list of them'
+    return types, message, extra
+
+
+def _compile_object(node):
+    properties = {name: compile_schema(spec) for name, spec in node.get('properties', {}).items()}
+    required = tuple(node.get('required', ()))
+    key = node.get('discriminator')
+    fallback = node.get('default_variant')
+    variants = {
+        name: ({**properties, **{k: compile_schema(v) for k, v in spec.get('properties', {}).items()}},
+               required + tuple(spec.get('required', ())))
+        for name, spec in node.get('variants', {}).items()
+    }
+    variant_names = ', '.join(sorted(variants))
+
+    def check_object(value, path, ctx):
+        fields, needed = properties, required
+        if key:
+            kind = value.get(key, fallback)
+            if kind in variants:
+                fields, needed = variants[kind]
+            elif kind is None:
+                ctx.error((path, key), 'is required')
+            else:
+                ctx.error((path, key), f'unknown type {kind!r} (expected one of: {variant_names})')
+        for name in needed:
+            if name not in value:
+                ctx.error((path, name), 'is required')
+        for name, item in value.items():
+            rule = fields.get(name)
+            if rule is None:
+                continue
+            types, message, extra = rule
+            if types is not None and item.__class__ not in types:
+                ctx.error((path, name), message)
+            elif extra is not None:
+                extra(item, (path, name), ctx)
+    return check_object
+
+
+def _check_ip(value, path, ctx):
+    try:
+        ipaddress.ip_address(value)
+    except ValueError:
+        ctx.error(path, 'must be an IP address')
+
+
+_IPV4_CIDR = re.compile(r'^((25[0-5]|2[0-4]\d|1?\d?\d)\.){3}(25[0-5]|2[0-4]\d|1?\d?\d)(/(3[0-2]|[12]?\d))?$')
+
+
+def _check_cidr(value, path, ctx):
+    if _IPV4_CIDR.match(value):
+        return
+    try:
+        ipaddress.ip_network(value, strict=False)
+    except ValueError:
+        ctx.error(path, 'must be an IP address or CIDR')
+
+
+def _check_short_id(value, path, ctx):
+    if len(value) % 2:
+        ctx.error(path, 'must have an even number of hex digits')
+
+
+def _check_rule_action(value, path, ctx):
+    if value.get('action', 'route') == 'route' and 'outbound' not in value:
+        ctx.error((path, 'outbound'), 'is required (or set an action other than route)')
+
+
+_UUID = {'type': 'string', 'pattern': r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$',
+         'pattern_message': 'must be a UUID'}
+_PORT = {'type': 'integer', 'min': 1, 'max': 65535}
+_DURATION = {'type': 'string', 'pattern': r'^(\d+(\.\d+)?(ns|us|µs|ms|s|m|h|d))+$',
+             'pattern_message': 'must be a duration such as 30s or 5m'}
+_STRINGS = {'type': 'string', 'listable': True}
+_OUTBOUND_REF = {'type': 'string', 'ref': 'outbound'}
+_SS_METHODS = ['2022-blake3-aes-128-gcm', '2022-blake3-aes-256-gcm', '2022-blake3-chacha20-poly1305', 'none',
+               'aes-128-gcm', 'aes-192-gcm', 'aes-256-gcm', 'chacha20-ietf-poly1305', 'xchacha20-ietf-poly1305']
+_SS_LEGACY_METHODS = ['aes-128-ctr', 'aes-192-ctr', 'aes-256-ctr', 'aes-128-cfb', 'aes-192-cfb', 'aes-256-cfb',
+                      'rc4-md5', 'chacha20-ietf', 'xchacha20']
+
+
+def _users(*fields, required=()):
+    spec = {'name': {'type': 'string'}, 'username': {'type': 'string'}, 'password': {'type': 'string'},
+            'uuid': _UUID, 'flow': {'type': 'string', 'enum': ['', 'xtls-rprx-vision']},
+            'alterId': {'type': 'integer', 'min': 0}}
+    return {'type': 'array', 'items': {'type': 'object', 'required': list(required),
+                                       'properties': {f: spec[f] for f in fields}}}
+
+
+_INBOUND_TLS = {'type': 'object', 'properties': {
+    'enabled': {'type': 'boolean'},
+    'server_name': {'type': 'string'},
+    'alpn': _STRINGS,
+    'min_version': {'type': 'string', 'enum': ['1.0', '1.1', '1.2', '1.3']},
+    'max_version': {'type': 'string', 'enum': ['1.0', '1.1', '1.2', '1.3']},
+    'certificate_path': {'type': 'string'},
+    'key_path': {'type': 'string'},
+    'certificate': _STRINGS,
+    'key': _STRINGS,
+    'acme': {'type': 'object', 'properties': {'domain': _STRINGS, 'email': {'type': 'string'},
+                                              'data_directory': {'type': 'string'}}},
+    'reality': {'type': 'object', 'properties': {
+        'enabled': {'type': 'boolean'},
+        'handshake': {'type': 'object', 'required': ['server'],
+                      'properties': {'server': {'type': 'string'}, 'server_port': _PORT}},
+        'private_key': {'type': 'string', 'pattern': r'^[A-Za-z0-9_-]{43}$',
+                        'pattern_message': 'must be a base64url X25519 key (43 characters)'},
+        'short_id': {'type': 'string', 'listable': True, 'pattern': r'^[0-9a-fA-F]{0,16}$',
+                     'pattern_message': 'must be up to 16 hex digits', 'check': _check_short_id},
+        'max_time_difference': _DURATION,
+    }},
+}}
+
+_OUTBOUND_TLS = {'type': 'object', 'properties': {
+    'enabled': {'type': 'boolean'},
+    'server_name': {'type': 'string'},
+    'insecure': {'type': 'boolean'},
+    'alpn': _STRINGS,
+    'utls': {'type': 'object', 'properties': {'enabled': {'type': 'boolean'}, 'fingerprint': {'type': 'string'}}},
+    'reality': {'type': 'object', 'properties': {
+        'enabled': {'type': 'boolean'},
+        'public_key': {'type': 'string', 'pattern': r'^[A-Za-z0-9_-]{43}$',
+                       'pattern_message': 'must be a base64url X25519 key (43 characters)'},
+        'short_id': {'type': 'string', 'pattern': r'^[0-9a-fA-F]{0,16}$',
+                     'pattern_message': 'must be up to 16 hex digits', 'check': _check_short_id},
+    }},
+}}
+
+_TRANSPORT = {'type': 'object', 'discriminator': 'type', 'variants': {
+    'tcp': {},  # plain TCP; the shipped template spells it out explicitly
+    'http': {'properties': {'host': _STRINGS, 'path': {'type': 'string'}}},
+    'ws': {'properties': {'path': {'type': 'string'}, 'max_early_data': {'type': 'integer', 'min': 0}}},
+    'quic': {},
+    'grpc': {'properties': {'service_name': {'type': 'string'}}},
+    'httpupgrade': {'properties': {'host': {'type': 'string'}, 'path': {'type': 'string'}}},
+}}
+
+_LISTEN = {
+    'tag': {'type': 'string', 'tag': 'inbound'},
+    'listen': {'type': 'string', 'check': _check_ip},
+    'listen_port': _PORT,
+    'tcp_fast_open': {'type': 'boolean'},
+    'udp_timeout': {'type': ['string', 'integer']},
+    'sniff': {'type': 'boolean'},
+    'sniff_override_destination': {'type': 'boolean'},
+    'detour': {'type': 'string', 'ref': 'inbound'},
+}
+
+_INBOUND = {'type': 'object', 'discriminator': 'type', 'properties': _LISTEN, 'variants': {
+    'direct': {'properties': {'override_address': {'type': 'string'}, 'override_port': _PORT}},
+    'mixed': {'properties': {'users': _users('username', 'password')}},
+    'socks': {'properties': {'users': _users('username', 'password')}},
+    'http': {'properties': {'users': _users('username', 'password'), 'tls': _INBOUND_TLS}},
+    'shadowsocks': {'required': ['method', 'password'], 'properties': {
+        'method': {'type': 'string', 'enum': _SS_METHODS}, 'password': {'type': 'string'},
+        'users': _users('name', 'password', required=['password'])}},
+    'vmess': {'required': ['users'], 'properties': {
+        'users': _users('name', 'uuid', 'alterId', required=['uuid']), 'tls': _INBOUND_TLS, 'transport': _TRANSPORT}},
+    'trojan': {'required': ['users'], 'properties': {
+        'users': _users('name', 'password', required=['password']), 'tls': _INBOUND_TLS, 'transport': _TRANSPORT}},
+    'naive': {'required': ['users'], 'properties': {'users': _users('username', 'password'), 'tls': _INBOUND_TLS}},
+    'hysteria': {'properties': {'up_mbps': {'type': 'integer', 'min': 0}, 'down_mbps': {'type': 'integer', 'min': 0},
+                                'tls': _INBOUND_TLS}},
+    'shadowtls': {'properties': {'version': {'type': 'integer', 'enum': [1, 2, 3]}}},
+    'vless': {'required': ['users'], 'properties': {
+        'users': _users('name', 'uuid', 'flow', required=['uuid']), 'tls': _INBOUND_TLS, 'transport': _TRANSPORT}},
+    'tuic': {'required': ['users'], 'properties': {
+        'users': _users('name', 'uuid', 'password', required=['uuid']), 'tls': _INBOUND_TLS,
+        'congestion_control': {'type': 'string', 'enum': ['cubic', 'new_reno', 'bbr']}}},
+    'hysteria2': {'required': ['users'], 'properties': {
+        'users': _users('name', 'password', required=['password']), 'tls': _INBOUND_TLS,
+        'up_mbps': {'type': 'integer', 'min': 0}, 'down_mbps': {'type': 'integer', 'min': 0},
+        'obfs': {'type': 'object', 'properties': {'type': {'type': 'string', 'enum': ['salamander']},
+                                                  'password': {'type': 'string'}}},
+        'masquerade': {'type': ['string', 'object']}}},
+    'tun': {'properties': {'address': _STRINGS, 'mtu': {'type': 'integer', 'min': 576}, 'auto_route': {'type': 'boolean'},
+                           'stack': {'type': 'string', 'enum': ['system', 'gvisor', 'mixed']}}},
+    'redirect': {},
+    'tproxy': {'properties': {'network': {'type': 'string', 'enum': ['tcp', 'udp']}}},
+}}
+
+_DIAL = {
+    'tag': {'type': 'string', 'tag': 'outbound'},
+    'detour': _OUTBOUND_REF,
+    'bind_interface': {'type': 'string'},
+    'connect_timeout': _DURATION,
+    'tcp_fast_open': {'type': 'boolean'},
+    'domain_strategy': {'type': 'string', 'enum': ['', 'prefer_ipv4', 'prefer_ipv6', 'ipv4_only', 'ipv6_only']},
+}
+_SERVER = {'server': {'type': 'string'}, 'server_port': _PORT}
+
+_OUTBOUND = {'type': 'object', 'discriminator': 'type', 'properties': _DIAL, 'variants': {
+    'direct': {'properties': {'override_address': {'type': 'string'}, 'override_port': _PORT}},
+    'block': {},
+    'dns': {},
+    'socks': {'required': ['server', 'server_port'], 'properties': {
+        **_SERVER, 'version': {'type': 'string', 'enum': ['4', '4a', '5']}, 'username': {'type': 'string'},
+        'password': {'type': 'string'}}},
+    'http': {'required': ['server', 'server_port'], 'properties': {
+        **_SERVER, 'username': {'type': 'string'}, 'password': {'type': 'string'}, 'tls': _OUTBOUND_TLS}},
+    'shadowsocks': {'required': ['server', 'server_port', 'method', 'password'], 'properties': {
+        **_SERVER, 'method': {'type': 'string', 'enum': _SS_METHODS + _SS_LEGACY_METHODS},
+        'password': {'type': 'string'}}},
+    'vmess': {'required': ['server', 'server_port', 'uuid'], 'properties': {
+        **_SERVER, 'uuid': _UUID, 'alter_id': {'type': 'integer', 'min': 0}, 'tls': _OUTBOUND_TLS,
+        'transport': _TRANSPORT}},
+    'trojan': {'required': ['server', 'server_port', 'password'], 'properties': {
+        **_SERVER, 'password': {'type': 'string'}, 'tls': _OUTBOUND_TLS, 'transport': _TRANSPORT}},
+    'wireguard': {'properties': {**_SERVER, 'local_address': _STRINGS, 'private_key': {'type': 'string'},
+                                 'peer_public_key': {'type': 'string'}}},
+    'hysteria': {'required': ['server', 'server_port'], 'properties': {**_SERVER, 'tls': _OUTBOUND_TLS}},
+    'shadowtls': {'required': ['server', 'server_port'], 'properties': {
+        **_SERVER, 'version': {'type': 'integer', 'enum': [1, 2, 3]}, 'tls': _OUTBOUND_TLS}},
+    'vless': {'required': ['server', 'server_port', 'uuid'], 'properties': {
+        **_SERVER, 'uuid': _UUID, 'flow': {'type': 'string', 'enum': ['', 'xtls-rprx-vision']},
+        'tls': _OUTBOUND_TLS, 'transport': _TRANSPORT}},
+    'tuic': {'required': ['server', 'server_port', 'uuid'], 'properties': {
+        **_SERVER, 'uuid': _UUID, 'password': {'type': 'string'}, 'tls': _OUTBOUND_TLS}},
+    'hysteria2': {'required': ['server', 'server_port'], 'properties': {
+        **_SERVER, 'password': {'type': 'string'}, 'tls': _OUTBOUND_TLS,
+        'up_mbps': {'type': 'integer', 'min': 0}, 'down_mbps': {'type': 'integer', 'min': 0}}},
+    'tor': {},
+    'ssh': {'required': ['server'], 'properties': {**_SERVER, 'user': {'type': 'string'}}},
+    'selector': {'required': ['outbounds'], 'properties': {
+        'outbounds': {'type': 'array', 'min_items': 1, 'items': _OUTBOUND_REF}, 'default': _OUTBOUND_REF}},
+    'urltest': {'required': ['outbounds'], 'properties': {
+        'outbounds': {'type': 'array', 'min_items': 1, 'items': _OUTBOUND_REF}, 'url': {'type': 'string'},
+        'interval': _DURATION, 'tolerance': {'type': 'integer', 'min': 0}}},
+}}
+
+_RULE_MATCH = {
+    'inbound': {'type': 'string', 'listable': True, 'ref': 'inbound'},
+    'ip_version': {'type': 'integer', 'enum': [4, 6]},
+    'network': {'type': 'string', 'listable': True, 'enum': ['tcp', 'udp']},
+    'auth_user': _STRINGS,
+    'protocol': _STRINGS,
+    'domain': _STRINGS,
+    'domain_suffix': _STRINGS,
+    'domain_keyword': _STRINGS,
+    'domain_regex': _STRINGS,
+    'geosite': _STRINGS,
+    'geoip': _STRINGS,
+    'source_geoip': _STRINGS,
+    'source_ip_cidr': {'type': 'string', 'listable': True, 'check': _check_cidr},
+    'ip_cidr': {'type': 'string', 'listable': True, 'check': _check_cidr},
+    'ip_is_private': {'type': 'boolean'},
+    'source_port': {'type': 'integer', 'listable': True, 'min': 1, 'max': 65535},
+    'port': {'type': 'integer', 'listable': True, 'min': 1, 'max': 65535},
+    'source_port_range': {'type': 'string', 'listable': True, 'pattern': r'^\d*:\d*$'},
+    'port_range': {'type': 'string', 'listable': True, 'pattern': r'^\d*:\d*$'},
+    'process_name': _STRINGS,
+    'process_path': _STRINGS,
+    'user': _STRINGS,
+    'user_id': {'type': 'integer', 'listable': True},
+    'clash_mode': {'type': 'string'},
+    'rule_set': {'type': 'string', 'listable': True, 'ref': 'rule_set'},
+    'invert': {'type': 'boolean'},
+}
+_RULE_ACTION = {
+    'action': {'type': 'string', 'enum': ['route', 'route-options', 'reject', 'hijack-dns', 'sniff', 'resolve']},
+    'outbound': _OUTBOUND_REF,
+}
+
+_ROUTE_RULE = {'type': 'object', 'discriminator': 'type', 'default_variant': 'default', 'variants': {
+    'default': {'properties': {**_RULE_MATCH, **_RULE_ACTION}},
+    'logical': {'required': ['mode', 'rules'], 'properties': {
+        'mode': {'type': 'string', 'enum': ['and', 'or']},
+        'rules': {'type': 'array', 'min_items': 1, 'items': {'type': 'object', 'properties': _RULE_MATCH}},
+        'invert': {'type': 'boolean'}, **_RULE_ACTION}},
+}, 'check': _check_rule_action}
+
+SINGBOX_SCHEMA = {'type': 'object', 'required': ['outbounds'], 'properties': {
+    'log': {'type': 'object', 'properties': {
+        'disabled': {'type': 'boolean'},
+        'level': {'type': 'string', 'enum': ['trace', 'debug', 'info', 'warn', 'error', 'fatal', 'panic']},
+        'output': {'type': 'string'}, 'timestamp': {'type': 'boolean'}}},
+    'dns': {'type': 'object', 'properties': {
+        'servers': {'type': 'array', 'items': {'type': 'object', 'properties': {
+            'tag': {'type': 'string', 'tag': 'dns_server'}, 'address': {'type': 'string'},
+            'detour': _OUTBOUND_REF, 'address_resolver': {'type': 'string', 'ref': 'dns_server'}}}},
+        'rules': {'type': 'array', 'items': {'type': 'object', 'properties': {
+            **_RULE_MATCH, 'outbound': {'type': 'string', 'listable': True},
+            'server': {'type': 'string', 'ref': 'dns_server'}}}},
+        'final': {'type': 'string', 'ref': 'dns_server'},
+        'strategy': {'type': 'string', 'enum': ['', 'prefer_ipv4', 'prefer_ipv6', 'ipv4_only', 'ipv6_only']}}},
+    'inbounds': {'type': 'array', 'items': _INBOUND},
+    'outbounds': {'type': 'array', 'items': _OUTBOUND},
+    'route': {'type': 'object', 'properties': {
+        'rules': {'type': 'array', 'items': _ROUTE_RULE},
+        'rule_set': {'type': 'array', 'items': {'type': 'object', 'required': ['tag'], 'properties': {
+            'tag': {'type': 'string', 'tag': 'rule_set'},
+            'type': {'type': 'string', 'enum': ['inline', 'local', 'remote']},
+            'format': {'type': 'string', 'enum': ['source', 'binary']},
+            'download_detour': _OUTBOUND_REF}}},
+        'final': _OUTBOUND_REF,
+        'auto_detect_interface': {'type': 'boolean'},
+        'default_mark': {'type': 'integer', 'min': 0}}},
+    'experimental': {'type': 'object', 'properties': {
+        'clash_api': {'type': 'object', 'properties': {
+            'external_controller': {'type': 'string'}, 'secret': {'type': 'string'}}},
+        'cache_file': {'type': 'object', 'properties': {'enabled': {'type': 'boolean'}, 'path': {'type': 'string'}}}}},
+}}
+
+_SINGBOX_RULE = compile_schema(SINGBOX_SCHEMA)
+SCHEMA_MAX_ERRORS = 200
+
+
+def check_singbox_config(config):
+    """Every schema and cross-reference error in config, as [{'path', 'message'}]"""
+    ctx = SchemaContext(SCHEMA_MAX_ERRORS)
+    types, message, extra = _SINGBOX_RULE
+    if config.__class__ not in types:
+        ctx.error(None, message)
+    else:
+        extra(config, None, ctx)
+        for namespace, tag, path in ctx.refs:
+            if tag not in ctx.tags[namespace]:
+                ctx.error(path, f'unknown {namespace} tag {tag!r}')
+    if ctx.error_count > len(ctx.errors):
+        ctx.errors.append({'path': '$', 'message': f'... and {ctx.error_count - len(ctx.errors)} more errors'})
+    return ctx.errors
+
+
 def validate_singbox_config(content):
-    """Validate sing-box configuration JSON"""
+    """(True, parsed config) or (False, [{'path', 'message'}, ...]) covering every error found"""
     try:
         config = json.loads(content)
     except json.JSONDecodeError as e:
-        return False, f'Invalid JSON: {str(e)}'
-    
-    # Must be a dict
-    if not isinstance(config, dict):
-        return False, 'Config must be a JSON object'
-    
-    # Check for required top-level keys
-    if 'outbounds' not in config:
-        return False, 'Missing required field: outbounds'
-    
-    if not isinstance(config.get('outbounds'), list):
-        return False, 'outbounds must be an array'
-    
-    # Validate inbounds if present
-    if 'inbounds' in config:
-        if not isinstance(config['inbounds'], list):
-            return False, 'inbounds must be an array'
-        
-        for i, inbound in enumerate(config['inbounds']):
-            if not isinstance(inbound, dict):
-                return False, f'inbounds[{i}] must be an object'
-            
-            # Check inbound type
-            inbound_type = inbound.get('type', '')
-            valid_types = {'direct', 'mixed', 'socks', 'http', 'shadowsocks', 'vmess', 'trojan', 
-                         'naive', 'hysteria', 'shadowtls', 'vless', 'tuic', 'hysteria2', 
-                         'tun', 'redirect', 'tproxy'}
-            if inbound_type and inbound_type not in valid_types:
-                return False, f'inbounds[{i}]: invalid type "{inbound_type}"'
-            
-            # Validate port if present
-            port = inbound.get('listen_port')
-            if port is not None:
-                if not isinstance(port, int) or port < 1 or port > 65535:
-                    return False, f'inbounds[{i}]: listen_port must be 1-65535'
-            
-            # Validate users if present
-            users = inbound.get('users', [])
-            if users and not isinstance(users, list):
-                return False, f'inbounds[{i}]: users must be an array'
-    
-    # Validate outbounds
-    for i, outbound in enumerate(config['outbounds']):
-        if not isinstance(outbound, dict):
-            return False, f'outbounds[{i}] must be an object'
-        
-        outbound_type = outbound.get('type', '')
-        valid_out_types = {'direct', 'block', 'socks', 'http', 'shadowsocks', 'vmess', 'trojan',
-                         'wireguard', 'hysteria', 'shadowtls', 'vless', 'tuic', 'hysteria2',
-                         'tor', 'ssh', 'dns', 'selector', 'urltest'}
-        if outbound_type and outbound_type not in valid_out_types:
-            return False, f'outbounds[{i}]: invalid type "{outbound_type}"'
-    
-    # Check for dangerous patterns (basic security check)
-    content_lower = content.lower()
-    dangerous_patterns = ['$(', '`', '&&', '||', ';', '|', '>', '<', '\n#!']
-    for pattern in dangerous_patterns:
-        if pattern in content_lower:
-            # Allow these in legitimate JSON strings, but flag if suspicious
-            pass  # JSON parser already handles escaping
-    
-    return True, config
+        return False, [{'path': '$', 'message': f'Invalid JSON: {e}'}]
+    errors = check_singbox_config(config)
+    return (False, errors) if errors else (True, config)
+
+
+# ============================================================================
+# CONFIG TEMPLATES - ${VAR} / {{.Var}} templates compiled once, typed parameters
+# ============================================================================
+# Everything from here up to TemplateSet is kept identical to master/app.py (tests/test_shared_code.bats)
+TEMPLATE_PLACEHOLDER = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\{\{\s*\.([A-Za-z_][A-Za-z0-9_]*)\s*\}\}')
+
+# Parameter types: values are checked before they reach a template (no quotes, braces or whitespace)
+TEMPLATE_PARAM_TYPES = {
+    'uuid': re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$'),
+    'domain': re.compile(r'^[a-zA-Z0-9]([a-zA-Z0-9\-\.]{0,253}[a-zA-Z0-9])?$'),
+    'email': re.compile(r'^[^@\s"\\{}]+@[^@\s"\\{}]+$'),
+    'secret': re.compile(r'^[A-Za-z0-9._~+/=$-]{1,256}$'),
+    'name': re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$'),
+    'hex': re.compile(r'^[0-9a-f]{1,64}$'),
+    'port': None,  # integer 1-65535
+}
+
+# name -> (file under the agent's templates directory, json | text, {parameter: type})
+CONFIG_TEMPLATES = {
+    'singbox': ('singbox-config.json.template', 'json', {
+        'VLESS_UUID': 'uuid', 'NODE_DOMAIN': 'domain', 'ACME_EMAIL': 'email',
+        'GATEWAY_CONTAINER': 'name', 'HY2_PASSWORD': 'secret', 'CLASH_API_SECRET': 'secret',
+    }),
+    'caddy': ('Caddyfile.template', 'text', {
+        'MasterDomain': 'domain', 'NodeDomain': 'domain', 'PathPrefix': 'hex', 'AdGuardAdminPass': 'secret',
+    }),
+}
+
+
+def _clone(value):
+    if isinstance(value, dict):
+        return {k: _clone(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_clone(v) for v in value]
+    return value
+
+
+class ConfigTemplate:
+    """One template compiled for repeated rendering.
+
+    Text templates become (literal, parameter) pairs joined per render. JSON
+    templates are parsed once into a tree of builders: subtrees without
+    placeholders are cloned, a string that is exactly one placeholder takes
+    the typed value (a port stays an integer) and other strings interpolate.
+    Rendering a JSON template returns the config as objects, ready for the
+    validator, with no escaping or re-parsing.
+    """
+
+    def __init__(self, name, source, kind, params):
+        self.name = name
+        self.kind = kind
+        self.params = params
+        self.source = source
+        self.hash = hashlib.sha256(source.encode()).hexdigest()[:16]
+        self.used = set()
+        if kind == 'json':
+            self.build = self._compile_value(json.loads(source))[0]
+        else:
+            self.build = self._compile_string(source)
+        unknown = self.used - set(params)
+        if unknown:
+            raise ValueError(f"{name}: undeclared placeholder(s) {', '.join(sorted(unknown))}")
+
+    def _placeholder(self, match):
+        name = match.group(1) or match.group(2)
+        self.used.add(name)
+        return name
+
+    def _compile_string(self, text):
+        """Builder for one string: constant, one typed placeholder, or literal/placeholder pairs"""
+        pairs, last = [], 0
+        for match in TEMPLATE_PLACEHOLDER.finditer(text):
+            pairs.append((text[last:match.start()], self._placeholder(match)))
+            last = match.end()
+        if not pairs:
+            return lambda values: text
+        tail = text[last:]
+        if len(pairs) == 1 and not pairs[0][0] and not tail:
+            name = pairs[0][1]
+            return lambda values: values[name]
+        return lambda values: ''.join([literal + str(values[name]) for literal, name in pairs]) + tail
+
+    def _compile_value(self, node):
+        """(builder, constant) for one JSON value"""
+        if isinstance(node, str):
+            build = self._compile_string(node)
+            return build, TEMPLATE_PLACEHOLDER.search(node) is None
+        if isinstance(node, dict):
+            items = [(self._compile_string(k), *self._compile_value(v)) for k, v in node.items()]
+            if all(constant for _, _, constant in items) and not TEMPLATE_PLACEHOLDER.search(''.join(node)):
+                return (lambda values: _clone(node)), True
+            return (lambda values: {key(values): value(values) for key, value, _ in items}), False
+        if isinstance(node, list):
+            items = [self._compile_value(v) for v in node]
+            if all(constant for _, constant in items):
+                return (lambda values: _clone(node)), True
+            return (lambda values: [item(values) for item, _ in items]), False
+        return (lambda values: node), True
+
+    def check(self, params):
+        """(typed values, errors) where errors is [{'param', 'message'}] covering every problem"""
+        values, errors = {}, []
+        for name in sorted(set(params) - set(self.params)):
+            errors.append({'param': name, 'message': 'unknown parameter'})
+        for name, kind in self.params.items():
+            if name not in params:
+                if name in self.used:
+                    errors.append({'param': name, 'message': f'required ({kind})'})
+                continue
+            value = params[name]
+            if kind == 'port':
+                if isinstance(value, str) and value.isdigit():
+                    value = int(value)
+                if not isinstance(value, int) or isinstance(value, bool) or not 1 <= value <= 65535:
+                    errors.append({'param': name, 'message': 'must be a port (1-65535)'})
+                    continue
+            elif not isinstance(value, str) or not TEMPLATE_PARAM_TYPES[kind].match(value):
+                errors.append({'param': name, 'message': f'must be a valid {kind}'})
+                continue
+            values[name] = value
+        return values, errors
+
+    def render(self, params):
+        """(output, errors): a dict for JSON templates, a string for text ones; output is None on errors"""
+        values, errors = self.check(params)
+        if errors:
+            return None, errors
+        return self.build(values), []
+
+
+class TemplateSet:
+    """CONFIG_TEMPLATES read from a directory, recompiled only when a file changes"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.compiled = {}  # name -> ((mtime_ns, size), ConfigTemplate)
+
+    def get(self, name):
+        """Compiled template for name (KeyError if unknown, OSError if the file is missing)"""
+        filename, kind, params = CONFIG_TEMPLATES[name]
+        path = os.path.join(self.directory, filename)
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            cached = self.compiled.get(name)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+        with open(path) as f:
+            template = ConfigTemplate(name, f.read(), kind, params)
+        with self.lock:
+            self.compiled[name] = (key, template)
+        return template
+
+
+config_templates = TemplateSet(TEMPLATES_DIR)
+
+# ============================================================================
+# DOCKER ENGINE API - keep-alive HTTP over the docker socket, no CLI forks
+# ============================================================================
+DOCKER_TIME_PATTERN = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$')
+
+
+class DockerError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=DOCKER_API_TIMEOUT):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class DockerStream:
+    """Raw reader for a streaming response: undoes chunked encoding and log stdout/stderr framing.
+
+    Nothing is buffered past what read() returns, so callers can select() on
+    fileno() exactly as they did on a `docker logs` pipe.
+    """
+
+    def __init__(self, sock, chunked, multiplexed):
+        self.sock = sock
+        self.chunked = chunked
+        self.multiplexed = multiplexed  # None: sniff the first frame header
+        self.eof = False
+        self.sniffed = b''
+        self.raw = b''
+        self.chunk_left = None  # None: expecting a chunk size line
+        self.frame = b''
+        self.frame_left = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _unchunk(self, data):
+        self.raw += data
+        out = []
+        while self.raw:
+            if self.chunk_left is None:
+                end = self.raw.find(b'\r\n')
+                if end < 0:
+                    break
+                size = int(self.raw[:end].split(b';')[0], 16)
+                self.raw = self.raw[end + 2:]
+                if size == 0:
+                    self.eof = True
+                    break
+                self.chunk_left = size
+            elif self.chunk_left == 0:
+                if len(self.raw) < 2:
+                    break
+                self.raw, self.chunk_left = self.raw[2:], None
+            else:
+                piece = self.raw[:self.chunk_left]
+                out.append(piece)
+                self.raw = self.raw[len(piece):]
+                self.chunk_left -= len(piece)
+        return b''.join(out)
+
+    def _unframe(self, data):
+        out = []
+        while data:
+            if self.frame_left:
+                piece = data[:self.frame_left]
+                out.append(piece)
+                data = data[len(piece):]
+                self.frame_left -= len(piece)
+                continue
+            # 8-byte header: stream type, 3 zero bytes, big-endian payload size
+            need = 8 - len(self.frame)
+            self.frame += data[:need]
+            data = data[need:]
+            if len(self.frame) == 8:
+                self.frame_left = int.from_bytes(self.frame[4:], 'big')
+                self.frame = b''
+        return b''.join(out)
+
+    def read(self):
+        """Next block of log output; b'' at the end of the stream"""
+        while not self.eof:
+            data = self.sock.recv(65536)
+            if not data:
+                self.eof = True
+                break
+            if self.chunked:
+                data = self._unchunk(data)
+            if self.multiplexed is None:
+                # Daemons before API 1.42 label framed output raw-stream too; a frame starts with 0/1/2 and three zeros
+                self.sniffed += data
+                if len(self.sniffed) < 8:
+                    continue
+                data, self.sniffed = self.sniffed, b''
+                self.multiplexed = data[0] in (0, 1, 2) and data[1:4] == b'\0\0\0'
+            if self.multiplexed:
+                data = self._unframe(data)
+            if data:
+                return data
+        data, self.sniffed = self.sniffed, b''
+        return data
+
+    def close(self):
+        self.eof = True
+        self.sock.close()
+
+
+class DockerClient:
+    """Docker Engine API client on the unix socket, one keep-alive connection per thread"""
+
+    def __init__(self, socket_path, timeout=DOCKER_API_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def request(self, method, path, op, timeout=None, body=None):
+        """(status, parsed JSON body or None); one retry when a reused connection was closed"""
+        started = time.perf_counter()
+        try:
+            for attempt in (0, 1):
+                conn = getattr(self.local, 'conn', None)
+                reused = conn is not None
+                if conn is None:
+                    conn = self.local.conn = UnixHTTPConnection(self.socket_path, self.timeout)
+                try:
+                    conn.timeout = timeout or self.timeout
+                    if conn.sock:
+                        conn.sock.settimeout(conn.timeout)
+                    conn.request(method, path, body=json.dumps(body).encode() if body is not None else None,
+                                 headers={'Host': 'docker', 'Content-Type': 'application/json'})
+                    resp = conn.getresponse()
+                    body = resp.read()
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    conn.close()
+                    self.local.conn = None
+                    if reused and not attempt:
+                        continue  # the daemon closed an idle keep-alive connection
+                    raise
+                except Exception:
+                    conn.close()
+                    self.local.conn = None
+                    raise
+                data = json.loads(body) if body and resp.getheader('Content-Type', '').startswith('application/json') else None
+                if resp.status >= 400:
+                    raise DockerError(resp.status, (data or {}).get('message') or body.decode(errors='replace').strip())
+                return resp.status, data
+        except Exception:
+            metrics.inc('docker_api_failures_total', (op,))
+            raise
+        finally:
+            metrics.observe('docker_api_duration_seconds', (op,), time.perf_counter() - started)
+
+    def list_containers(self, prefix='sui-'):
+        """{name: container summary} of every container whose name starts with prefix, in one list call"""
+        filters = quote(json.dumps({'name': [f'^/{prefix}']}))
+        _, data = self.request('GET', f'/containers/json?all=1&filters={filters}', 'containers')
+        return {
+            name.lstrip('/'): container
+            for container in data or [] for name in container.get('Names', []) if name.lstrip('/').startswith(prefix)
+        }
+
+    def containers(self, prefix='sui-'):
+        """{name: state} of every container whose name starts with prefix"""
+        return {name: c.get('State', 'unknown') for name, c in self.list_containers(prefix).items()}
+
+    def inspect(self, name):
+        return self.request('GET', f'/containers/{quote(name)}/json', 'inspect')[1]
+
+    def restart(self, name, stop_timeout=10):
+        self.request('POST', f'/containers/{quote(name)}/restart?t={stop_timeout}', 'restart',
+                     timeout=stop_timeout + self.timeout)
+
+    def version(self):
+        return self.request('GET', '/version', 'version')[1]
+
+    def kill(self, name, signal='HUP'):
+        self.request('POST', f'/containers/{quote(name)}/kill?signal={signal}', 'kill')
+
+    def exec_run(self, name, cmd, timeout=None):
+        """Run cmd inside a running container -> (exit code, combined output)"""
+        _, created = self.request('POST', f'/containers/{quote(name)}/exec', 'exec',
+                                  body={'Cmd': cmd, 'AttachStdout': True, 'AttachStderr': True})
+        stream = self.open_stream(f'/exec/{created["Id"]}/start', 'exec', framed=True, method='POST',
+                                  body={'Detach': False, 'Tty': False})
+        try:
+            if timeout:
+                stream.sock.settimeout(timeout)
+            output = b''.join(iter(stream.read, b'')).decode(errors='replace')
+        finally:
+            stream.close()
+        return self.request('GET', f'/exec/{created["Id"]}/json', 'exec')[1].get('ExitCode'), output
+
+    def open_stream(self, path, op, follow=False, framed=False, method='GET', body=None):
+        """DockerStream over a dedicated connection (a follow stream holds it indefinitely)"""
+        started = time.perf_counter()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        payload = json.dumps(body).encode() if body is not None else b''
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(f'{method} {path} HTTP/1.1\r\nHost: docker\r\nConnection: close\r\n'
+                         f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n'.encode() + payload)
+            # Peek, then consume exactly the header bytes so the body stays on the socket for select()
+            head = b''
+            while True:
+                peeked = sock.recv(65536, socket.MSG_PEEK)
+                if not peeked:
+                    raise DockerError(502, 'docker closed the connection')
+                end = (head[-3:] + peeked).find(b'\r\n\r\n')
+                if end >= 0:
+                    head += sock.recv(end + 4 - len(head[-3:]))
+                    break
+                head += sock.recv(len(peeked))
+            status_line, *header_lines = head.decode('latin-1').split('\r\n')
+            headers = {k.strip().lower(): v.strip() for k, _, v in (h.partition(':') for h in header_lines if h)}
+            status = int(status_line.split()[1])
+            stream = DockerStream(sock, headers.get('transfer-encoding') == 'chunked',
+                                  framed and ('multiplexed-stream' in headers.get('content-type', '') or None))
+            if status >= 400:
+                stream.multiplexed = False
+                body = b''.join(iter(stream.read, b''))
+                sock.close()
+                try:
+                    message = json.loads(body).get('message')
+                except ValueError:
+                    message = body.decode(errors='replace').strip()
+                raise DockerError(status, message or f'HTTP {status}')
+            sock.settimeout(None if follow else self.timeout)
+            return stream
+        except Exception:
+            sock.close()
+            metrics.inc('docker_api_failures_total', (op,))
+            raise
+        finally:
+            metrics.observe('docker_api_duration_seconds', (op,), time.perf_counter() - started)
+
+    def open_logs(self, name, tail=None, since=None, follow=False, timestamps=True):
+        params = {'stdout': 1, 'stderr': 1, 'timestamps': int(timestamps), 'follow': int(follow)}
+        if since:
+            params['since'] = since
+        elif tail is not None:
+            params['tail'] = tail
+        return self.open_stream(f'/containers/{quote(name)}/logs?{urlencode(params)}', 'logs', follow, framed=True)
+
+    def open_events(self, filters):
+        """Newline-delimited JSON event stream, e.g. filters={'type': ['container']}"""
+        return self.open_stream(f'/events?filters={quote(json.dumps(filters))}', 'events', follow=True)
+
+    def logs(self, name, tail):
+        stream = self.open_logs(name, tail=tail, timestamps=False)
+        try:
+            return b''.join(iter(stream.read, b'')).decode(errors='replace')
+        finally:
+            stream.close()
+
+
+def docker_since(stamp):
+    """Log event id (RFC 3339 timestamp or unix seconds) -> the API's exact seconds.nanoseconds"""
+    if re.match(r'^\d+(\.\d+)?$', stamp):
+        return stamp
+    match = DOCKER_TIME_PATTERN.match(stamp)
+    if not match:
+        raise ValueError(f'Invalid timestamp: {stamp}')
+    base, frac, offset = match.groups()
+    seconds = calendar.timegm(time.strptime(base, '%Y-%m-%dT%H:%M:%S'))
+    if offset and offset != 'Z':
+        seconds -= (1 if offset[0] == '+' else -1) * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+    return f'{seconds}.{(frac or "")[:9]:0<9}'
+
+
+docker = DockerClient(DOCKER_SOCKET)
+
+
+class ContainerStateCache:
+    """Live state of the sui-* containers, kept current by the Docker events stream.
+
+    Each worker follows the stream into its own table, so reads never touch
+    docker; the table is trusted only while the stream is connected (callers
+    fall back to a list call otherwise). After every (re)subscribe the table is
+    resynced from one list call and any difference is treated as an event, so
+    nothing that happened while disconnected is lost. The worker holding the
+    events lock queues state changes for the master webhook.
+    """
+
+    TRANSITIONS = {'create': 'created', 'start': 'running', 'restart': 'running', 'unpause': 'running',
+                   'pause': 'paused', 'die': 'exited', 'stop': 'exited'}
+    HEALTH_RE = re.compile(r'\((healthy|unhealthy|health: starting)\)')
+
+    def __init__(self, prefix='sui-'):
+        self.prefix = prefix
+        self.table = {}  # name -> {'state', 'health', 'exit_code', 'since'}
+        self.changed = 0.0
+        self.connected = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = deque(maxlen=EVENTS_QUEUE_MAX)
+        self.leader = LeaderLock(os.path.join(STATE_DIR, 'container-events.lock'))
+        self.stats = defaultdict(int)
+
+    def states(self):
+        """{name: state} while the events stream is connected, else None"""
+        with self.lock:
+            return {name: entry['state'] for name, entry in self.table.items()} if self.connected else None
+
+    def services(self):
+        with self.lock:
+            return {name[len(self.prefix):]: dict(entry) for name, entry in self.table.items()}
+
+    def _apply(self, name, entry, action, ts, notify=False):
+        """Store entry (None = removed); lock held. Queues an event when state or health changed."""
+        old = self.table.get(name)
+        if entry is None:
+            self.table.pop(name, None)
+        else:
+            self.table[name] = entry
+        if not notify and (old or {}).get('state') == (entry or {}).get('state') \
+                and (old or {}).get('health') == (entry or {}).get('health'):
+            return
+        self.changed = ts
+        self.stats['changes'] += 1
+        if self.leader.lock_file and MASTER_EVENTS_URL:
+            self.pending.append({
+                'time': ts, 'service': name[len(self.prefix):], 'action': action,
+                'state': entry['state'] if entry else 'removed',
+                'previous': old['state'] if old else None,
+                'health': entry.get('health') if entry else None,
+                'exit_code': entry.get('exit_code') if entry else None
+            })
+            self.wakeup.notify()
+
+    def _sync(self):
+        containers = docker.list_containers(self.prefix)
+        now = time.time()
+        with self.lock:
+            for name in set(self.table) | set(containers):
+                container = containers.get(name)
+                if container is None:
+                    self._apply(name, None, 'sync', now)
+                    continue
+                match = self.HEALTH_RE.search(container.get('Status', ''))
+                old = self.table.get(name) or {}
+                state = container.get('State', 'unknown')
+                self._apply(name, {
+                    'state': state,
+                    'health': match.group(1).replace('health: ', '') if match else None,
+                    'exit_code': old.get('exit_code'),
+                    'since': old.get('since') if old.get('state') == state else now
+                }, 'sync', now)
+            self.connected = True
+
+    def _handle(self, event):
+        attrs = (event.get('Actor') or {}).get('Attributes') or {}
+        name = attrs.get('name', '')
+        action = event.get('Action') or event.get('status') or ''
+        if event.get('Type') != 'container' or not name.startswith(self.prefix):
+            return
+        ts = event['timeNano'] / 1e9 if event.get('timeNano') else time.time()
+        self.stats['events'] += 1
+        with self.lock:
+            entry = dict(self.table.get(name) or {'state': 'created', 'health': None, 'exit_code': None, 'since': ts})
+            if action.startswith('health_status: '):
+                entry['health'] = action.partition(': ')[2]
+            elif action == 'destroy':
+                entry = None
+            elif action == 'oom':
+                self._apply(name, entry, action, ts, notify=True)
+                return
+            elif action in self.TRANSITIONS:
+                if entry['state'] != self.TRANSITIONS[action]:
+                    entry['since'] = ts
+                entry['state'] = self.TRANSITIONS[action]
+                if action == 'die':
+                    entry['exit_code'] = int(attrs.get('exitCode', 0))
+                    entry['health'] = None
+                elif action == 'start':
+                    entry['exit_code'] = None
+                    entry['health'] = None if entry.get('health') is None else 'starting'
+            else:
+                return  # exec_*, attach, resize... do not change state
+            self._apply(name, entry, action, ts)
+
+    def run(self):
+        backoff = 1
+        while True:
+            stream = None
+            try:
+                # Subscribe first, then list: an event racing the list is applied after it
+                stream = docker.open_events({'type': ['container']})
+                self._sync()
+                backoff = 1
+                pending = b''
+                while True:
+                    chunk = stream.read()
+                    if not chunk:
+                        break
+                    *lines, pending = (pending + chunk).split(b'\n')
+                    for line in lines:
+                        if line.strip():
+                            self._handle(json.loads(line))
+            except Exception as e:
+                app.logger.warning(f'Docker events stream: {e}')
+            finally:
+                with self.lock:
+                    self.connected = False
+                if stream:
+                    stream.close()
+            self.stats['reconnects'] += 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    def push_loop(self):
+        """Send queued changes to MASTER_EVENTS_URL, coalescing bursts (a restart is die, stop, start)"""
+        backoff = 1
+        while True:
+            if not self.leader.acquire():
+                time.sleep(30)
+                continue
+            with self.lock:
+                while not self.pending:
+                    self.wakeup.wait()
+            time.sleep(EVENTS_PUSH_DELAY)
+            with self.lock:
+                batch = list(self.pending)
+                self.pending.clear()
+                changed = self.changed
+            body = json.dumps({'domain': NODE_DOMAIN, 'changed': changed, 'services': self.services(), 'events': batch})
+            req = urllib.request.Request(MASTER_EVENTS_URL, data=body.encode(), method='POST', headers={
+                'Content-Type': 'application/json', 'X-SUI-Token': CLUSTER_SECRET})
+            try:
+                with urllib.request.urlopen(req, timeout=10) as resp:
+                    resp.read()
+                self.stats['pushed'] += len(batch)
+                backoff = 1
+            except Exception as e:
+                self.stats['push_failures'] += 1
+                app.logger.warning(f'Event push to master failed: {e}')
+                with self.lock:
+                    self.pending.extendleft(reversed(batch))  # oldest are dropped first on overflow
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+
+container_cache = ContainerStateCache()
 
 
 def sanitize_lines(l):
@@ -140,34 +1525,39 @@ def sanitize_lines(l):
         return '100'
 
 
+# Container operations go through the Docker Engine API (DockerClient); only these still fork
 ALLOWED_COMMANDS = {
-    'restart_singbox': ['docker', 'restart', 'sui-singbox'],
-    'restart_adguard': ['docker', 'restart', 'sui-adguard'],
-    'restart_caddy': ['docker', 'restart', 'sui-caddy'],
-    'status_singbox': ['docker', 'inspect', '-f', '{{.State.Status}}', 'sui-singbox'],
-    'status_adguard': ['docker', 'inspect', '-f', '{{.State.Status}}', 'sui-adguard'],
-    'status_caddy': ['docker', 'inspect', '-f', '{{.State.Status}}', 'sui-caddy'],
-    'logs_singbox': ['docker', 'logs', '--tail', '{lines}', 'sui-singbox'],
-    'logs_adguard': ['docker', 'logs', '--tail', '{lines}', 'sui-adguard'],
-    'logs_caddy': ['docker', 'logs', '--tail', '{lines}', 'sui-caddy'],
     'uptime': ['cat', '/proc/uptime'],
 }
 
 
-def execute_cmd(key, **kwargs):
+def execute_cmd(key):
     if key not in ALLOWED_COMMANDS:
         return False, 'Command not allowed'
-    cmd = [p.format(lines=sanitize_lines(kwargs.get('lines', '100'))) if '{lines}' in p else p for p in ALLOWED_COMMANDS[key]]
+    cmd = ALLOWED_COMMANDS[key]
+    started = time.perf_counter()
     try:
         r = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        if r.returncode != 0:
+            metrics.inc('subprocess_failures_total', (key,))
         return r.returncode == 0, r.stdout + r.stderr
     except Exception as e:
+        metrics.inc('subprocess_failures_total', (key,))
         return False, str(e)
+    finally:
+        metrics.observe('subprocess_duration_seconds', (key,), time.perf_counter() - started)
 
 
-def get_container_status(svc):
-    ok, out = execute_cmd(f'status_{svc}')
-    return out.strip() if ok else 'not found'
+def container_states(services=('singbox', 'adguard', 'caddy')):
+    """{service: container state} from the events cache, else one list call ('unknown' when docker is unreachable)"""
+    try:
+        states = container_cache.states()
+        if states is None:
+            states = docker.containers()
+    except (OSError, http.client.HTTPException, DockerError) as e:
+        app.logger.warning(f'Docker API unavailable: {e}')
+        return dict.fromkeys(services, 'unknown')
+    return {svc: states.get(f'sui-{svc}', 'not found') for svc in services}
 
 
 def get_hidden_path(token):
@@ -187,9 +1577,13 @@ def require_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         ip = get_client_ip()
-        if not auth_limiter.is_allowed(ip):
+        # Only failed attempts count towards the limit; the master authenticates on every call
+        if not auth_limiter.is_allowed(ip, consume=False):
             return jsonify({'error': 'Too many auth attempts', 'retry_after': 120}), 429
-        if not _secure_compare(request.headers.get('X-SUI-Token', ''), CLUSTER_SECRET):
+        bearer = request.headers.get('Authorization', '')
+        token = request.headers.get('X-SUI-Token') or (bearer[7:] if bearer.startswith('Bearer ') else '')
+        if not _secure_compare(token, CLUSTER_SECRET):
+            auth_limiter.is_allowed(ip)
             app.logger.warning(f'Auth failed: {ip}')
             return jsonify({'error': 'Unauthorized'}), 401
         return f(*args, **kwargs)
@@ -217,14 +1611,14 @@ def status():
                 uptime_str = f"{minutes}m"
         except:
             uptime_str = uptime_raw.strip()
-    return jsonify({'status': 'online', 'domain': NODE_DOMAIN, 'uptime': uptime_str})
+    return jsonify({'status': 'online', 'domain': NODE_DOMAIN, 'uptime': uptime_str, 'services': container_states()})
 
 
 @app.route(f'/{PATH_PREFIX}/api/v1/services')
 @require_auth
 @rate_limit(api_limiter)
 def services():
-    return jsonify({'services': {s: get_container_status(s) for s in ['singbox', 'adguard', 'caddy']} | {'agent': 'running'}})
+    return jsonify({'services': container_states() | {'agent': 'running'}})
 
 
 @app.route(f'/{PATH_PREFIX}/api/v1/restart/<service>', methods=['POST'])
@@ -235,14 +1629,61 @@ def restart_service(service):
         service = sanitize_service(service)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
-    ok, out = execute_cmd(f'restart_{service}')
-    return jsonify({'success': ok, 'service': service, 'message': out.strip()})
+    try:
+        docker.restart(f'sui-{service}')
+    except (OSError, http.client.HTTPException, DockerError) as e:
+        return jsonify({'success': False, 'service': service, 'message': str(e)})
+    return jsonify({'success': True, 'service': service, 'message': f'sui-{service}'})
+
+
+# Kept identical to config_digest in master/app.py (tests/test_shared_code.bats)
+def config_digest(service, content):
+    """Content hash agent and master compare; sing-box JSON is hashed in canonical form so formatting does not count"""
+    if service == 'singbox':
+        try:
+            config = json.loads(content) if isinstance(content, str) else content
+            content = json.dumps(config, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        except json.JSONDecodeError:
+            pass
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+@lru_cache(maxsize=8)
+def _file_digest(service, path, mtime_ns, size):
+    with open(path) as f:
+        return config_digest(service, f.read())
+
+
+def file_digest(service, path):
+    """config_digest of a config file, recomputed only when the file changes"""
+    st = os.stat(path)
+    return _file_digest(service, path, st.st_mtime_ns, st.st_size)
+
+
+def merge_patch(target, patch):
+    """Apply a JSON merge patch (RFC 7386): objects merge recursively, null deletes, anything else replaces"""
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key), value)
+    return target
 
 
 @app.route(f'/{PATH_PREFIX}/api/v1/config/<service>', methods=['GET', 'POST'])
 @require_auth
 @rate_limit(api_limiter)
 def config(service):
+    """Read or replace a service config.
+
+    GET ?hash_only=1 returns just the content hash. POST takes the full
+    content, or for sing-box a merge patch against the config whose hash is
+    base_hash (409 with the current hash when the node has moved on).
+    """
     try:
         service = sanitize_service(service)
     except ValueError as e:
@@ -252,22 +1693,44 @@ def config(service):
     if not os.path.realpath(path).startswith(os.path.realpath(CONFIG_DIR)):
         return jsonify({'error': 'Invalid path'}), 400
     if request.method == 'GET':
-        return jsonify({'error': 'Not found'}) if not os.path.exists(path) else jsonify({'service': service, 'content': open(path).read()})
+        if not os.path.exists(path):
+            return jsonify({'error': 'Not found'})
+        if request.args.get('hash_only'):
+            return jsonify({'service': service, 'hash': file_digest(service, path)})
+        with open(path) as f:
+            content = f.read()
+        return jsonify({'service': service, 'content': content, 'hash': config_digest(service, content)})
     
-    content = request.json.get('content', '')
+    data = request.get_json(silent=True) or {}
+    if 'patch' in data:
+        if service != 'singbox' or not isinstance(data['patch'], dict):
+            return jsonify({'success': False, 'error': 'patch must be an object and is only supported for singbox'}), 400
+        if not os.path.exists(path):
+            return jsonify({'success': False, 'error': 'sing-box config not found'}), 404
+        current = file_digest(service, path)
+        if data.get('base_hash') != current:
+            return jsonify({'success': False, 'error': 'Config changed since base_hash', 'hash': current}), 409
+        content = json.dumps(merge_patch(load_singbox_config(), data['patch']))
+    else:
+        content = data.get('content', '')
     
     # Validate config based on service type
     if service == 'singbox':
         valid, result = validate_singbox_config(content)
         if not valid:
-            return jsonify({'success': False, 'error': f'Config validation failed: {result}'}), 400
+            first = result[0]
+            more = f' (+{len(result) - 1} more)' if len(result) > 1 else ''
+            return jsonify({'success': False, 'errors': result,
+                            'error': f"Config validation failed: {first['path']}: {first['message']}{more}"}), 400
+        if data.get('apply'):
+            # Check, swap, reload in place and roll back if sing-box does not come up healthy
+            report = singbox_applier.apply(result)
+            return jsonify({**report, **({'hash': config_digest(service, result)} if report['success'] else {})})
         # Write the validated and re-serialized JSON for consistency
         content = json.dumps(result, indent=2)
     
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'w') as f:
-        f.write(content)
-    return jsonify({'success': True})
+    write_atomic(path, content)
+    return jsonify({'success': True, 'hash': config_digest(service, content)})
 
 
 @app.route(f'/{PATH_PREFIX}/api/v1/logs/<service>')
@@ -278,10 +1741,88 @@ def logs(service):
         service = sanitize_service(service)
     except ValueError as e:
         return jsonify({'error': str(e)}), 400
-    ok, out = execute_cmd(f'logs_{service}', lines=request.args.get('lines', '100'))
+    try:
+        out = docker.logs(f'sui-{service}', sanitize_lines(request.args.get('lines', '100')))
+    except (OSError, http.client.HTTPException, DockerError) as e:
+        out = str(e)
     return jsonify({'service': service, 'logs': out})
 
 
+def stream_container_logs(service, tail='100', since=None, follow=False):
+    """Yield docker log lines as SSE events without buffering the whole log.
+
+    Each event id is the docker timestamp of its line so a client can resume
+    with since=<last id>. Reads happen only when the previous event has been
+    written out, so a slow consumer stalls the daemon on a full socket instead
+    of growing memory here.
+    """
+    try:
+        stream = docker.open_logs(f'sui-{service}', tail=tail, since=docker_since(since) if since else None,
+                                  follow=follow)
+    except (OSError, http.client.HTTPException, DockerError) as e:
+        yield f'data: {e}\n\nevent: end\ndata: \n\n'
+        return
+    fd = stream.fileno()
+    deadline = time.monotonic() + LOG_STREAM_MAX_SECONDS
+    pending = b''
+    try:
+        yield 'retry: 1000\n\n'
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return  # the client reconnects with Last-Event-ID and resumes
+            ready, _, _ = select.select([fd], [], [], min(LOG_STREAM_HEARTBEAT, remaining))
+            if not ready:
+                yield ': keepalive\n\n'
+                continue
+            chunk = stream.read()
+            *lines, pending = (pending + chunk).split(b'\n') if chunk else (pending, b'')
+            if len(pending) > 65536:
+                lines, pending = lines + [pending], b''
+            events = ''.join(_log_event(raw, since) for raw in lines if raw)
+            if events:
+                yield events
+            if not chunk:
+                break
+        yield 'event: end\ndata: \n\n'
+    finally:
+        stream.close()
+
+
+def _log_event(raw, since):
+    line = raw.decode(errors='replace').rstrip('\r')
+    stamp, _, text = line.partition(' ')
+    if not LOG_SINCE_PATTERN.match(stamp):
+        return f'data: {line}\n\n'  # untimestamped output
+    if stamp == since:
+        return ''  # since is inclusive; the client already has this line
+    return f'id: {stamp}\ndata: {text}\n\n'
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/logs/<service>/stream')
+@require_auth
+@rate_limit(api_limiter)
+def logs_stream(service):
+    try:
+        service = sanitize_service(service)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    since = request.args.get('since') or request.headers.get('Last-Event-ID') or None
+    if since:
+        try:
+            if not LOG_SINCE_PATTERN.match(since):
+                raise ValueError
+            docker_since(since)
+        except ValueError:
+            return jsonify({'error': 'Invalid since'}), 400
+    follow = request.args.get('follow', '0').lower() in ('1', 'true', 'yes')
+    return Response(
+        stream_with_context(stream_container_logs(service, sanitize_lines(request.args.get('tail', '100')), since, follow)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route(f'/{PATH_PREFIX}/api/v1/update', methods=['POST'])
 @require_auth
 @rate_limit(api_limiter)
@@ -294,9 +1835,12 @@ def update():
                 curl -fsSL https://github.com/pjonix/SUIS/archive/main.zip -o /tmp/update.zip
                 unzip -o /tmp/update.zip -d /tmp/
                 cp /tmp/SUIS-main/node/agent.py ./agent.py.new
+                cp /tmp/SUIS-main/node/gunicorn.conf.py /tmp/SUIS-main/node/Dockerfile /tmp/SUIS-main/node/requirements.txt ./
                 cp /tmp/SUIS-main/node/templates/Caddyfile.template ./templates/Caddyfile.template.new
+                cp /tmp/SUIS-main/node/templates/singbox-config.json.template ./templates/singbox-config.json.template.new
                 mv ./agent.py.new ./agent.py
                 mv ./templates/Caddyfile.template.new ./templates/Caddyfile.template
+                mv ./templates/singbox-config.json.template.new ./templates/singbox-config.json.template
                 rm -rf /tmp/update.zip /tmp/SUIS-main
                 docker compose up -d --build
             '''],
@@ -347,11 +1891,13 @@ def get_proxies():
                         'enabled': True,
                         'domain': NODE_DOMAIN
                     }
-                    # Extract user info
+                    # Extract user info (first user; the rest are counted)
                     users = inbound.get('users', [])
                     if users:
                         proxy['uuid'] = users[0].get('uuid', users[0].get('password', ''))
                         proxy['flow'] = users[0].get('flow', '')
+                    proxy['users'] = len(users)
+                    proxy['managed_users'] = sum(1 for u in users if str(u.get('name', '')).startswith(MANAGED_USER_PREFIX))
                     # TLS info
                     tls = inbound.get('tls', {})
                     proxy['tls'] = tls.get('enabled', False)
@@ -374,73 +1920,1066 @@ def version():
     return jsonify({'version': '2.0.0'})
 
 
-@app.route(f'/{PATH_PREFIX}/api/v1/diagnostics')
-@require_auth
-@rate_limit(api_limiter)
-def diagnostics():
-    """Run diagnostics and return system health status"""
-    issues = []
-    warnings = []
-    
-    # Check 1: Docker CLI availability
-    try:
-        result = subprocess.run(['docker', '--version'], capture_output=True, text=True, timeout=5)
-        if result.returncode != 0:
-            issues.append('Docker CLI not available in agent container')
-    except Exception as e:
-        issues.append(f'Docker CLI check failed: {str(e)}')
-    
-    # Check 2: Docker socket access
+# ============================================================================
+# DIAGNOSTICS - registered checks, run concurrently under one deadline
+# ============================================================================
+class Diagnostics:
+    """Registry of health checks with per-check result caching.
+
+    A check returns (findings, data) where findings are (level, message)
+    pairs with level 'warning' or 'error'. Fresh results come from the
+    cache; expired ones are served (marked stale) while a single background
+    run refreshes them, unless older than MAX_STALE ttls. Checks still
+    running at the deadline are reported as timed out and land in the cache
+    when they finish.
+    """
+
+    MAX_STALE = 10
+
+    def __init__(self, deadline, workers=8):
+        self.deadline = deadline
+        self.checks = {}  # name -> (fn, ttl)
+        self.results = {}  # name -> result dict
+        self.running = {}  # name -> future
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='diagnostics')
+
+    def check(self, name, ttl):
+        def decorator(fn):
+            self.checks[name] = (fn, ttl)
+            return fn
+        return decorator
+
+    def _run(self, name):
+        fn, _ = self.checks[name]
+        started = time.perf_counter()
+        try:
+            findings, data = fn()
+        except Exception as e:
+            findings, data = [('error', f'{name} check failed: {e}')], None
+        levels = {level for level, _ in findings}
+        metrics.observe('diagnostics_check_duration_seconds', (name,), time.perf_counter() - started)
+        result = {
+            'status': 'error' if 'error' in levels else 'warning' if findings else 'ok',
+            'findings': findings,
+            'data': data,
+            'ms': round((time.perf_counter() - started) * 1000, 1),
+            'checked': time.time()
+        }
+        with self.lock:
+            self.results[name] = result
+            self.running.pop(name, None)
+        return result
+
+    def _submit(self, name):
+        """Start name unless it is already running (lock held)"""
+        future = self.running.get(name)
+        if future is None:
+            future = self.running[name] = self.executor.submit(self._run, name)
+        return future
+
+    def run(self, refresh=False):
+        """{name: result + cache info} within the deadline"""
+        now = time.time()
+        started = time.monotonic()
+        waiting, report = {}, {}
+        with self.lock:
+            for name, (_, ttl) in self.checks.items():
+                cached = self.results.get(name)
+                age = now - cached['checked'] if cached else None
+                if cached and not refresh and age < ttl:
+                    report[name] = dict(cached, age=round(age, 1), cached=True, stale=False)
+                elif cached and not refresh and age < ttl * self.MAX_STALE:
+                    self._submit(name)
+                    report[name] = dict(cached, age=round(age, 1), cached=True, stale=True)
+                else:
+                    waiting[name] = self._submit(name)
+        if waiting:
+            wait(waiting.values(), timeout=self.deadline)
+        for name, future in waiting.items():
+            if future.done():
+                report[name] = dict(future.result(), age=0.0, cached=False, stale=False)
+            else:
+                report[name] = {
+                    'status': 'timeout',
+                    'findings': [('warning', f'{name} check still running after {self.deadline:g}s')],
+                    'data': None,
+                    'ms': round((time.monotonic() - started) * 1000, 1),
+                    'checked': None, 'age': None, 'cached': False, 'stale': False
+                }
+        return {name: report[name] for name in self.checks}
+
+
+diagnostics_engine = Diagnostics(DIAGNOSTICS_DEADLINE)
+
+
+@diagnostics_engine.check('docker_cli', ttl=3600)
+def check_docker_cli():
+    # update and restart-all still run docker compose
+    path = shutil.which('docker')
+    return ([] if path else [('error', 'Docker CLI not available in agent container')]), path
+
+
+@diagnostics_engine.check('docker_socket', ttl=30)
+def check_docker_socket():
     try:
-        result = subprocess.run(['docker', 'ps'], capture_output=True, text=True, timeout=5)
-        if result.returncode != 0:
-            issues.append('Cannot access Docker socket')
+        return [], docker.version().get('Version')
     except Exception as e:
-        issues.append(f'Docker socket check failed: {str(e)}')
-    
-    # Check 3: Container status
-    services_status = {}
-    for svc in ['singbox', 'adguard', 'caddy']:
-        ok, out = execute_cmd(f'status_{svc}')
-        status = out.strip() if ok else 'not found'
-        services_status[svc] = status
-        if status == 'not found':
-            warnings.append(f'{svc} container not found')
-        elif status != 'running':
-            warnings.append(f'{svc} container status: {status}')
-    
-    # Check 4: Config files
+        return [('error', f'Cannot access Docker socket: {e}')], None
+
+
+@diagnostics_engine.check('containers', ttl=5)
+def check_containers():
+    states = container_states()
+    findings = []
+    for svc, state in states.items():
+        if state == 'not found':
+            findings.append(('warning', f'{svc} container not found'))
+        elif state != 'running':
+            findings.append(('warning', f'{svc} container status: {state}'))
+    return findings, states
+
+
+@diagnostics_engine.check('config_files', ttl=30)
+def check_config_files():
     config_files = {
         'singbox': os.path.join(CONFIG_DIR, 'singbox/config.json'),
         'adguard': os.path.join(CONFIG_DIR, 'adguard/AdGuardHome.yaml'),
     }
-    for name, path in config_files.items():
-        if not os.path.exists(path):
-            warnings.append(f'{name} config file missing: {path}')
-    
-    # Check 5: Network connectivity
+    return [('warning', f'{name} config file missing: {path}')
+            for name, path in config_files.items() if not os.path.exists(path)], None
+
+
+@diagnostics_engine.check('network', ttl=60)
+def check_network():
+    # A TCP handshake instead of forking ping (which also needs NET_RAW)
+    host, _, port = DIAGNOSTICS_PROBE.rpartition(':')
+    started = time.perf_counter()
     try:
-        result = subprocess.run(['ping', '-c', '1', '-W', '2', '8.8.8.8'], 
-                              capture_output=True, timeout=5)
-        if result.returncode != 0:
-            warnings.append('Network connectivity issue detected')
-    except:
-        pass
-    
+        socket.create_connection((host, int(port)), timeout=2).close()
+    except OSError as e:
+        return [('warning', f'Network connectivity issue detected: {e}')], None
+    return [], {'probe': DIAGNOSTICS_PROBE, 'connect_ms': round((time.perf_counter() - started) * 1000, 1)}
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/diagnostics')
+@require_auth
+@rate_limit(api_limiter)
+def diagnostics():
+    """Run diagnostics (cached per check; ?refresh=1 reruns all) and return system health status"""
+    started = time.monotonic()
+    checks = diagnostics_engine.run(refresh=request.args.get('refresh', '0').lower() in ('1', 'true', 'yes'))
+    issues = [message for result in checks.values() for level, message in result['findings'] if level == 'error']
+    warnings = [message for result in checks.values() for level, message in result['findings'] if level == 'warning']
+
     health_status = 'healthy' if not issues else 'unhealthy'
     if warnings and not issues:
         health_status = 'degraded'
-    
+
     return jsonify({
         'status': health_status,
         'issues': issues,
         'warnings': warnings,
-        'services': services_status,
-        'docker_cli': 'available' if not any('Docker CLI' in i for i in issues) else 'missing',
+        'services': checks['containers']['data'] or dict.fromkeys(['singbox', 'adguard', 'caddy'], 'unknown'),
+        'docker_cli': 'missing' if checks['docker_cli']['status'] == 'error' else 'available',
+        'docker_version': checks['docker_socket']['data'],
+        'checks': {
+            name: {k: result[k] for k in ('status', 'ms', 'age', 'cached', 'stale')} | {
+                'messages': [message for _, message in result['findings']]}
+            for name, result in checks.items()
+        },
+        'elapsed_ms': round((time.monotonic() - started) * 1000, 1),
         'timestamp': time.time()
     })
 
 
+# ============================================================================
+# LOG COLLECTOR - bounded, indexed store of parsed container log records
+# ============================================================================
+LOG_LEVELS = {'trace': 0, 'debug': 1, 'info': 2, 'warn': 3, 'warning': 3, 'error': 4, 'fatal': 5, 'panic': 5}
+LOG_LEVEL_NAMES = ['trace', 'debug', 'info', 'warn', 'error', 'fatal']
+LOG_LEVEL_RE = re.compile(r'\b(trace|debug|info|warn(?:ing)?|error|fatal|panic)\b', re.I)
+LOG_CLIENT_RE = re.compile(r'\bfrom \[?([0-9a-fA-F:.]+?)\]?:\d+')
+LOG_DEST_RE = re.compile(r'\bconnection to \[?([^\s\]]+?)\]?:\d+')
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+
+
+def connect_sqlite(path):
+    """Autocommit SQLite connection in WAL mode (one per thread)"""
+    db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+@lru_cache(maxsize=64)
+def _compile_regex(pattern):
+    return re.compile(pattern)
+
+
+def _sql_regexp(pattern, value):
+    return value is not None and _compile_regex(pattern).search(value) is not None
+
+
+def parse_docker_time(stamp):
+    """RFC 3339 docker timestamp (or unix seconds) -> epoch float"""
+    if re.match(r'^\d+(\.\d+)?$', stamp):
+        return float(stamp)
+    base, _, frac = stamp.rstrip('Z').partition('.')
+    return calendar.timegm(time.strptime(base[:19], '%Y-%m-%dT%H:%M:%S')) + float('0.' + (frac or '0'))
+
+
+def parse_log_line(line):
+    """Docker log line ('<timestamp> <text>') -> (ts, level, client, destination, message)"""
+    stamp, _, text = line.partition(' ')
+    text = ANSI_RE.sub('', text).rstrip()
+    level, client, destination = LOG_LEVELS['info'], None, None
+    if text.startswith('{'):
+        # Caddy logs structured JSON
+        try:
+            entry = json.loads(text)
+            req = entry.get('request') or {}
+            level = LOG_LEVELS.get(str(entry.get('level', '')).lower(), level)
+            client, destination = req.get('remote_ip') or req.get('client_ip'), req.get('host')
+        except (ValueError, AttributeError):
+            pass
+    else:
+        match = LOG_LEVEL_RE.search(text, 0, 64)
+        if match:
+            level = LOG_LEVELS[match.group(1).lower()]
+        match = LOG_CLIENT_RE.search(text)
+        if match:
+            client = match.group(1)
+        match = LOG_DEST_RE.search(text)
+        if match:
+            destination = match.group(1).lower()
+    return parse_docker_time(stamp), level, client, destination, text
+
+
+class LogCollector:
+    """Follows the service containers into LOG_DB; one worker collects, any worker queries.
+
+    Once a service holds TRIM_SLACK more than max_records, its oldest records
+    are deleted down to max_records, so the store behaves as a ring buffer
+    without a trim per batch. Indexes on (service, ts), (service, level, ts),
+    client and destination keep the common filters off full scans; free text
+    and regex filters run in SQLite over the already narrowed range.
+    """
+
+    SERVICES = ('singbox', 'adguard', 'caddy')
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY,
+            service TEXT NOT NULL,
+            ts REAL NOT NULL,
+            level INTEGER NOT NULL,
+            client TEXT,
+            destination TEXT,
+            message TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS records_service_id ON records(service, id);
+        CREATE INDEX IF NOT EXISTS records_service_ts ON records(service, ts);
+        CREATE INDEX IF NOT EXISTS records_service_level ON records(service, level, ts);
+        CREATE INDEX IF NOT EXISTS records_client ON records(client, ts);
+        CREATE INDEX IF NOT EXISTS records_destination ON records(destination, ts);
+    '''
+    MAX_LINE = 16384
+    TRIM_SLACK = 0.1  # fraction of max_records a service may exceed before it is trimmed
+
+    def __init__(self, path, max_records, batch_interval):
+        self.path = path
+        self.max_records = max_records
+        self.batch_interval = batch_interval
+        self.local = threading.local()
+        self.leader = LeaderLock(os.path.join(STATE_DIR, 'log-collector.lock'))
+        self.counts = {}  # service -> records stored, kept by the collecting worker
+        self.stats = defaultdict(int)
+
+    def _db(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = connect_sqlite(self.path)
+            db.executescript(self.SCHEMA)
+            db.create_function('regexp', 2, _sql_regexp, deterministic=True)
+            self.local.db = db
+        return db
+
+    def _follow(self, service):
+        last = self._db().execute('SELECT MAX(ts) FROM records WHERE service = ?', (service,)).fetchone()[0]
+        try:
+            stream = docker.open_logs(f'sui-{service}', tail=None if last else 1000,
+                                      since=f'{last:.9f}' if last else None, follow=True)
+        except (OSError, http.client.HTTPException, DockerError):
+            return None, 0  # container missing or docker unreachable; retried later
+        return stream, last or 0
+
+    def store(self, service, records):
+        db = self._db()
+        count = self.counts.get(service)
+        if count is None:
+            count = db.execute('SELECT COUNT(*) FROM records WHERE service = ?', (service,)).fetchone()[0]
+        count += len(records)
+        db.execute('BEGIN')
+        try:
+            db.executemany(
+                'INSERT INTO records (service, ts, level, client, destination, message) VALUES (?, ?, ?, ?, ?, ?)',
+                [(service, *record) for record in records]
+            )
+            if count > self.max_records * (1 + self.TRIM_SLACK):
+                # Walks records_service_id from the newest end; no sort
+                db.execute(
+                    'DELETE FROM records WHERE service = ? AND id <= '
+                    '(SELECT id FROM records WHERE service = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                    (service, service, self.max_records)
+                )
+                count = min(count, self.max_records)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            self.counts.pop(service, None)
+            raise
+        self.counts[service] = count
+        self.stats['stored'] += len(records)
+
+    def run(self):
+        followers = {}  # fd -> [service, log stream, partial line, newest ts stored before following]
+        retry_at = dict.fromkeys(self.SERVICES, 0)
+        batches = defaultdict(list)
+        next_flush = time.monotonic() + self.batch_interval
+        while True:
+            try:
+                if not self.leader.acquire():
+                    time.sleep(30)
+                    continue
+                now = time.monotonic()
+                running = {state[0] for state in followers.values()}
+                for service in self.SERVICES:
+                    if service not in running and now >= retry_at[service]:
+                        retry_at[service] = now + 10
+                        stream, last = self._follow(service)
+                        if stream:
+                            followers[stream.fileno()] = [service, stream, b'', last]
+                ready = select.select(list(followers), [], [], self.batch_interval)[0] if followers else []
+                if not followers:
+                    time.sleep(self.batch_interval)
+                for fd in ready:
+                    state = followers[fd]
+                    service, stream, pending, last = state
+                    chunk = stream.read()
+                    if not chunk:
+                        # Container stopped or missing; followed again once retry_at passes
+                        stream.close()
+                        del followers[fd]
+                        continue
+                    *lines, pending = (pending + chunk).split(b'\n')
+                    state[2] = pending if len(pending) <= self.MAX_LINE else b''
+                    for raw in lines:
+                        try:
+                            record = parse_log_line(raw.decode(errors='replace')[:self.MAX_LINE])
+                        except ValueError:
+                            self.stats['unparsed'] += 1
+                            continue
+                        if record[0] > last:
+                            batches[service].append(record)
+                if time.monotonic() >= next_flush:
+                    for service, records in batches.items():
+                        if records:
+                            self.store(service, records)
+                    batches.clear()
+                    next_flush = time.monotonic() + self.batch_interval
+            except Exception as e:
+                app.logger.error(f'Log collector error: {e}')
+                time.sleep(self.batch_interval)
+
+    def query(self, service, since=None, until=None, level=None, contains=None, regex=None,
+              client=None, destination=None, limit=200, newest_first=True):
+        sql, args = 'SELECT ts, level, client, destination, message FROM records WHERE service = ?', [service]
+        for clause, value in (('ts >= ?', since), ('ts <= ?', until), ('level >= ?', level),
+                              ('instr(message, ?) > 0', contains), ('message REGEXP ?', regex),
+                              ('client = ?', client)):
+            if value is not None:
+                sql += f' AND {clause}'
+                args.append(value)
+        if destination is not None:
+            if destination.startswith('*.'):
+                sql += " AND (destination = ? OR destination LIKE ? ESCAPE '\\')"
+                suffix = destination[2:].lower()
+                args += [suffix, '%.' + suffix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')]
+            else:
+                sql += ' AND destination = ?'
+                args.append(destination.lower())
+        sql += f" ORDER BY ts {'DESC' if newest_first else 'ASC'}, id {'DESC' if newest_first else 'ASC'} LIMIT ?"
+        args.append(limit + 1)
+        rows = self._db().execute(sql, args).fetchall()
+        return [{
+            'ts': ts,
+            'time': datetime.fromtimestamp(ts, timezone.utc).isoformat(),
+            'level': LOG_LEVEL_NAMES[min(level, len(LOG_LEVEL_NAMES) - 1)],
+            'client': client,
+            'destination': destination,
+            'message': message
+        } for ts, level, client, destination, message in rows[:limit]], len(rows) > limit
+
+
+log_collector = LogCollector(LOG_DB, LOG_BUFFER_MAX_RECORDS, LOG_COLLECT_INTERVAL)
+_background_lock = threading.Lock()
+_background_started = False
+
+
+@app.before_request
+def start_background_tasks():
+    """Start per-worker background threads on the first request"""
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+        if LOG_BUFFER_MAX_RECORDS > 0:
+            threading.Thread(target=log_collector.run, name='log-collector', daemon=True).start()
+        threading.Thread(target=metrics.run, args=(METRICS_FLUSH_INTERVAL,), name='metrics', daemon=True).start()
+        threading.Thread(target=container_cache.run, name='container-events', daemon=True).start()
+        if MASTER_EVENTS_URL:
+            threading.Thread(target=container_cache.push_loop, name='event-push', daemon=True).start()
+        if STATS_SAMPLE_INTERVAL > 0:
+            threading.Thread(target=traffic_sampler.run, name='traffic-sampler', daemon=True).start()
+            if MASTER_USAGE_URL:
+                threading.Thread(target=usage_outbox.run, name='usage-push', daemon=True).start()
+
+
+@metrics.collector
+def collect_component_counters():
+    for limiter in (api_limiter, auth_limiter):
+        yield 'rate_limit_rejections_total', (limiter.name,), limiter.rejected
+    for event in ('stored', 'unparsed'):
+        yield 'log_collector_records_total', (event,), log_collector.stats[event]
+    for event in ('events', 'changes', 'reconnects', 'pushed', 'push_failures'):
+        yield 'container_events_total', (event,), container_cache.stats[event]
+    for event in ('batches', 'users', 'failures'):
+        yield 'usage_push_total', (event,), usage_outbox.stats[event]
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/metrics')
+@require_auth
+def metrics_endpoint():
+    """Prometheus text exposition summed over all workers"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def _time_arg(value):
+    """Query time bound: unix seconds or ISO 8601 (UTC when no offset is given)"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return (parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)).timestamp()
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/logs/<service>/query')
+@require_auth
+@rate_limit(api_limiter)
+def logs_query(service):
+    """Filter collected records: since, until, level (minimum), q (substring), regex, client, destination, limit, order"""
+    try:
+        service = sanitize_service(service)
+        since, until = _time_arg(request.args.get('since')), _time_arg(request.args.get('until'))
+        level = request.args.get('level')
+        if level is not None and level.lower() not in LOG_LEVELS:
+            raise ValueError(f'Invalid level: {level}')
+        regex = request.args.get('regex') or None
+        if regex is not None:
+            if len(regex) > 256:
+                raise ValueError('regex too long')
+            _compile_regex(regex)
+        limit = min(max(int(request.args.get('limit', '200')), 1), 5000)
+    except (ValueError, re.error) as e:
+        return jsonify({'error': str(e)}), 400
+    started = time.monotonic()
+    records, truncated = log_collector.query(
+        service, since, until, LOG_LEVELS[level.lower()] if level else None,
+        request.args.get('q') or None, regex, request.args.get('client') or None,
+        request.args.get('destination') or None, limit, request.args.get('order', 'desc') != 'asc'
+    )
+    return jsonify({
+        'service': service,
+        'records': records,
+        'count': len(records),
+        'truncated': truncated,
+        'query_ms': round((time.monotonic() - started) * 1000, 1)
+    })
+
+
+# ============================================================================
+# TRAFFIC STATS - sing-box clash API samples in fixed-size ring buffers
+# ============================================================================
+class StatsStore:
+    """Fixed-size traffic time series shared by the workers through an mmap.
+
+    Series ('total', 'inbound:<tag>', 'user:<name>') occupy up to max_series
+    fixed blocks; each block holds one ring per resolution where a bucket
+    lives at slot (ts // step) % capacity and its stored start tells whether
+    the slot is current or left over from an earlier lap. Buckets keep bytes
+    up/down, peak connections and the connection sum for averages. The
+    sampling worker writes under an exclusive flock, queries take a shared one.
+    """
+
+    RESOLUTIONS = {'1m': (60, 720), '1h': (3600, 336), '1d': (86400, 90)}
+    FIELDS = ('start', 'up', 'down', 'conn_max', 'conn_sum', 'samples')
+    NAME_SIZE = 64
+
+    def __init__(self, path, max_series):
+        self.max_series = max_series
+        self.block_size = self.NAME_SIZE + 8 + 8 * len(self.FIELDS) * sum(cap for _, cap in self.RESOLUTIONS.values())
+        size = self.block_size * max_series
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size != size:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(self.fd, size)
+        self.index = {}  # series name -> block number (writer side)
+
+    def _name(self, block):
+        offset = block * self.block_size
+        return self.map[offset:offset + self.NAME_SIZE].rstrip(b'\0').decode()
+
+    def _last_seen(self, block):
+        return struct.unpack_from('<d', self.map, block * self.block_size + self.NAME_SIZE)[0]
+
+    def _rings(self, block):
+        """{resolution: {field: memoryview of doubles}} for one block"""
+        view = memoryview(self.map)
+        offset = block * self.block_size + self.NAME_SIZE + 8
+        rings = {}
+        for resolution, (_, cap) in self.RESOLUTIONS.items():
+            fields = {}
+            for field in self.FIELDS:
+                fields[field] = view[offset:offset + 8 * cap].cast('d')
+                offset += 8 * cap
+            rings[resolution] = fields
+        return rings
+
+    def _block(self, name):
+        block = self.index.get(name)
+        if block is not None:
+            return block
+        names = {self._name(b): b for b in range(self.max_series)}
+        self.index = {n: b for n, b in names.items() if n}
+        if name in self.index:
+            return self.index[name]
+        free = [b for n, b in names.items() if not n]
+        if free:
+            block = free[0]
+        else:
+            # Reuse the series that has been idle longest ('total' is always fresh)
+            block = min(self.index.values(), key=self._last_seen)
+            del self.index[self._name(block)]
+        offset = block * self.block_size
+        self.map[offset:offset + self.block_size] = bytes(self.block_size)
+        self.map[offset:offset + self.NAME_SIZE] = name.encode()[:self.NAME_SIZE].ljust(self.NAME_SIZE, b'\0')
+        self.index[name] = block
+        return block
+
+    def record(self, samples, ts):
+        """samples: {series name: (bytes up, bytes down, active connections)}"""
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            for name, (up, down, connections) in samples.items():
+                block = self._block(name)
+                struct.pack_into('<d', self.map, block * self.block_size + self.NAME_SIZE, ts)
+                for resolution, ring in self._rings(block).items():
+                    step, cap = self.RESOLUTIONS[resolution]
+                    start = ts - ts % step
+                    slot = int(ts // step) % cap
+                    if ring['start'][slot] != start:
+                        for field in self.FIELDS:
+                            ring[field][slot] = 0
+                        ring['start'][slot] = start
+                    ring['up'][slot] += up
+                    ring['down'][slot] += down
+                    ring['conn_max'][slot] = max(ring['conn_max'][slot], connections)
+                    ring['conn_sum'][slot] += connections
+                    ring['samples'][slot] += 1
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def series(self):
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            return sorted((name, self._last_seen(b)) for b in range(self.max_series) if (name := self._name(b)))
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def query(self, names, resolution, since=None, until=None):
+        """{name: [[bucket start, up, down, peak connections, average connections], ...]} oldest first"""
+        step, cap = self.RESOLUTIONS[resolution]
+        now = time.time()
+        oldest = max(now - now % step - (cap - 1) * step, since or 0)
+        result = {}
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            blocks = {self._name(b): b for b in range(self.max_series)}
+            for name in names:
+                if name not in blocks:
+                    continue
+                ring = self._rings(blocks[name])[resolution]
+                points = [
+                    [int(start), int(ring['up'][i]), int(ring['down'][i]), int(ring['conn_max'][i]),
+                     round(ring['conn_sum'][i] / ring['samples'][i], 2) if ring['samples'][i] else 0]
+                    for i, start in enumerate(ring['start'])
+                    if start and oldest <= start <= (until if until is not None else now)
+                ]
+                result[name] = sorted(points)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return result
+
+
+class TrafficSampler:
+    """Samples the sing-box clash API; one worker samples, any worker queries.
+
+    Every interval it reads /connections once. Global bytes come from the
+    cumulative uploadTotal/downloadTotal counters; per-inbound and per-user
+    bytes are the growth of each open connection since the previous sample
+    (bytes of a connection that closes between samples after its last sample
+    are only in the totals). Connection counts are the connections open now.
+    """
+
+    def __init__(self, url, secret, interval, store_factory, source=None, usage=None):
+        self.url = url.rstrip('/')
+        self.secret = secret
+        self.interval = interval
+        self.store_factory = store_factory
+        self.source = source  # replaces the clash API call when set
+        self.usage = usage  # UsageOutbox for master-managed users
+        self.store = None
+        self.leader = LeaderLock(os.path.join(STATE_DIR, 'traffic-sampler.lock'))
+        self.previous = {}  # connection id -> (upload, download)
+        self.previous_totals = None
+        self.last_sample = {}
+
+    def get_store(self):
+        if self.store is None:
+            os.makedirs(RUNTIME_DIR, exist_ok=True)
+            self.store = self.store_factory()
+        return self.store
+
+    def fetch(self):
+        if self.source is not None:
+            return self.source()
+        req = urllib.request.Request(f'{self.url}/connections')
+        # Without SINGBOX_API_SECRET use the secret the installer put into the sing-box config
+        secret = self.secret or ((load_singbox_config().get('experimental') or {}).get('clash_api') or {}).get('secret')
+        if secret:
+            req.add_header('Authorization', f'Bearer {secret}')
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            return json.load(resp)
+
+    def sample_once(self):
+        data = self.fetch()
+        now = time.time()
+        totals = (data.get('uploadTotal', 0), data.get('downloadTotal', 0))
+        prev = self.previous_totals
+        # Counters restart from zero when sing-box restarts
+        delta = tuple(t - p if prev and t >= p else (t if prev else 0) for t, p in zip(totals, prev or (0, 0)))
+        samples = {'total': [delta[0], delta[1], 0]}
+        current = {}
+        for conn in data.get('connections') or []:
+            meta = conn.get('metadata') or {}
+            up, down = conn.get('upload', 0), conn.get('download', 0)
+            current[conn.get('id')] = (up, down)
+            last_up, last_down = self.previous.get(conn.get('id'), (0, 0))
+            inbound = (meta.get('type') or 'unknown').split('/')[-1]
+            user = meta.get('user') or meta.get('inboundUser')
+            samples['total'][2] += 1
+            for name in (f'inbound:{inbound}', f'user:{user}' if user else None):
+                if name:
+                    entry = samples.setdefault(name, [0, 0, 0])
+                    entry[0] += max(up - last_up, 0)
+                    entry[1] += max(down - last_down, 0)
+                    entry[2] += 1
+        if self.usage is not None:
+            # Master-managed users are accounted on the master; thousands of them would only
+            # churn the fixed series slots here
+            prefix = f'user:{MANAGED_USER_PREFIX}'
+            managed = {name: samples.pop(name) for name in [n for n in samples if n.startswith(prefix)]}
+            if prev is not None:
+                self.usage.add({name[5:]: (up, down) for name, (up, down, _) in managed.items() if up or down})
+        if prev is not None:
+            self.get_store().record({name: tuple(values) for name, values in samples.items()}, now)
+        self.previous, self.previous_totals = current, totals
+        self.last_sample = {'at': now, 'connections': samples['total'][2], 'series': len(samples)}
+
+    def run(self):
+        while True:
+            try:
+                if self.leader.acquire():
+                    self.sample_once()
+                    time.sleep(self.interval)
+                else:
+                    time.sleep(30)
+            except Exception as e:
+                self.last_sample = {'error': str(e), 'at': time.time()}
+                time.sleep(self.interval)
+
+
+class UsageOutbox:
+    """Per-user byte deltas waiting to be shipped to the master.
+
+    The sampler adds each user's growth to `pending`, two counters per user
+    however long the master stays unreachable. A push freezes pending into a
+    numbered batch that is resent unchanged until the master acknowledges it,
+    so a retry after a lost response is recognized as a duplicate instead of
+    being counted twice; new growth meanwhile collects in a fresh pending.
+    """
+
+    def __init__(self, url, interval):
+        self.url = url
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = {}  # user -> [bytes up, bytes down]
+        self.inflight = None
+        self.boot = uuid_lib.uuid4().hex[:12]
+        self.seq = 0
+        self.stats = defaultdict(int)
+
+    def add(self, usage):
+        with self.lock:
+            for user, (up, down) in usage.items():
+                entry = self.pending.get(user)
+                if entry is None:
+                    self.pending[user] = [up, down]
+                else:
+                    entry[0] += up
+                    entry[1] += down
+
+    def push_once(self):
+        """Ship the in-flight batch (or freeze pending into one); returns the number of users sent"""
+        with self.lock:
+            if self.inflight is None:
+                if not self.pending:
+                    return 0
+                self.seq += 1
+                self.inflight = {'boot': self.boot, 'seq': self.seq, 'usage': self.pending}
+                self.pending = {}
+            batch = self.inflight
+        body = json.dumps({'domain': NODE_DOMAIN, **batch}, separators=(',', ':'))
+        req = urllib.request.Request(self.url, data=body.encode(), method='POST', headers={
+            'Content-Type': 'application/json', 'X-SUI-Token': CLUSTER_SECRET})
+        with urllib.request.urlopen(req, timeout=30) as resp:
+            resp.read()
+        with self.lock:
+            self.inflight = None
+        self.stats['batches'] += 1
+        self.stats['users'] += len(batch['usage'])
+        return len(batch['usage'])
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.push_once()
+            except Exception as e:
+                self.stats['failures'] += 1
+                app.logger.warning(f'Usage push to master failed: {e}')
+
+
+class StubConnectionsSource:
+    """Stand-in for the clash API /connections (STATS_SOURCE=stub): one long-lived
+    connection per user in the sing-box config, or `clients` made-up users on the
+    template's inbounds when it has none; counters grow by up to `rate` bytes a call"""
+
+    INBOUND_TAGS = {'vless': 'vless-in', 'hysteria2': 'hy2-in'}
+
+    def __init__(self, rate=1 << 20, clients=4):
+        self.rate = rate
+        self.clients = [(f'stub-{i}', list(self.INBOUND_TAGS)[i % len(self.INBOUND_TAGS)]) for i in range(clients)]
+        self.counters = {}
+        self.totals = [0, 0]
+
+    def __call__(self):
+        _, users = user_index.load()
+        clients = [(name, next(iter(inbounds))) for name, inbounds in users.items() if name] or self.clients
+        connections = []
+        for name, inbound in clients:
+            up, down = random.randint(0, self.rate // 8), random.randint(0, self.rate)
+            counters = self.counters.setdefault(name, [0, 0])
+            counters[0] += up
+            counters[1] += down
+            self.totals[0] += up
+            self.totals[1] += down
+            tag = self.INBOUND_TAGS.get(inbound, f'{inbound}-in')
+            connections.append({'id': f'stub-{name}', 'upload': counters[0], 'download': counters[1],
+                                'metadata': {'type': f'{inbound}/{tag}', 'user': name}})
+        return {'uploadTotal': self.totals[0], 'downloadTotal': self.totals[1], 'connections': connections}
+
+
+usage_outbox = UsageOutbox(MASTER_USAGE_URL, USAGE_PUSH_INTERVAL)
+
+traffic_sampler = TrafficSampler(
+    SINGBOX_API_URL, SINGBOX_API_SECRET, STATS_SAMPLE_INTERVAL,
+    lambda: StatsStore(os.path.join(RUNTIME_DIR, 'sui-agent-traffic.bin'), STATS_MAX_SERIES),
+    source=StubConnectionsSource() if STATS_SOURCE == 'stub' else None,
+    usage=usage_outbox if MASTER_USAGE_URL else None
+)
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/stats')
+@require_auth
+@rate_limit(api_limiter)
+def traffic_stats():
+    """Traffic time series: ?series=total,inbound:vless-in&resolution=1m|1h|1d&since=&until= (no series: list them)"""
+    store = traffic_sampler.get_store()
+    series = [s for s in request.args.get('series', '').split(',') if s]
+    if not series:
+        known = store.series()
+        return jsonify({
+            'series': [{'name': name, 'last_seen': last_seen} for name, last_seen in known],
+            'resolutions': {name: {'step': step, 'points': cap} for name, (step, cap) in StatsStore.RESOLUTIONS.items()},
+            # Only the sampling worker knows about errors; every worker sees the last sample time
+            'sampler': traffic_sampler.last_sample or {'at': dict(known).get('total'), 'interval': STATS_SAMPLE_INTERVAL}
+        })
+    resolution = request.args.get('resolution', '1m')
+    if resolution not in StatsStore.RESOLUTIONS:
+        return jsonify({'error': f'Invalid resolution: {resolution}'}), 400
+    try:
+        since, until = _time_arg(request.args.get('since')), _time_arg(request.args.get('until'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({
+        'resolution': resolution,
+        'step': StatsStore.RESOLUTIONS[resolution][0],
+        'columns': ['start', 'up', 'down', 'conn_max', 'conn_avg'],
+        'series': store.query(series, resolution, since, until)
+    })
+
+
+# ============================================================================
+# CONFIG APPLY - validate, swap atomically, reload in place, roll back
+# ============================================================================
+def write_atomic(path, content):
+    """Replace path with content via a synced temp file and rename (readers see old or new, never half)"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    tmp = f'{path}.tmp.{os.getpid()}.{threading.get_ident()}'
+    try:
+        with open(tmp, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SingboxApplier:
+    """Apply pipeline for the sing-box config.
+
+    The candidate is validated, written next to the live file and checked
+    with `sing-box check` inside the container. It then replaces the live
+    file by rename, and sing-box is reloaded with SIGHUP (or restarted when
+    SINGBOX_RELOAD_MODE=restart or the signal cannot be delivered). Health
+    means the container is still running without having been restarted,
+    and the clash API answers when the config enables it. A failed health
+    check restores config.json.lkg, the last config that passed, and
+    reloads again. Applies are serialized across workers with flock.
+    """
+
+    def __init__(self, path, container, container_dir, mode, settle, health_timeout):
+        self.path = path
+        self.lkg_path = f'{path}.lkg'
+        self.candidate_path = f'{path}.new'
+        self.container = container
+        self.container_dir = container_dir
+        self.mode = mode
+        self.settle = settle
+        self.health_timeout = health_timeout
+
+    def _container(self):
+        try:
+            return docker.inspect(self.container)
+        except DockerError as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def _connections(self):
+        """Open connection ids from the clash API, None when it is not reachable"""
+        try:
+            return {c.get('id') for c in traffic_sampler.fetch().get('connections') or []}
+        except Exception:
+            return None
+
+    def _reload(self):
+        if self.mode == 'signal':
+            try:
+                docker.kill(self.container, 'HUP')
+                return 'reload'
+            except DockerError as e:
+                app.logger.warning(f'sing-box reload signal failed ({e}), restarting instead')
+        docker.restart(self.container)
+        return 'restart'
+
+    def _wait_healthy(self, mode, started_at, clash_api):
+        """(healthy, reason) once the reloaded instance has held up for the settle time"""
+        time.sleep(self.settle)
+        deadline = time.monotonic() + self.health_timeout
+        reason = 'health check timed out'
+        while True:
+            state = ((self._container() or {}).get('State')) or {}
+            if not state.get('Running'):
+                reason = f"container {state.get('Status', 'missing')} (exit code {state.get('ExitCode')})"
+            elif mode == 'reload' and state.get('StartedAt') != started_at:
+                return False, 'sing-box exited on reload and was restarted'
+            elif clash_api and self._connections() is None:
+                reason = 'clash API not answering'
+            else:
+                return True, None
+            if time.monotonic() >= deadline:
+                return False, reason
+            time.sleep(0.25)
+
+    def _activate(self, content):
+        """Swap content in and reload -> (mode, healthy, reason, reload ms)"""
+        started_at = ((self._container() or {}).get('State') or {}).get('StartedAt')
+        write_atomic(self.path, content)
+        started = time.perf_counter()
+        mode = self._reload()
+        reload_ms = round((time.perf_counter() - started) * 1000, 1)
+        clash_api = bool((json.loads(content).get('experimental') or {}).get('clash_api'))
+        healthy, reason = self._wait_healthy(mode, started_at, clash_api)
+        return mode, healthy, reason, reload_ms
+
+    def apply(self, config):
+        started = time.perf_counter()
+        timings = {}
+
+        def mark(step, since):
+            timings[f'{step}_ms'] = round((time.perf_counter() - since) * 1000, 1)
+            return time.perf_counter()
+
+        report = {'success': False, 'mode': None, 'rolled_back': False, 'check': None, 'connections': None,
+                  'timings': timings}
+        content = json.dumps(config, indent=2)
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with open(os.path.join(STATE_DIR, 'singbox-apply.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            step = mark('lock_wait', started)
+            try:
+                container = self._container()
+                running = bool(container and (container.get('State') or {}).get('Running'))
+                if running:
+                    write_atomic(self.candidate_path, content)
+                    try:
+                        code, output = docker.exec_run(self.container, [
+                            'sing-box', 'check', '-c', f'{self.container_dir}/{os.path.basename(self.candidate_path)}'
+                        ], timeout=30)
+                    finally:
+                        os.unlink(self.candidate_path)
+                    step = mark('check', step)
+                    if code != 0:
+                        report.update(check='failed', error=f'sing-box check failed: {output.strip()[:2000]}')
+                        return report
+                    report['check'] = 'passed'
+                else:
+                    report['check'] = 'skipped (container not running)'
+
+                if os.path.exists(self.path) and not os.path.exists(self.lkg_path):
+                    with open(self.path) as f:
+                        write_atomic(self.lkg_path, f.read())
+                if not running:
+                    write_atomic(self.path, content)
+                    report.update(success=True, mode='none')  # picked up when the container starts
+                    return report
+
+                before = self._connections()
+                mode, healthy, reason, timings['reload_ms'] = self._activate(content)
+                step = mark('healthy', step)
+                report['mode'] = mode
+                after = self._connections()
+                if before is not None and after is not None:
+                    report['connections'] = {'before': len(before), 'after': len(after),
+                                             'survived': len(before & after), 'dropped': len(before - after)}
+                if healthy:
+                    write_atomic(self.lkg_path, content)
+                    report['success'] = True
+                    return report
+
+                report['error'] = f'Health check failed after {mode}: {reason}'
+                if os.path.exists(self.lkg_path):
+                    with open(self.lkg_path) as f:
+                        known_good = f.read()
+                    _, rollback_healthy, rollback_reason, _ = self._activate(known_good)
+                    mark('rollback', step)
+                    report.update(rolled_back=True, rollback_healthy=rollback_healthy)
+                    if not rollback_healthy:
+                        report['rollback_error'] = rollback_reason
+                return report
+            except (OSError, http.client.HTTPException, DockerError) as e:
+                report['error'] = f'Apply failed: {e}'
+                return report
+            finally:
+                timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+                metrics.observe('config_apply_duration_seconds',
+                                ('ok' if report['success'] else 'rolled_back' if report['rolled_back'] else 'failed'),
+                                time.perf_counter() - started)
+
+
+singbox_applier = SingboxApplier(
+    os.path.join(CONFIG_DIR, 'singbox/config.json'), 'sui-singbox', SINGBOX_CONTAINER_CONFIG_DIR,
+    SINGBOX_RELOAD_MODE, SINGBOX_APPLY_SETTLE, SINGBOX_APPLY_HEALTH_TIMEOUT
+)
+
+
+def ensure_clash_api():
+    """Add the clash API the traffic sampler reads to configs installed before the template had it.
+
+    Only runs when the operator asks for it (POST /api/v1/stats/clash-api); the
+    change goes through the normal apply (check, reload, health, rollback).
+    Returns its report, or None when the block is already there.
+    """
+    config = load_singbox_config() if os.path.exists(singbox_applier.path) else {}
+    if not config or (config.get('experimental') or {}).get('clash_api'):
+        return None
+    config.setdefault('experimental', {})['clash_api'] = {
+        'external_controller': f'0.0.0.0:{urlsplit(SINGBOX_API_URL).port or 9090}',
+        # Without SINGBOX_API_SECRET the sampler reads the secret back from the config
+        'secret': SINGBOX_API_SECRET or os.urandom(24).hex(),
+    }
+    report = singbox_applier.apply(config)
+    if report['success']:
+        app.logger.info('Added experimental.clash_api to the sing-box config for traffic statistics')
+    else:
+        app.logger.error(f"Adding experimental.clash_api failed: {report.get('error')}")
+    return report
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/stats/clash-api', methods=['POST'])
+@require_auth
+@rate_limit(api_limiter)
+def enable_clash_api():
+    """Opt in to traffic statistics on a sing-box config that has no clash API block yet"""
+    report = ensure_clash_api()
+    if report is None:
+        return jsonify({'success': True, 'changed': False})
+    return jsonify({**report, 'changed': report['success']})
+
+
 # ============================================================================
 # FIREWALL MANAGEMENT (provides commands for manual configuration)
 # ============================================================================
@@ -572,34 +3111,194 @@ def find_inbound(config, inbound_type):
     return None
 
 
+# Credential field per multi-user inbound type
+USER_INBOUNDS = {'vless': 'uuid', 'hysteria2': 'password'}
+MANAGED_USER_PATTERN = re.compile(r'^' + re.escape(MANAGED_USER_PREFIX) + r'[A-Za-z0-9_-]{1,64}$')
+UUID_PATTERN = re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')
+
+
+class UserIndex:
+    """name -> {inbound type: user} over the live config, rebuilt only when config.json changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.key = None
+        self.config = {}
+        self.users = {}
+
+    def load(self):
+        """(config, users by name); lookups are dict hits until the file is replaced"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return {}, {}
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self.lock:
+            if key != self.key:
+                config = load_singbox_config()
+                users = defaultdict(dict)
+                for inbound in config.get('inbounds', []):
+                    if inbound.get('type') in USER_INBOUNDS:
+                        for user in inbound.get('users') or []:
+                            users[user.get('name', '')].setdefault(inbound['type'], user)
+                self.key, self.config, self.users = key, config, dict(users)
+            return self.config, self.users
+
+
+user_index = UserIndex(os.path.join(CONFIG_DIR, 'singbox/config.json'))
+
+
+def merge_managed_users(config, users):
+    """Replace the master-managed users of every vless/hysteria2 inbound; True if anything changed.
+
+    Users not named with MANAGED_USER_PREFIX (the install-time credentials)
+    stay first, so /subscribe without ?user= keeps handing them out.
+    """
+    changed = False
+    for inbound in config.get('inbounds', []):
+        field = USER_INBOUNDS.get(inbound.get('type'))
+        if field is None:
+            continue
+        current = inbound.get('users') or []
+        kept = [u for u in current if not str(u.get('name', '')).startswith(MANAGED_USER_PREFIX)]
+        # vless flow must match the inbound's transport, so follow what the existing users use
+        flow = next((u['flow'] for u in current if 'flow' in u), None) if field == 'uuid' else None
+        merged = kept + [{'name': u['name'], field: u[field], **({'flow': flow} if flow is not None else {})}
+                         for u in users]
+        if merged != current:
+            inbound['users'] = merged
+            changed = True
+    return changed
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/users', methods=['GET', 'POST'])
+@require_auth
+@rate_limit(api_limiter)
+def managed_users():
+    """Master-managed users of the vless/hysteria2 inbounds; POST replaces the whole set and applies it"""
+    if request.method == 'GET':
+        _, users = user_index.load()
+        managed = sorted(name for name in users if name.startswith(MANAGED_USER_PREFIX))
+        return jsonify({'users': managed, 'count': len(managed)})
+
+    users = (request.get_json(silent=True) or {}).get('users')
+    if not isinstance(users, list):
+        return jsonify({'success': False, 'error': 'users must be a list'}), 400
+    for i, user in enumerate(users):
+        if not (isinstance(user, dict) and MANAGED_USER_PATTERN.match(str(user.get('name', '')))
+                and UUID_PATTERN.match(str(user.get('uuid', ''))) and isinstance(user.get('password'), str)
+                and user['password']):
+            return jsonify({'success': False, 'error': f'users[{i}]: needs a {MANAGED_USER_PREFIX}* name, '
+                                                       f'a uuid and a password'}), 400
+    if not os.path.exists(singbox_applier.path):
+        return jsonify({'success': False, 'error': 'sing-box config not found'}), 404
+
+    config = load_singbox_config()
+    if not merge_managed_users(config, users):
+        return jsonify({'success': True, 'changed': False, 'users': len(users)})
+    errors = check_singbox_config(config)
+    if errors:
+        return jsonify({'success': False, 'error': f"{errors[0]['path']}: {errors[0]['message']}"}), 400
+    return jsonify({**singbox_applier.apply(config), 'changed': True, 'users': len(users)})
+
+
 @app.route(f'/{PATH_PREFIX}/api/v1/subscribe')
 @require_auth
 @rate_limit(api_limiter)
 def node_subscribe():
-    """Get subscription links for this node (from actual sing-box config)"""
-    config = load_singbox_config()
+    """Subscription links for this node (from the actual sing-box config).
+
+    Links carry the first user of each inbound, or the user named by ?user=.
+    """
+    config, users = user_index.load()
+    name = request.args.get('user')
+    if name is not None and name not in users:
+        return jsonify({'error': 'User not found'}), 404
     links = []
-    
+
+    def credential(inbound, field):
+        user = users[name].get(inbound['type']) if name is not None else (inbound.get('users') or [None])[0]
+        return user.get(field, '') if user else None
+
     # VLESS + XTLS-Vision + TLS (port 443)
     vless_inbound = find_inbound(config, 'vless')
-    if vless_inbound and vless_inbound.get('users'):
-        uuid = vless_inbound['users'][0].get('uuid', '')
+    uuid = credential(vless_inbound, 'uuid') if vless_inbound else None
+    if uuid is not None:
         port = vless_inbound.get('listen_port', 443)
         # VLESS link format: vless://uuid@domain:port?params#name
         link = f"vless://{uuid}@{NODE_DOMAIN}:{port}?encryption=none&flow=xtls-rprx-vision&security=tls&sni={NODE_DOMAIN}&alpn=h2,http/1.1&type=tcp#{NODE_DOMAIN}-VLESS"
         links.append({'type': 'vless', 'link': link, 'port': port})
-    
+
     # Hysteria2 (port 50000-60000 with port hopping)
     hy2_inbound = find_inbound(config, 'hysteria2')
-    if hy2_inbound and hy2_inbound.get('users'):
-        password = hy2_inbound['users'][0].get('password', '')
+    password = credential(hy2_inbound, 'password') if hy2_inbound else None
+    if password is not None:
         port = hy2_inbound.get('listen_port', 50000)
         # Hysteria2 link format: hysteria2://password@domain:port?params#name
         # Note: Port hopping is handled by client automatically when using port range
         link = f"hysteria2://{password}@{NODE_DOMAIN}:{port}?sni={NODE_DOMAIN}&alpn=h3#{NODE_DOMAIN}-Hysteria2"
         links.append({'type': 'hysteria2', 'link': link, 'port': port})
-    
-    return jsonify({'links': links, 'domain': NODE_DOMAIN})
+
+    # ETag over the link set lets master revalidate with a 304 instead of a full payload
+    body = {'links': links, 'domain': NODE_DOMAIN}
+    etag = '"' + hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()[:32] + '"'
+    if etag in [t.strip() for t in request.headers.get('If-None-Match', '').split(',')]:
+        return '', 304, {'ETag': etag}
+    resp = jsonify({**body, 'etag': etag})
+    resp.headers['ETag'] = etag
+    return resp
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/templates', methods=['GET'])
+@require_auth
+@rate_limit(api_limiter)
+def list_templates():
+    """Template sources with their declared parameters; master compiles these for bulk rendering"""
+    templates = {}
+    for name, (_, kind, params) in CONFIG_TEMPLATES.items():
+        try:
+            template = config_templates.get(name)
+        except OSError:
+            continue
+        templates[name] = {'format': kind, 'params': params, 'used': sorted(template.used),
+                           'hash': template.hash, 'source': template.source}
+    return jsonify({'templates': templates})
+
+
+@app.route(f'/{PATH_PREFIX}/api/v1/templates/<name>/render', methods=['POST'])
+@require_auth
+@rate_limit(api_limiter)
+def render_config_template(name):
+    """Render a template from typed parameters; sing-box output is schema-checked and optionally applied"""
+    data = request.get_json(silent=True) or {}
+    params = data.get('params')
+    if not isinstance(params, dict):
+        return jsonify({'success': False, 'error': 'params must be an object'}), 400
+    try:
+        template = config_templates.get(name)
+    except KeyError:
+        return jsonify({'success': False, 'error': f'Unknown template: {name}'}), 404
+    except (OSError, ValueError) as e:
+        return jsonify({'success': False, 'error': f'Template unavailable: {e}'}), 500
+    if data.get('apply') and name != 'singbox':
+        return jsonify({'success': False, 'error': 'apply is only supported for the singbox template'}), 400
+
+    started = time.perf_counter()
+    output, errors = template.render(params)
+    if errors:
+        return jsonify({'success': False, 'error': f"{errors[0]['param']}: {errors[0]['message']}",
+                        'errors': errors}), 400
+    if template.kind == 'text':
+        return jsonify({'success': True, 'hash': template.hash, 'content': output})
+    errors = check_singbox_config(output)
+    render_ms = round((time.perf_counter() - started) * 1000, 2)
+    if errors:
+        return jsonify({'success': False, 'error': f"{errors[0]['path']}: {errors[0]['message']}",
+                        'errors': errors}), 400
+    if not data.get('apply'):
+        return jsonify({'success': True, 'hash': template.hash, 'render_ms': render_ms, 'config': output})
+    return jsonify({**singbox_applier.apply(output), 'hash': template.hash, 'render_ms': render_ms})
 
 
 @app.route('/health')
@@ -610,6 +3309,80 @@ def health():
 # No initialization needed - config is generated by install script
 
 
+def benchmark_docker(rounds=20):
+    """Compare the former docker CLI forks with the Engine API client (run inside the agent container)"""
+    def cli(*args):
+        subprocess.run(['docker', *args], capture_output=True, timeout=30)
+
+    cases = [
+        ('services status', lambda: [cli('inspect', '-f', '{{.State.Status}}', f'sui-{s}') for s in ('singbox', 'adguard', 'caddy')],
+         container_states),
+        ('logs --tail 100', lambda: cli('logs', '--tail', '100', 'sui-singbox'), lambda: docker.logs('sui-singbox', 100)),
+        ('docker version', lambda: cli('--version'), docker.version),
+    ]
+    for name, via_cli, via_api in cases:
+        timings = {}
+        for label, fn in (('cli', via_cli), ('api', via_api)):
+            samples = []
+            for _ in range(rounds):
+                cpu, started = time.process_time(), time.perf_counter()
+                children = os.times()
+                fn()
+                after = os.times()
+                wall = time.perf_counter() - started
+                cpu = time.process_time() - cpu + (after.children_user + after.children_system) - (children.children_user + children.children_system)
+                samples.append((wall, cpu))
+            samples.sort()
+            timings[label] = samples[len(samples) // 2]
+        print(f"{name:<18} cli {timings['cli'][0] * 1000:8.2f} ms ({timings['cli'][1] * 1000:6.2f} ms cpu)   "
+              f"api {timings['api'][0] * 1000:8.2f} ms ({timings['api'][1] * 1000:6.2f} ms cpu)")
+
+
+def benchmark_validate(users=50000, rules=20000):
+    """Time the schema validator against json.loads on a generated config of the given size"""
+    config = {
+        'log': {'level': 'info'},
+        'inbounds': [
+            {'type': 'vless', 'tag': 'vless-in', 'listen': '::', 'listen_port': 443,
+             'users': [{'name': f'user{i}', 'uuid': str(uuid_lib.UUID(int=i)), 'flow': 'xtls-rprx-vision'}
+                       for i in range(users)],
+             'tls': {'enabled': True, 'server_name': 'example.com',
+                     'reality': {'enabled': True, 'handshake': {'server': 'example.com', 'server_port': 443},
+                                 'private_key': 'A' * 43, 'short_id': ['0123456789abcdef']}}},
+            {'type': 'hysteria2', 'tag': 'hy2-in', 'listen': '::', 'listen_port': 8443,
+             'users': [{'name': f'user{i}', 'password': f'secret{i}'} for i in range(users)]},
+        ],
+        'outbounds': [{'type': 'direct', 'tag': 'direct'}, {'type': 'block', 'tag': 'block'}],
+        'route': {'rules': [{'ip_cidr': [f'10.{i // 256 % 256}.{i % 256}.0/24'], 'domain_suffix': [f'site{i}.example'],
+                             'port': [80, 443], 'inbound': 'vless-in', 'outbound': 'block' if i % 2 else 'direct'}
+                            for i in range(rules)],
+                  'final': 'direct'},
+    }
+    content = json.dumps(config)
+    print(f'config: {users} users x 2 inbounds, {rules} route rules, {len(content) / 1e6:.1f} MB')
+    for label, fn in (('json.loads', lambda: json.loads(content)),
+                      ('validate', lambda: validate_singbox_config(content))):
+        samples = []
+        for _ in range(5):
+            started = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - started)
+        print(f'{label:<12} {sorted(samples)[2] * 1000:8.1f} ms')
+    config['inbounds'][0]['users'][7]['uuid'] = 'not-a-uuid'
+    config['inbounds'][1]['listen_port'] = 70000
+    config['route']['rules'][3]['outbound'] = 'missing'
+    config['route']['rules'][5]['ip_cidr'] = ['10.0.0.0/33']
+    valid, errors = validate_singbox_config(json.dumps(config))
+    for error in errors:
+        print(f"  {error['path']}: {error['message']}")
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['bench-docker']:
+        benchmark_docker(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+        sys.exit(0)
+    if sys.argv[1:2] == ['bench-validate']:
+        benchmark_validate(*(int(arg) for arg in sys.argv[2:4]))
+        sys.exit(0)
     print(f"[SUI Solo Agent] {NODE_DOMAIN} | /{PATH_PREFIX}/api/v1/")
     app.run(host='0.0.0.0', port=5001)
@@ -0,0 +1,5 @@
+# Read by gunicorn from the working directory, so updates that replace only the code
+# files (not the image) still get threaded workers: SSE log streams hold a thread
+# for as long as the client follows, which a sync worker would kill at `timeout`.
+worker_class = 'gthread'
+threads = 8
@@ -0,0 +1,88 @@
+#!/usr/bin/env bats
+
+# Feature: fleet jobs, Property 1: a running job stays visible while a step outlasts STALE_AFTER
+# Feature: fleet jobs, Property 2: progress writes never undo an abort request
+# Feature: fleet jobs, Property 3: of concurrent exclusive claims on one kind exactly one gets a job
+
+setup() {
+    python3 -c 'import flask, requests' 2>/dev/null || skip "master dependencies not installed"
+    TEST_DATA_DIR="$(mktemp -d)"
+}
+
+teardown() {
+    rm -rf "$TEST_DATA_DIR"
+}
+
+run_master_python() {
+    (cd master && DATA_DIR="$TEST_DATA_DIR" CLUSTER_SECRET=test python3 -c "$1")
+}
+
+@test "Property 1: Rollout with a node update slower than STALE_AFTER is not reported lost" {
+    run run_master_python '
+import asyncio, time, app
+app.JobStore.STALE_AFTER = 1
+app.JobStore.HEARTBEAT = 0.2
+
+async def slow_update(node, endpoint, method="GET", data=None, timeout=30, headers=None):
+    await asyncio.sleep(3)
+    return {"success": False, "error": "stub"}
+
+app.node_client.call = slow_update
+rollout = app.RollingUpdate({"0000000a": {"name": "a", "domain": "a.example.com"}}, canary=0)
+job_id = rollout.start()
+for _ in range(10):
+    time.sleep(0.25)
+    assert app.job_store.get(job_id)["state"] == "running", app.job_store.get(job_id)
+    assert app.job_store.active("rollout"), "rollout no longer active"
+while app.job_store.get(job_id)["state"] == "running":
+    time.sleep(0.1)
+print(app.job_store.get(job_id)["state"])
+'
+    [ "$status" -eq 0 ]
+    # the stub update fails, so the rollout ends aborted on its failure ratio - but never lost
+    [[ "${lines[-1]}" == "aborted" ]]
+}
+
+@test "Property 2: Saving running progress keeps a requested abort" {
+    run run_master_python '
+import app
+progress = {"state": "running", "nodes": {}}
+job_id = app.job_store.create("rollout", progress)
+assert app.job_store.request_abort(job_id)
+app.job_store.save(job_id, progress)
+assert app.job_store.state(job_id) == "aborting", app.job_store.state(job_id)
+assert app.job_store.get(job_id)["state"] == "aborting"
+progress["state"] = "aborted"
+app.job_store.save(job_id, progress)
+print(app.job_store.state(job_id))
+'
+    [ "$status" -eq 0 ]
+    [[ "${lines[-1]}" == "aborted" ]]
+}
+
+@test "Property 3: Concurrent exclusive creates start one job per kind; a lost job does not block" {
+    run run_master_python '
+import threading, time, app
+app.JobStore.STALE_AFTER = 1
+barrier = threading.Barrier(16)
+claimed = []
+
+def claim(kind):
+    barrier.wait()
+    claimed.append((kind, app.job_store.create(kind, {"state": "running"}, exclusive=True)))
+
+threads = [threading.Thread(target=claim, args=(kind,)) for kind in ("rollout", "config") for _ in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+for kind in ("rollout", "config"):
+    winners = [job_id for k, job_id in claimed if k == kind and job_id]
+    assert len(winners) == 1, (kind, claimed)
+    assert [job["id"] for job in app.job_store.active(kind)] == winners
+time.sleep(1.2)
+print(bool(app.job_store.create("rollout", {"state": "running"}, exclusive=True)))
+'
+    [ "$status" -eq 0 ]
+    [[ "${lines[-1]}" == "True" ]]
+}
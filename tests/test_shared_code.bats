@@ -0,0 +1,91 @@
+#!/usr/bin/env bats
+
+# Feature: shared code, Property 1: master and agent carry identical copies of the shared classes
+# Feature: shared code, Property 2: master and agent render a fixed corpus to identical output
+
+MASTER="master/app.py"
+AGENT="node/agent.py"
+
+# Print the lines of $1 from the line matching $2 up to (not including) the next line matching $3
+extract() {
+    sed -n "/$2/,/$3/p" "$1" | sed '$d'
+}
+
+@test "Property 1: Template engine is identical in master and agent" {
+    master_engine=$(extract "$MASTER" '^TEMPLATE_PLACEHOLDER = ' '^class TemplateCatalog')
+    agent_engine=$(extract "$AGENT" '^TEMPLATE_PLACEHOLDER = ' '^class TemplateSet')
+    [ -n "$master_engine" ]
+    [ "$master_engine" = "$agent_engine" ]
+}
+
+@test "Property 1: config_digest is identical in master and agent" {
+    master_digest=$(sed -n '/^def config_digest/,/^$/p' "$MASTER")
+    agent_digest=$(sed -n '/^def config_digest/,/^$/p' "$AGENT")
+    [ -n "$master_digest" ]
+    [ "$master_digest" = "$agent_digest" ]
+}
+
+@test "Property 1: RateLimiter is identical in master and agent" {
+    master_class=$(extract "$MASTER" '^class RateLimiter:' '^[a-z_]* = \|^def \|^# Kept identical')
+    agent_class=$(extract "$AGENT" '^class RateLimiter:' '^[a-z_]* = \|^def \|^# Kept identical')
+    [ -n "$master_class" ]
+    [ "$master_class" = "$agent_class" ]
+}
+
+@test "Property 1: Metrics is identical in master and agent" {
+    master_class=$(extract "$MASTER" '^class Metrics:' '^[a-z_]* = \|^def \|^# Kept identical')
+    agent_class=$(extract "$AGENT" '^class Metrics:' '^[a-z_]* = \|^def \|^# Kept identical')
+    [ -n "$master_class" ]
+    [ "$master_class" = "$agent_class" ]
+}
+
+@test "Property 1: LeaderLock is identical in master and agent" {
+    master_class=$(extract "$MASTER" '^class LeaderLock:' '^[a-z_]* = \|^def \|^# ')
+    agent_class=$(extract "$AGENT" '^class LeaderLock:' '^[a-z_]* = \|^def \|^# ')
+    [ -n "$master_class" ]
+    [ "$master_class" = "$agent_class" ]
+}
+
+@test "Property 2: Master and agent render the shipped templates identically" {
+    python3 -c 'import flask, requests' 2>/dev/null || skip "dependencies not installed"
+    data_dir="$(mktemp -d)"
+    run env DATA_DIR="$data_dir" CONFIG_DIR="$data_dir" CLUSTER_SECRET=test python3 -c '
+import json, sys
+sys.path[:0] = ["master", "node"]
+import app, agent
+
+corpus = {
+    "singbox": [
+        {"VLESS_UUID": "0f3c6a1e-1111-4222-8333-444455556666", "NODE_DOMAIN": "n1.example.com",
+         "ACME_EMAIL": "ops@example.com", "GATEWAY_CONTAINER": "sui-gateway",
+         "HY2_PASSWORD": "pw-1", "CLASH_API_SECRET": "s3cret"},
+        {"VLESS_UUID": "A0000000-0000-4000-8000-00000000000F", "NODE_DOMAIN": "xn--bcher-kva.example",
+         "ACME_EMAIL": "a+b@example.org", "GATEWAY_CONTAINER": "gw.1",
+         "HY2_PASSWORD": "p/w+=~$", "CLASH_API_SECRET": "x"},
+    ],
+    "caddy": [
+        {"MasterDomain": "m.example.com", "NodeDomain": "n.example.com", "PathPrefix": "0123abcd",
+         "AdGuardAdminPass": "$2a$10$abcdefghijklmnopqrstuv"},
+        {"MasterDomain": "Master.Example.COM", "NodeDomain": "node-2.Example.NET", "PathPrefix": "ff",
+         "AdGuardAdminPass": "$2b$12$ABC./xyz0123456789+=~"},
+    ],
+}
+for name, cases in corpus.items():
+    agent_template = agent.config_templates.get(name)
+    master_template = app.template_catalog.compile(name, agent_template.source)
+    assert master_template.hash == agent_template.hash
+    for params in cases + [{}]:
+        agent_out, agent_errors = agent_template.render(params)
+        master_out, master_errors = master_template.render(params)
+        assert agent_errors == master_errors, (agent_errors, master_errors)
+        if agent_out is None:
+            continue
+        assert agent_out == master_out
+        rendered = json.dumps(agent_out, indent=2) if name == "singbox" else agent_out
+        assert app.config_digest(name, master_out) == agent.config_digest(name, rendered)
+print("ok")
+'
+    rm -rf "$data_dir"
+    [ "$status" -eq 0 ]
+    [[ "${lines[-1]}" == "ok" ]]
+}
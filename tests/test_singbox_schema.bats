@@ -0,0 +1,120 @@
+#!/usr/bin/env bats
+
+# Feature: sing-box schema, Property 1: a known-bad config yields exactly the expected {path, message} list
+# Feature: sing-box schema, Property 2: the shipped template renders to a config with zero errors
+
+setup() {
+    python3 -c 'import flask' 2>/dev/null || skip "agent dependencies not installed"
+    TEST_CONFIG_DIR="$(mktemp -d)"
+}
+
+teardown() {
+    rm -rf "$TEST_CONFIG_DIR"
+}
+
+# Python from stdin with the agent importable; check(config, expected) prints the diff on mismatch
+run_schema_python() {
+    (cd node && CONFIG_DIR="$TEST_CONFIG_DIR" RATE_LIMIT_DIR= python3 -c '
+import sys, agent
+
+def check(config, expected):
+    errors = agent.check_singbox_config(config)
+    if errors != [{"path": path, "message": message} for path, message in expected]:
+        for error in errors:
+            print(error)
+        raise SystemExit(1)
+
+exec(sys.stdin.read())
+print("ok")
+')
+}
+
+@test "Property 1: Listable fields accept a value or a list and check every item" {
+    run run_schema_python <<'PY'
+check({'outbounds': [{'type': 'direct', 'tag': 'direct'}], 'route': {'rules': [
+    {'port': '443', 'outbound': 'direct'},
+    {'port': [443, 0, 'x'], 'domain_suffix': 5, 'network': ['tcp', 'icmp'], 'outbound': 'direct'},
+    {'ip_cidr': ['10.0.0.0/8', '10.0.0.0/33'], 'domain': ['a.com', 'b.com'], 'port': 8443, 'outbound': 'direct'},
+]}}, [
+    ('$.route.rules[0].port', 'must be integer or a list of them'),
+    ('$.route.rules[1].port[1]', 'must be between 1 and 65535'),
+    ('$.route.rules[1].port[2]', 'must be integer or a list of them'),
+    ('$.route.rules[1].domain_suffix', 'must be string or a list of them'),
+    ('$.route.rules[1].network[1]', "must be one of: 'tcp', 'udp'"),
+    ('$.route.rules[2].ip_cidr[1]', 'must be an IP address or CIDR'),
+])
+PY
+    [ "$status" -eq 0 ]
+    [ "${lines[-1]}" = "ok" ]
+}
+
+@test "Property 1: Discriminators pick the variant, default_variant covers an omitted type" {
+    run run_schema_python <<'PY'
+check({
+    'outbounds': [{'type': 'direct', 'tag': 'direct'}],
+    'inbounds': [{'listen_port': 443},
+                 {'type': 'vless', 'users': [{'uuid': 'x'}], 'transport': {'type': 'h2'}}],
+    'route': {'rules': [{'outbound': 'direct', 'invert': 'yes'},
+                        {'type': 'logical', 'mode': 'xor', 'rules': []}]},
+}, [
+    ('$.inbounds[0].type', 'is required'),
+    ('$.inbounds[1].users[0].uuid', 'must be a UUID'),
+    ('$.inbounds[1].transport.type', "unknown type 'h2' (expected one of: grpc, http, httpupgrade, quic, tcp, ws)"),
+    ('$.route.rules[0].invert', 'must be boolean'),
+    ('$.route.rules[1].mode', "must be one of: 'and', 'or'"),
+    ('$.route.rules[1].rules', 'must have at least 1 item(s)'),
+    ('$.route.rules[1].outbound', 'is required (or set an action other than route)'),
+])
+PY
+    [ "$status" -eq 0 ]
+    [ "${lines[-1]}" = "ok" ]
+}
+
+@test "Property 1: Duplicate tags and unknown references are reported where they occur" {
+    run run_schema_python <<'PY'
+check({
+    'inbounds': [{'type': 'direct', 'tag': 'in', 'detour': 'nowhere'}],
+    'outbounds': [{'type': 'direct', 'tag': 'direct'}, {'type': 'block', 'tag': 'direct'},
+                  {'type': 'selector', 'tag': 'pick', 'outbounds': ['direct', 'proxy']}],
+    'route': {'rules': [{'inbound': ['in', 'other'], 'outbound': 'gone'}], 'final': 'missing'},
+}, [
+    ('$.outbounds[1].tag', "duplicate outbound tag 'direct' (also at $.outbounds[0].tag)"),
+    ('$.inbounds[0].detour', "unknown inbound tag 'nowhere'"),
+    ('$.outbounds[2].outbounds[1]', "unknown outbound tag 'proxy'"),
+    ('$.route.rules[0].inbound[1]', "unknown inbound tag 'other'"),
+    ('$.route.rules[0].outbound', "unknown outbound tag 'gone'"),
+    ('$.route.final', "unknown outbound tag 'missing'"),
+])
+PY
+    [ "$status" -eq 0 ]
+    [ "${lines[-1]}" = "ok" ]
+}
+
+@test "Property 1: Errors past SCHEMA_MAX_ERRORS collapse into one overflow line" {
+    run run_schema_python <<'PY'
+assert agent.SCHEMA_MAX_ERRORS == 200
+outbounds = [{'type': 'direct', 'tag': f't{i}', 'override_port': 0} for i in range(250)]
+check({'outbounds': outbounds},
+      [(f'$.outbounds[{i}].override_port', 'must be between 1 and 65535') for i in range(200)]
+      + [('$', '... and 50 more errors')])
+check([], [('$', 'must be object')])
+PY
+    [ "$status" -eq 0 ]
+    [ "${lines[-1]}" = "ok" ]
+}
+
+@test "Property 2: Shipped sing-box template renders to a config with zero errors" {
+    run run_schema_python <<'PY'
+import json
+config, errors = agent.config_templates.get('singbox').render({
+    'VLESS_UUID': '0f3c6a1e-1111-4222-8333-444455556666', 'NODE_DOMAIN': 'n1.example.com',
+    'ACME_EMAIL': 'ops@example.com', 'GATEWAY_CONTAINER': 'sui-gateway', 'HY2_PASSWORD': 'pw-1',
+    'CLASH_API_SECRET': 's3cret',
+})
+assert errors == [], errors
+check(config, [])
+assert agent.validate_singbox_config(json.dumps(config)) == (True, config)
+PY
+    [ "$status" -eq 0 ]
+    [ "${lines[-1]}" = "ok" ]
+}
@@ -0,0 +1,88 @@
+#!/usr/bin/env bats
+
+# Feature: traffic statistics, Property 1: every resolution sums exactly the samples of its retained buckets
+# Feature: traffic statistics, Property 2: the stub source feeds the sampler without master-managed users
+
+setup() {
+    python3 -c 'import flask' 2>/dev/null || skip "agent dependencies not installed"
+    TEST_CONFIG_DIR="$(mktemp -d)"
+}
+
+teardown() {
+    rm -rf "$TEST_CONFIG_DIR"
+}
+
+run_agent_python() {
+    (cd node && CONFIG_DIR="$TEST_CONFIG_DIR" RATE_LIMIT_DIR= python3 -c "$1")
+}
+
+@test "Property 1: 1m/1h/1d rollups match a reference model across bucket rollover and ring wrap" {
+    run run_agent_python '
+import os, random, time, agent
+store = agent.StatsStore(os.path.join(os.environ["CONFIG_DIR"], "traffic.bin"), 4)
+rng = random.Random(7)
+now = time.time()
+time.time = lambda: now  # query() windows on the clock; keep it on this minute
+end = now - now % 60
+# Hourly samples for 95 days (past the 90-day and 14-day rings), then every
+# minute for the last 13 hours (past the 12-hour ring)
+stamps = [end - 95 * 86400 + h * 3600 + 17 for h in range(95 * 24 - 13)]
+stamps += [end - m * 60 + 5 for m in range(13 * 60, -1, -1)]
+samples = []
+for ts in stamps:
+    sample = (rng.randrange(1 << 20), rng.randrange(1 << 24), rng.randrange(50))
+    store.record({"total": sample}, ts)
+    samples.append((ts, sample))
+
+for resolution, (step, cap) in agent.StatsStore.RESOLUTIONS.items():
+    oldest = now - now % step - (cap - 1) * step
+    model = {}
+    for ts, (up, down, connections) in samples:
+        start = ts - ts % step
+        if start >= oldest:
+            bucket = model.setdefault(start, [0, 0, 0, 0, 0])
+            bucket[0] += up
+            bucket[1] += down
+            bucket[2] = max(bucket[2], connections)
+            bucket[3] += connections
+            bucket[4] += 1
+    expected = [[int(start), up, down, peak, round(total / count, 2)]
+                for start, (up, down, peak, total, count) in sorted(model.items())]
+    got = store.query(["total"], resolution)["total"]
+    assert len(got) <= cap, (resolution, len(got))
+    assert got == expected, (resolution, len(got), len(expected), got[:2], expected[:2])
+    print(resolution, len(got))
+
+# until and since narrow the window
+since, until = end - 3600, end - 1800
+window = store.query(["total"], "1m", since=since, until=until)["total"]
+assert [p[0] for p in window] == list(range(int(since), int(until) + 1, 60))
+assert store.query(["missing"], "1h") == {}
+print("ok")
+'
+    [ "$status" -eq 0 ]
+    [ "${lines[0]}" = "1m 720" ]
+    [ "${lines[1]}" = "1h 336" ]
+    [ "${lines[2]}" = "1d 90" ]
+    [ "${lines[3]}" = "ok" ]
+}
+
+@test "Property 2: Stub source produces total, inbound and user series on a node without managed users" {
+    run run_agent_python '
+import os, agent
+path = os.path.join(os.environ["CONFIG_DIR"], "traffic.bin")
+sampler = agent.TrafficSampler("http://unused", "", 10, lambda: agent.StatsStore(path, 16),
+                               source=agent.StubConnectionsSource(clients=3))
+for _ in range(3):
+    sampler.sample_once()
+names = [name for name, _ in sampler.get_store().series()]
+print(",".join(names))
+points = sampler.get_store().query(["total", "user:stub-0"], "1m")
+assert points["total"] and points["total"][-1][1] > 0 and points["total"][-1][3] == 3, points
+assert points["user:stub-0"][-1][2] > 0, points
+print("ok")
+'
+    [ "$status" -eq 0 ]
+    [ "${lines[0]}" = "inbound:hy2-in,inbound:vless-in,total,user:stub-0,user:stub-1,user:stub-2" ]
+    [ "${lines[1]}" = "ok" ]
+}
@@ -47,6 +47,8 @@ update_master() {
     cp "$TMP_DIR/SUIS-main/master/app.py" "$INSTALL_DIR/master/app.py"
     cp "$TMP_DIR/SUIS-main/master/templates/index.html" "$INSTALL_DIR/master/templates/index.html"
     cp "$TMP_DIR/SUIS-main/master/requirements.txt" "$INSTALL_DIR/master/requirements.txt"
+    cp "$TMP_DIR/SUIS-main/master/gunicorn.conf.py" "$INSTALL_DIR/master/gunicorn.conf.py"
+    cp "$TMP_DIR/SUIS-main/master/Dockerfile" "$INSTALL_DIR/master/Dockerfile"
     
     log "Master files updated"
     
@@ -74,6 +76,8 @@ update_node() {
     # Copy new files
     cp "$TMP_DIR/SUIS-main/node/agent.py" "$INSTALL_DIR/node/agent.py"
     cp "$TMP_DIR/SUIS-main/node/requirements.txt" "$INSTALL_DIR/node/requirements.txt"
+    cp "$TMP_DIR/SUIS-main/node/gunicorn.conf.py" "$INSTALL_DIR/node/gunicorn.conf.py"
+    cp "$TMP_DIR/SUIS-main/node/Dockerfile" "$INSTALL_DIR/node/Dockerfile"
     
     log "Node files updated"
     